@@ -1,134 +1,179 @@
-
 # used by the PREPROCESS class and specified by the MISFIT parameter
 
+# Like misfit functions, adjoint trace generators accept either single traces
+# or (nrec, nt) arrays of traces. The analytic signal of each input is
+# computed only once, and if the SCRATCH dictionary already filled by the
+# misfit function of the same name is passed, not at all.
 
 
 import numpy as _np
-from scipy.signal import hilbert as _analytic
+from scipy.signal import hilbert as _scipy_hilbert
 
 from seisflows.plugins import misfit
-from seisflows.tools.math import hilbert as _hilbert
+from seisflows.tools import dispersion
+from seisflows.plugins.misfit import _analytic, _envelope, _phase
 
 
 ### adjoint traces generators
 
 
-def Waveform(syn, obs, nt, dt):
+def Waveform(syn, obs, nt, dt, scratch=None):
     # waveform difference
     # (Tromp et al 2005, eq 9)
     wadj = syn - obs
     return wadj
 
 
-def Envelope(syn, obs, nt, dt, eps=0.05):
+def Envelope(syn, obs, nt, dt, eps=0.05, scratch=None):
     # envelope difference
     # (Yuan et al 2015, eq 16)
-    esyn = abs(_analytic(syn))
-    eobs = abs(_analytic(obs))
-    etmp = (esyn - eobs)/(esyn + eps*esyn.max())
-    wadj = etmp*syn - _np.imag(_analytic(etmp*_np.imag(_analytic(syn))))
+    asyn = _analytic(syn, 'syn', scratch)
+    esyn = _envelope(syn, 'syn', scratch)
+    eobs = _envelope(obs, 'obs', scratch)
+    etmp = (esyn - eobs)/(esyn + eps*_max(esyn))
+    wadj = etmp*syn - _hilbert(etmp*_np.imag(asyn))
     return wadj
 
 
-def InstantaneousPhase(syn, obs, nt, dt, eps=0.05):
-    # instantaneous phase 
+def InstantaneousPhase(syn, obs, nt, dt, eps=0.05, scratch=None):
+    # instantaneous phase
     # (Bozdag et al 2011, eq 27)
-    r = _np.real(_analytic(syn))
-    i = _np.imag(_analytic(syn))
-    phi_syn = _np.arctan2(i,r)
-
-    r = _np.real(_analytic(obs))
-    i = _np.imag(_analytic(obs))
-    phi_obs = _np.arctan2(i,r)
+    asyn = _analytic(syn, 'syn', scratch)
+    phi_syn = _phase(syn, 'syn', scratch)
+    phi_obs = _phase(obs, 'obs', scratch)
 
     phi_rsd = phi_syn - phi_obs
-    esyn = abs(_analytic(syn))
-    emax = max(esyn**2.)
+    esyn = _envelope(syn, 'syn', scratch)
+    emax = _max(esyn**2.)
 
-    wadj = phi_rsd*_np.imag(_analytic(syn))/(esyn**2. + eps*emax) + \
-           _np.imag(_analytic(phi_rsd * syn/(esyn**2. + eps*emax)))
+    wadj = phi_rsd*_np.imag(asyn)/(esyn**2. + eps*emax) + \
+           _hilbert(phi_rsd * syn/(esyn**2. + eps*emax))
 
     return wadj
 
 
-def Traveltime(syn, obs, nt, dt):
+def Traveltime(syn, obs, nt, dt, scratch=None):
     # cross correlation traveltime
     # (Tromp et al 2005, eq 45)
-    wadj = _np.zeros(nt)
-    wadj[1:-1] = (syn[2:] - syn[0:-2])/(2.*dt)
-    wadj *= 1./(sum(wadj*wadj)*dt)
-    wadj *= misfit.Traveltime(syn,obs,nt,dt)
+    wadj = _velocity(syn, dt)
+    wadj *= 1./(_sum(wadj*wadj)*dt)
+    wadj *= _column(misfit.Traveltime(syn,obs,nt,dt,scratch=scratch))
     return wadj
 
 
-def TraveltimeInexact(syn, obs, nt, dt):
+def TraveltimeInexact(syn, obs, nt, dt, scratch=None):
     # must faster but possibly inaccurate
-    wadj = _np.zeros(nt)
-    wadj[1:-1] = (syn[2:] - syn[0:-2])/(2.*dt)
-    wadj *= 1./(sum(wadj*wadj)*dt)
-    wadj *= misfit.TraveltimeInexact(syn,obs,nt,dt)
+    wadj = _velocity(syn, dt)
+    wadj *= 1./(_sum(wadj*wadj)*dt)
+    wadj *= _column(misfit.TraveltimeInexact(syn,obs,nt,dt))
     return wadj
 
 
-def Amplitude(syn, obs, nt, dt):
+def Amplitude(syn, obs, nt, dt, scratch=None):
     # cross correlation amplitude
-    wadj = 1./(sum(syn*syn)*dt) * syn
-    wadj *= misfit.Amplitude(syn,obs,nt,dt)
+    wadj = 1./(_sum(syn*syn)*dt) * syn
+    wadj *= _column(misfit.Amplitude(syn,obs,nt,dt,scratch=scratch))
     return wadj
 
 
 
 
-def Envelope2(syn, obs, nt, dt, eps=0.):
+def Envelope2(syn, obs, nt, dt, eps=0., scratch=None):
     # envelope amplitude ratio
     # (Yuan et al 2015, eqs B-2, B-3)
     raise NotImplementedError
 
 
-def Envelope3(syn, obs, nt, dt, eps=0.):
+def Envelope3(syn, obs, nt, dt, eps=0., scratch=None):
     # envelope lag
     # (Yuan et al 2015, eqs B-2, B-5)
-    esyn = abs(_analytic(syn))
-    eobs = abs(_analytic(obs))
+    esyn = _envelope(syn, 'syn', scratch)
+    eobs = _envelope(obs, 'obs', scratch)
 
-    erat = _np.zeros(nt)
-    erat[1:-1] = (esyn[2:] - esyn[0:-2])/(2.*dt)
-    erat[1:-1] /= esyn[1:-1]
-    erat *= misfit.Envelope3(syn, obs, nt, dt)
+    erat = _velocity(esyn, dt)
+    erat[..., 1:-1] /= esyn[..., 1:-1]
+    erat *= _column(misfit.Envelope3(syn, obs, nt, dt, scratch=scratch))
 
     wadj = -erat*syn + _hilbert(erat*_hilbert(esyn))
     return wadj
 
 
-def InstantaneousPhase2(syn, obs, nt, dt, eps=0.):
-    esyn = abs(_analytic(syn))
-    eobs = abs(_analytic(obs))
+def InstantaneousPhase2(syn, obs, nt, dt, eps=0., scratch=None):
+    hsyn = _np.imag(_analytic(syn, 'syn', scratch))
+    hobs = _np.imag(_analytic(obs, 'obs', scratch))
+    esyn = _envelope(syn, 'syn', scratch)
+    eobs = _envelope(obs, 'obs', scratch)
 
-    esyn1 = esyn + eps*max(esyn)
-    eobs1 = eobs + eps*max(eobs)
-    esyn3 = esyn**3 + eps*max(esyn**3)
+    esyn1 = esyn + eps*_max(esyn)
+    eobs1 = eobs + eps*_max(eobs)
+    esyn3 = esyn**3 + eps*_max(esyn**3)
 
     diff1 = syn/(esyn1) - obs/(eobs1)
-    diff2 = _hilbert(syn)/esyn1 - _hilbert(obs)/eobs1
+    diff2 = hsyn/esyn1 - hobs/eobs1
 
-    part1 = diff1*_hilbert(syn)**2/esyn3 - diff2*syn*_hilbert(syn)/esyn3
-    part2 = diff1*syn*_hilbert(syn)/esyn3 - diff2*syn**2/esyn3
+    part1 = diff1*hsyn**2/esyn3 - diff2*syn*hsyn/esyn3
+    part2 = diff1*syn*hsyn/esyn3 - diff2*syn**2/esyn3
 
     wadj = part1 + _hilbert(part2)
     return wadj
 
 
+def Dispersion(syn, obs, nt, dt, x=None, c=None, fmin=0., fmax=None,
+               eps=0.05, scratch=None):
+    # phase velocity-frequency image difference, through the transposed
+    # phase-shift transform
+    fidx, U, N, S, isyn = misfit._dispersion(syn, 'syn', dt, x, c, fmin, fmax,
+        eps, scratch)
+    iobs = misfit._dispersion(obs, 'obs', dt, x, c, fmin, fmax, eps,
+        scratch)[-1]
+    if x is None:
+        x = _np.arange(len(syn), dtype=float)
+    return dispersion.image_adjoint(isyn - iobs, nt, dt, x, c, fidx, U, N, S,
+        eps)
+
+Dispersion.gather = True
+
+
 
 ### migration
 
-def Displacement(syn, obs, nt, dt):
+def Displacement(syn, obs, nt, dt, scratch=None):
     return obs
 
-def Velocity(syn, obs, nt, dt):
-    adj[1:-1] = (obs[2:] - obs[0:-2])/(2.*dt)
+def Velocity(syn, obs, nt, dt, scratch=None):
+    adj = _np.zeros(_np.shape(obs))
+    adj[..., 1:-1] = (obs[..., 2:] - obs[..., 0:-2])/(2.*dt)
     return adj
 
-def Acceleration(syn, obs, nt, dt):
-    adj[1:-1] = (-obs[2:] + 2.*obs[1:-1] - obs[0:-2])/(2.*dt)
+def Acceleration(syn, obs, nt, dt, scratch=None):
+    adj = _np.zeros(_np.shape(obs))
+    adj[..., 1:-1] = (-obs[..., 2:] + 2.*obs[..., 1:-1] - obs[..., 0:-2])/(2.*dt)
     return adj
 
+
+
+### utility functions
+
+def _hilbert(w):
+    return _np.imag(_scipy_hilbert(w))
+
+
+def _velocity(w, dt):
+    # central difference time derivative, zero at end points
+    v = _np.zeros(_np.shape(w))
+    v[..., 1:-1] = (w[..., 2:] - w[..., 0:-2])/(2.*dt)
+    return v
+
+
+def _column(x):
+    # per-trace values, broadcastable against traces
+    return _np.expand_dims(x, -1)
+
+
+def _max(w):
+    return w.max(axis=-1, keepdims=True)
+
+
+def _sum(w):
+    return _np.sum(w, axis=-1, keepdims=True)
+
@@ -1,100 +1,175 @@
-
 # used by the PREPROCESS class and specified by the MISFIT parameter
 
+# Misfit functions accept either single traces or (nrec, nt) arrays of traces,
+# in which case one residual per trace is returned. Operations act along the
+# last axis. Functions marked as gather-level instead measure a whole
+# (nrec, nt) gather at once and take further keyword arguments describing
+# its geometry.
+
+# If a SCRATCH dictionary is passed, intermediate results such as analytic
+# signals, envelopes, phases and traveltime lags are stored in it, so that
+# the adjoint trace generator of the same name, called afterwards with the
+# same SCRATCH, does not compute them again.
 
 
 import numpy as np
-from scipy.signal import hilbert as _analytic
+from scipy.signal import hilbert as _hilbert
 
+from seisflows.tools import dispersion
+from seisflows.tools.signal import correlation_lag
 
-def Waveform(syn, obs, nt, dt):
+
+def Waveform(syn, obs, nt, dt, scratch=None):
     # waveform difference
     wrsd = syn-obs
-    return np.sqrt(np.sum(wrsd*wrsd*dt))
+    return np.sqrt(np.sum(wrsd*wrsd*dt, axis=-1))
 
 
-def Envelope(syn, obs, nt, dt, eps=0.05):
+def Envelope(syn, obs, nt, dt, eps=0.05, scratch=None):
     # envelope difference
     # (Yuan et al 2015, eq 9)
-    esyn = abs(_analytic(syn))
-    eobs = abs(_analytic(obs))
+    esyn = _envelope(syn, 'syn', scratch)
+    eobs = _envelope(obs, 'obs', scratch)
     ersd = esyn-eobs
-    return np.sqrt(np.sum(ersd*ersd*dt))
+    return np.sqrt(np.sum(ersd*ersd*dt, axis=-1))
 
 
-def InstantaneousPhase(syn, obs, nt, dt, eps=0.05):
-    # instantaneous phase 
+def InstantaneousPhase(syn, obs, nt, dt, eps=0.05, scratch=None):
+    # instantaneous phase
     # from Bozdag et al. 2011
 
-    r = np.real(_analytic(syn))
-    i = np.imag(_analytic(syn))
-    phi_syn = np.arctan2(i,r)
-
-    r = np.real(_analytic(obs))
-    i = np.imag(_analytic(obs))
-    phi_obs = np.arctan2(i,r)
+    phi_syn = _phase(syn, 'syn', scratch)
+    phi_obs = _phase(obs, 'obs', scratch)
 
     phi_rsd = phi_syn - phi_obs
-    return np.sqrt(np.sum(phi_rsd*phi_rsd*dt))
+    return np.sqrt(np.sum(phi_rsd*phi_rsd*dt, axis=-1))
 
 
-def Traveltime(syn, obs, nt, dt):
-    cc = abs(np.convolve(obs, np.flipud(syn)))
-    return (np.argmax(cc)-nt+1)*dt
+def Traveltime(syn, obs, nt, dt, subsample=False, scratch=None):
+    # cross correlation traveltime
+    return _traveltime(syn, obs, dt, subsample, 'traveltime', scratch)
 
 
-def TraveltimeInexact(syn, obs, nt, dt):
+def TraveltimeInexact(syn, obs, nt, dt, scratch=None):
     # much faster but possibly inaccurate
-    it = np.argmax(syn)
-    jt = np.argmax(obs)
+    it = np.argmax(syn, axis=-1)
+    jt = np.argmax(obs, axis=-1)
     return (jt-it)*dt
 
 
-def Amplitude(syn, obs, nt, dt):
+def Amplitude(syn, obs, nt, dt, scratch=None):
     # cross correlation amplitude
-    ioff = (np.argmax(cc)-nt+1)*dt
-    if ioff <= 0:
-        wrsd = syn[ioff:] - obs[:-ioff]
-    else:
-        wrsd = syn[:-ioff] - obs[ioff:]
-    return np.sqrt(np.sum(wrsd*wrsd*dt))
+    lag = _traveltime(syn, obs, dt, False, 'traveltime', scratch)
+    ioff = np.rint(lag/dt).astype(int)
+    wrsd = syn - _shift(obs, ioff)
+    return np.sqrt(np.sum(wrsd*wrsd*dt, axis=-1))
 
 
-def Envelope2(syn, obs, nt, dt, eps=0.):
+def Envelope2(syn, obs, nt, dt, eps=0., scratch=None):
     # envelope amplitude ratio
     # (Yuan et al 2015, eq B-1)
-    esyn = abs(_analytic(syn))
-    eobs = abs(_analytic(obs))
+    esyn = _envelope(syn, 'syn', scratch)
+    eobs = _envelope(obs, 'obs', scratch)
     raise NotImplementedError
 
 
-def Envelope3(syn, obs, nt, dt, eps=0.):
+def Envelope3(syn, obs, nt, dt, eps=0., scratch=None):
     # envelope cross-correlation lag
     # (Yuan et al 2015, eqs B-4)
-    esyn = abs(_analytic(syn))
-    eobs = abs(_analytic(obs))
-    return Traveltime(esyn, eobs, nt, dt)
+    esyn = _envelope(syn, 'syn', scratch)
+    eobs = _envelope(obs, 'obs', scratch)
+    return _traveltime(esyn, eobs, dt, False, 'envelope_traveltime', scratch)
 
 
-def InstantaneousPhase2(syn, obs, nt, dt, eps=0.):
-    esyn = abs(_analytic(syn))
-    eobs = abs(_analytic(obs))
+def InstantaneousPhase2(syn, obs, nt, dt, eps=0., scratch=None):
+    esyn = _envelope(syn, 'syn', scratch)
+    eobs = _envelope(obs, 'obs', scratch)
 
-    esyn1 = esyn + eps*max(esyn)
-    eobs1 = eobs + eps*max(eobs)
+    esyn1 = esyn + eps*esyn.max(axis=-1, keepdims=True)
+    eobs1 = eobs + eps*eobs.max(axis=-1, keepdims=True)
 
     diff = syn/esyn1 - obs/eobs1
 
-    return np.sqrt(np.sum(diff*diff*dt))
+    return np.sqrt(np.sum(diff*diff*dt, axis=-1))
+
+
+def Dispersion(syn, obs, nt, dt, x=None, c=None, fmin=0., fmax=None,
+               eps=0.05, scratch=None):
+    # phase velocity-frequency image difference, measured on whole gathers
+    # (Park et al 1998); returns one residual per frequency
+    isyn = _dispersion(syn, 'syn', dt, x, c, fmin, fmax, eps, scratch)[-1]
+    iobs = _dispersion(obs, 'obs', dt, x, c, fmin, fmax, eps, scratch)[-1]
+    rsd = isyn - iobs
+    return np.sqrt(np.sum(rsd*rsd, axis=0))
+
+# gather-level measurement, see preprocess.base.get_gather_options
+Dispersion.gather = True
 
 
 
-def Displacement(syn, obs, nt, dt):
+def Displacement(syn, obs, nt, dt, scratch=None):
     return Exception('This function can only used for migration.')
 
-def Velocity(syn, obs, nt, dt):
+def Velocity(syn, obs, nt, dt, scratch=None):
     return Exception('This function can only used for migration.')
 
-def Acceleration(syn, obs, nt, dt):
+def Acceleration(syn, obs, nt, dt, scratch=None):
     return Exception('This function can only used for migration.')
 
+
+
+### intermediate results
+
+def _analytic(w, name, scratch=None):
+    return _stored(scratch, 'analytic_'+name, lambda: _hilbert(w))
+
+
+def _envelope(w, name, scratch=None):
+    return _stored(scratch, 'envelope_'+name,
+        lambda: abs(_analytic(w, name, scratch)))
+
+
+def _phase(w, name, scratch=None):
+    return _stored(scratch, 'phase_'+name,
+        lambda: np.angle(_analytic(w, name, scratch)))
+
+
+def _traveltime(syn, obs, dt, subsample, name, scratch=None):
+    if subsample:
+        name += '_subsample'
+    return _stored(scratch, name,
+        lambda: correlation_lag(syn, obs, dt, subsample))
+
+
+def _dispersion(w, name, dt, x, c, fmin, fmax, eps, scratch=None):
+    if x is None:
+        x = np.arange(len(w), dtype=float)
+    if c is None:
+        raise ValueError('Phase velocities C are required.')
+    return _stored(scratch, 'dispersion_'+name,
+        lambda: dispersion.image(w, dt, x, c, fmin, fmax, eps))
+
+
+def _stored(scratch, key, func):
+    # returns SCRATCH[KEY], computing it first if necessary
+    if scratch is None:
+        return func()
+    if key not in scratch:
+        scratch[key] = func()
+    return scratch[key]
+
+
+
+### utility functions
+
+def _shift(v, it):
+    # shifts traces IT samples to the left, padding with zeros
+    v = np.asarray(v)
+    nt = v.shape[-1]
+    idx = np.arange(nt) + np.expand_dims(it, -1)
+    valid = (0 <= idx) & (idx < nt)
+    idx = np.clip(idx, 0, nt-1)
+    if v.ndim == 1:
+        return np.where(valid, v[idx], 0.)
+    return np.where(valid, v[np.arange(len(v))[:, np.newaxis], idx], 0.)
+
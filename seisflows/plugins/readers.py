@@ -1,46 +1,41 @@
-
-# SeisFlows uses obspy stream objects for holding and processing seismic data. In some cases, obspy.read doesn't  provide the desired behavior, so we introduce an additonal level of indirection
+# SeisFlows holds seismic data as gathers, that is, as (nrec, nt) arrays of
+# traces together with their headers. Readers return seisflows.tools.su.Gather
+# objects
 
 # used by the PREPROCESS class and specified by the READER parameter
 
+import numpy as np
+
+from seisflows.tools import su as _su
+
 
 def su(path, filename):
     """ Reads Seismic Unix files
 
-      Hardwired ''
+      Hardwired little-endian byte order
     """
-    import obspy
-    stream = obspy.read(path +'/'+ filename, 
-                   format='SU',
-                   byteorder='<')
-    return stream
+    return _su.read(path +'/'+ filename, byteorder='<')
 
 
 def ascii(path, filenames):
     """ Reads SPECFEM3D-style ascii data
     """
-    from numpy import loadtxt
-    from obspy.core import Stream, Stats, Trace
-
-    stream = Stream()
-    for filename in filenames:
-        stats = Stats()
-        data = loadtxt(path +'/'+ filename)
-
-        stats.filename = filename
-        stats.starttime = data[0,0]
-        stats.sampling_rate = data[0,1] - data[0,0]
-        stats.npts = len(data[:,0])
-
-        try:
-            parts = filename.split('.')
-            stats.network = parts[0]
-            stats.station = parts[1]
-            stats.channel = temp[2]
-        except:
-            pass
-
-        stream.append(Trace(data=data[:,1], header=stats))
-
-    return stream
+    headers = np.zeros(len(filenames), dtype=ASCII_HEADER)
+    traces = []
+    for ir, filename in enumerate(filenames):
+        data = np.loadtxt(path +'/'+ filename)
+
+        headers[ir]['filename'] = filename
+        headers[ir]['starttime'] = data[0,0]
+        headers[ir]['delta'] = data[1,0] - data[0,0]
+        traces += [data[:,1]]
+
+    return _su.Gather(np.array(traces), headers)
+
+
+# header fields of ascii gathers
+ASCII_HEADER = np.dtype([
+    ('filename', 'S256'),
+    ('starttime', 'f8'),
+    ('delta', 'f8')])
 
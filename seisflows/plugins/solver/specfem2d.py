@@ -1,5 +1,11 @@
 
+import os
 import sys
+from glob import glob
+from hashlib import sha1
+
+import numpy as np
+import scipy.sparse
 
 from seisflows.tools import array, unix
 from seisflows.tools.tools import exists, findpath
@@ -18,6 +24,7 @@ def write_sources(coords, path='.', ws=1., suffix=''):
         lines = f.readlines()
 
     filename = 'DATA/SOURCE' + suffix
+    unix.detach(filename)
     with open(filename, 'w') as f:
         f.writelines(lines)
 
@@ -73,6 +80,7 @@ def write_receivers(coords, path='.'):
         line += '%3.1f' % 0. + '\n'
         lines.extend(line)
 
+    unix.detach(filename)
     with open(filename, 'w') as f:
         f.writelines(lines)
 
@@ -97,10 +105,6 @@ def smooth_legacy(input_path='', output_path='', parameters=[], span=0.):
             kernels[key] = []
         #print len(kernels[key])
 
-        coords = {}
-        for key in ['x', 'z']:
-            coords[key] = []
-
         # read kernels
         for key in parameters or solver.parameters:
             for iproc in range(nproc):
@@ -109,22 +113,54 @@ def smooth_legacy(input_path='', output_path='', parameters=[], span=0.):
         if not span:
             return kernels
 
-        # read coordinates
-        for key in ['x', 'z']:
-            for iproc in range(nproc):
-                coords[key] += solver.io.read_slice(PATH.MODEL_INIT, key, iproc)
-
-        mesh = array.stack(coords['x'][0], coords['z'][0])
-        if nproc > 1:
-            for iproc in range(nproc-1):
-                mesh = array.append(mesh,array.stack(coords['x'][iproc+1], coords['z'][iproc+1]))
+        mesh = solver.geometry.mesh
 
-        # apply smoother
+        # apply smoother; gridsmooth sampled its Gaussian every other grid
+        # cell, so a span of SPAN cells corresponds to a deviation of SPAN/2
+        sigma = 0.5*np.multiply(span, solver.geometry.spacing)
+        G = smoothing_operator(mesh, sigma, PATH.SCRATCH+'/'+'smooth')
+        bounds = solver.geometry.offsets[1:-1]
         for key in parameters or solver.parameters:
-            kernels[key][:] = array.meshsmooth(kernels[key][:], mesh, span)
+            v = G.dot(np.concatenate(kernels[key]))
+            kernels[key][:] = np.split(v, bounds)
 
         # write smooth kernels
         for key in parameters or solver.parameters:
             for iproc in range(nproc):
                 solver.io.write_slice(kernels[key][iproc], output_path, key+'_kernel', iproc)
 
+
+def smoothing_operator(mesh, sigma, path):
+    """ Returns sparse Gaussian smoothing operator for MESH, reading it from
+      cache if it was built before
+
+      Operators are stored as .npz files in PATH, with file names containing
+      a hash of the mesh coordinates and of SIGMA, so that an operator is
+      rebuilt only if the initial model or smoothing length change.
+    """
+    key = sha1(np.ascontiguousarray(mesh).tostring())
+    key.update(np.asarray(sigma, dtype='float64').tostring())
+    cachefile = '%s/operator.%s.npz' % (path, key.hexdigest())
+
+    if cachefile in _smoothing_operators:
+        return _smoothing_operators[cachefile]
+
+    if exists(cachefile):
+        G = scipy.sparse.load_npz(cachefile)
+    else:
+        G = array.smoothing_operator(mesh, sigma)
+
+        # remove operators built for other meshes, then write atomically
+        unix.mkdir(path)
+        for stale in glob(path+'/'+'operator.*.npz'):
+            os.remove(stale)
+        tmpfile = '%s/.operator.%d.npz' % (path, os.getpid())
+        scipy.sparse.save_npz(tmpfile, G)
+        os.rename(tmpfile, cachefile)
+
+    _smoothing_operators.clear()
+    _smoothing_operators[cachefile] = G
+    return G
+
+
+_smoothing_operators = {}
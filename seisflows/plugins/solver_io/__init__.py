@@ -2,8 +2,9 @@
 # used by the SOLVER class and specified by the SOLVERIO parameter
 
 
-# ADIOS IO format is currently implemented in SPECFEM3D, but not SeisFlows
-#import adios
+# ADIOS IO format is implemented in SPECFEM3D; SeisFlows provides a
+# single-file container with the same role
+import adios
 
 import fortran_binary
 
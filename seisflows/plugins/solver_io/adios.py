@@ -1,9 +1,93 @@
 
-from os.path import abspath, join
-from shutil import copyfile
+# Single-file container for models and kernels, standing in for the ADIOS
+# format used by SPECFEM3D. All processor slices of all material parameters
+# in a directory are stored back to back in one data file, together with an
+# append-only index recording where each slice begins. Slices not found in
+# the container are read from Fortran binary files, so that models and
+# kernels written by the solver itself remain readable. Since the solver
+# cannot read the container, models it runs on are still written to its
+# databases as Fortran binary files (see solver.base.save).
+
+import os
+import fcntl
+import shutil
+import threading
+from os.path import exists, islink, join
 
 import numpy as np
 
+from seisflows.plugins.solver_io import fortran_binary
+from seisflows.tools.tools import iterable
+
+
+DATAFILE = 'container.dat'
+INDEXFILE = 'container.idx'
+LOCKFILE = 'container.lock'
+
+_lock = threading.Lock()
+_cache = {}
+
+
+def read_slice(path, parameters, iproc, mmap=False):
+    """ Reads SPECFEM model slice(s) from container
+    """
+    index = _load_index(path)
+    vals = []
+    for key in iterable(parameters):
+        name = _name(iproc, key)
+        if name not in index:
+            vals += fortran_binary.read_slice(path, key, iproc, mmap)
+            continue
+
+        offset, count = index[name]
+        if mmap and count > 0:
+            vals += [np.memmap(join(path, DATAFILE), dtype='float32',
+                mode='c', offset=offset, shape=(count,))]
+        else:
+            with open(join(path, DATAFILE), 'rb') as file:
+                file.seek(offset)
+                vals += [np.fromfile(file, dtype='float32', count=count)]
+    return vals
+
+
+def write_slice(data, path, parameters, iproc, inplace=False):
+    """ Writes SPECFEM model slice to container
+
+      Slices are always appended, and the index entry written after them
+      supersedes any earlier one, so that an interrupted write leaves the
+      previous version of the slice intact. Containers linked to other
+      directories are first replaced by private copies. INPLACE is accepted
+      for compatibility with other SOLVERIO modules
+    """
+    data = np.asarray(data, dtype='float32')
+
+    with _lock:
+        with open(join(path, LOCKFILE), 'a') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                _unshare(join(path, DATAFILE))
+                _unshare(join(path, INDEXFILE))
+                index = _load_index(path)
+                for key in iterable(parameters):
+                    _write(data, path, _name(iproc, key), index)
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+def copy_slice(src, dst, iproc, parameter):
+    """ Copies SPECFEM model slice
+    """
+    write_slice(read_slice(src, parameter, iproc)[0], dst, parameter, iproc)
+
+
+def exists_slice(path, parameter, iproc):
+    """ Checks whether slice is present, either in container or as Fortran
+      binary file
+    """
+    if _name(iproc, parameter) in _load_index(path):
+        return True
+    return fortran_binary.exists_slice(path, parameter, iproc)
+
 
 def mread(path, parameters, iproc, prefix='', suffix=''):
     """ Multiparameter read, callable by a single mpi process
@@ -11,20 +95,76 @@ def mread(path, parameters, iproc, prefix='', suffix=''):
     keys = []
     vals = []
     for key in sorted(parameters):
-        val = _read1(path, iproc, prefix+key+suffix)
+        val = read_slice(path, prefix+key+suffix, iproc)[0]
         keys += [key]
         vals += [val]
     return keys, vals
 
 
 def read(path, parameter, iproc):
-    """ Reads from ADIOS container
+    """ Reads from container
     """
-    raise NotImplementedError
+    return read_slice(path, parameter, iproc)[0]
 
 
 def write(v, path, parameter, iproc):
-    """ Writes to ADIOS container
+    """ Writes to container
+    """
+    write_slice(v, path, parameter, iproc)
+
+
+### utility functions
+
+def _name(iproc, key):
+    return 'proc%06d_%s' % (iproc, key)
+
+
+def _write(data, path, name, index):
+    """ Writes a single slice and records its location in the index
+    """
+    with open(join(path, DATAFILE), 'ab') as file:
+        file.seek(0, os.SEEK_END)
+        offset = file.tell()
+        data.tofile(file)
+        file.flush()
+        os.fsync(file.fileno())
+
+    # slice becomes visible only once fully written
+    with open(join(path, INDEXFILE), 'a') as file:
+        file.write('%s %d %d\n' % (name, offset, len(data)))
+    index[name] = (offset, len(data))
+
+
+def _load_index(path):
+    """ Parses container index, reusing the last parsed version if the index
+      file is unchanged
+    """
+    filename = join(path, INDEXFILE)
+    if not exists(filename):
+        return {}
+
+    stat = os.stat(filename)
+    key = (stat.st_mtime, stat.st_size)
+    if filename in _cache and _cache[filename][0] == key:
+        return _cache[filename][1]
+
+    index = {}
+    with open(filename, 'r') as file:
+        for line in file:
+            # later entries supersede earlier ones
+            name, offset, count = line.split()
+            index[name] = (int(offset), int(count))
+
+    _cache[filename] = (key, index)
+    return index
+
+
+def _unshare(filename):
+    """ Replaces symbolic or hard linked file by a private copy before
+      writing
     """
-    raise NotImplementedError
+    if islink(filename) or \
+       exists(filename) and os.stat(filename).st_nlink > 1:
+        shutil.copy(filename, filename+'.tmp')
+        os.rename(filename+'.tmp', filename)
 
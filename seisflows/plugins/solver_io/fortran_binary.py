@@ -1,26 +1,39 @@
 
-from os.path import abspath, getsize, join
+import os
+from os.path import abspath, exists, getsize, islink, join
 from shutil import copyfile
+from seisflows.tools import unix
 from seisflows.tools.tools import iterable
 
 import numpy as np
 
 
-def read_slice(path, parameters, iproc):
+def read_slice(path, parameters, iproc, mmap=False):
     """ Reads SPECFEM model slice(s)
+
+      If MMAP is True, slices are returned as copy-on-write views of the
+      files on disk rather than as in-memory copies
     """
     vals = []
     for key in iterable(parameters):
         filename = '%s/proc%06d_%s.bin' % (path, iproc, key)
-        vals += [_read(filename)]
+        if mmap:
+            vals += [_mmap(filename)]
+        else:
+            vals += [_read(filename)]
     return vals
 
 
-def write_slice(data, path, parameters, iproc):
+def write_slice(data, path, parameters, iproc, inplace=False):
     """ Writes SPECFEM model slice
+
+      If INPLACE is True, existing files of matching size are overwritten
+      through a memory map rather than truncated and rewritten
     """
     for key in iterable(parameters):
         filename = '%s/proc%06d_%s.bin' % (path, iproc, key)
+        if inplace and _write_inplace(data, filename):
+            continue
         _write(data, filename)
 
 
@@ -31,6 +44,12 @@ def copy_slice(src, dst, iproc, parameter):
     copyfile(join(src, filename), join(dst, filename))
 
 
+def exists_slice(path, parameter, iproc):
+    """ Checks whether SPECFEM model slice is present
+    """
+    return exists('%s/proc%06d_%s.bin' % (path, iproc, parameter))
+
+
 def _read(filename):
     """ Reads Fortran style binary data into numpy array
     """
@@ -50,6 +69,27 @@ def _read(filename):
             return data
 
 
+def _mmap(filename):
+    """ Maps Fortran style binary data into numpy array without reading it
+
+      The returned array is a view past the leading and trailing 4-byte record
+      markers. Pages are only read when accessed, and modifications are kept in
+      memory rather than written back to disk.
+    """
+    nbytes = getsize(filename)
+    if nbytes < 8 or nbytes % 4:
+        return _read(filename)
+
+    m = np.memmap(filename, dtype='int32', mode='c')
+
+    if m[0]==nbytes-8:
+        if m[-1]!=m[0]:
+            raise IOError('Inconsistent record markers: %s' % filename)
+        return m[1:-1].view('float32')
+    else:
+        return m.view('float32')
+
+
 def _write(v, filename):
     """ Writes Fortran style binary files--data are written as single precision
         floating point numbers
@@ -57,8 +97,38 @@ def _write(v, filename):
     n = np.array([4*len(v)], dtype='int32')
     v = np.array(v, dtype='float32')
 
+    unix.detach(filename)
     with open(filename, 'wb') as file:
         n.tofile(file)
         v.tofile(file)
         n.tofile(file)
 
+
+def _write_inplace(v, filename):
+    """ Overwrites data of an existing Fortran style binary file through a
+      memory map, leaving record markers untouched
+
+      Returns False without writing anything if the file is missing, has a
+      different size or layout, or is hard linked from elsewhere
+    """
+    if not exists(filename):
+        return False
+
+    if islink(filename) or os.stat(filename).st_nlink > 1:
+        # writing would modify every other link to the same data
+        return False
+
+    nbytes = getsize(filename)
+    if nbytes != 4*len(v)+8:
+        return False
+
+    m = np.memmap(filename, dtype='int32', mode='r+')
+    if m[0]!=nbytes-8 or m[-1]!=m[0]:
+        del m
+        return False
+
+    m[1:-1].view('float32')[:] = v
+    m.flush()
+    del m
+    return True
+
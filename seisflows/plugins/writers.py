@@ -1,55 +1,43 @@
-
-# SeisFlows uses obspy stream objects for holding and processing seismic data. In some cases, obspy.read doesn't  provide the desired behavior, so we introduce an additonal level of indirection
+# SeisFlows holds seismic data as gathers, that is, as (nrec, nt) arrays of
+# traces together with their headers. Writers accept seisflows.tools.su.Gather
+# objects
 
 # used by the PREPROCESS class and specified by the WRITER parameter
 
 
 import numpy as np
 
-def su(d, path, filename):
-    for t in d:
-        # work around obspy data type conversion
-        t.data = t.data.astype(np.float32)
-
-
-    max_delta = 0.065535
-    dummy_delta = max_delta
+from seisflows.tools import su as _su
 
-    if d[0].stats.delta > max_delta:
-        for t in d:
-            t.stats.delta = dummy_delta
-
-    # write data to file
-    d.write(path+'/'+filename, format='SU')
 
+def su(d, path, filename):
+    """ Writes Seismic Unix files
+    """
+    _su.write(d, path +'/'+ filename, byteorder='<')
 
-def ascii(stream, path, filenames):
-    for ir, tr in enumerate(stream):
-        nt = tr.stats.npts
-        t1 = float(tr.stats.starttime)
-        t2 = t1 + tr.stats.npts*tr.stats.sampling_rate
-        print(nt, t1, t2)
 
-        t = np.linspace(t1, t2, nt)
-        w = tr.data
+def ascii(d, path, filenames):
+    """ Writes SPECFEM3D-style ascii data
+    """
+    nt = d.nt
+    for ir, header in enumerate(d.headers):
+        t = header['starttime'] + header['delta']*np.arange(nt)
+        w = d.data[ir]
 
-        print(path +'/'+ tr.stats.filename)
-        print(t.shape, tr.data.shape)
-        np.savetxt(path +'/'+ tr.stats.filename,
+        np.savetxt(path +'/'+ header['filename'],
                    np.column_stack((t, w)))
 
 
-def ascii_2(stream, path, channel, dt):
-    for ir, tr in enumerate(stream):
-        nt = tr.stats.npts
-        t1 = float(tr.stats.starttime)
-        t2 = t1 + tr.stats.npts*dt
-        #print(nt, t1, t2)
+def ascii_2(d, path, channel, dt):
+    nt = d.nt
+    for ir in range(d.nrec):
+        # SU gathers carry no start time
+        t1 = 0.
+        t2 = t1 + nt*dt
 
         t = np.linspace(t1, t2, nt)
-        w = tr.data
+        w = d.data[ir]
 
         file_out = path +'/'+ channel + str(ir).zfill(4)
-        #print(file_out)
-        #print(t.shape, tr.data.shape)
-        np.savetxt(file_out, np.column_stack((t, w)))
\ No newline at end of file
+        np.savetxt(file_out, np.column_stack((t, w)))
+
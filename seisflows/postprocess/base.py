@@ -5,6 +5,7 @@ import time
 
 from os.path import join
 from seisflows.tools import unix
+from seisflows.tools.seismic import ModelDict
 from seisflows.tools.tools import exists
 from seisflows.config import ParameterError
 
@@ -35,6 +36,10 @@ class base(object):
         if 'PRECOND' not in PAR:
             setattr(PAR, 'PRECOND', False)
 
+        # maximum time in seconds to wait for kernels to be exported
+        if 'KERNEL_TIMEOUT' not in PAR:
+            setattr(PAR, 'KERNEL_TIMEOUT', 3600.)
+
         # check paths
         if 'MASK' not in PATH:
             setattr(PATH, 'MASK', None)
@@ -74,20 +79,20 @@ class base(object):
         #         path=path+'/kernels',
         #         parameters=solver.parameters)
 
-        g = solver.merge(solver.load(
+        g = solver.load(
                  path +'/'+ 'kernels/sum',
-                 suffix='_kernel'))
+                 suffix='_kernel')
 
         self.save(g, path)
 
         if PAR.KERNELTYPE=='Relative':
             # convert from relative to absolute perturbations
-            g *= solver.merge(solver.load(path +'/'+ 'model'))
+            g *= solver.load(path +'/'+ 'model')
             self.save(g, path, backup='relative')
 
         if PATH.MASK:
             # apply mask
-            g *= solver.merge(solver.load(PATH.MASK))
+            g *= solver.load(PATH.MASK)
             self.save(g, path, backup='nomask')
 
 
@@ -124,13 +129,14 @@ class base(object):
         if not exists(path):
             raise Exception
 
+        solver.wait_kernels(path, PAR.KERNEL_TIMEOUT)
+
         if PAR.SMOOTH > 0:
             solver.combine(
                    input_path=path,
                    output_path=path+'/'+'sum_nosmooth',
                    parameters=parameters)
 
-            #time.sleep(5)
             solver.smooth(
                    input_path=path+'/'+'sum_nosmooth',
                    output_path=path+'/'+'sum',
@@ -142,12 +148,12 @@ class base(object):
                    output_path=path+'/'+'sum',
                    parameters=parameters)
 
-        #time.sleep(5)
-
 
     def save(self, g, path='', parameters=[], backup=None):
         """ Convience function for saving dictionary representation of 
           gradient
+
+          G can be given either as a ModelDict or as a vector
         """
         if not exists(path):
             raise Exception
@@ -160,7 +166,10 @@ class base(object):
             dst = path +'/'+ 'gradient_'+backup
             unix.mv(src, dst)
 
-        solver.save(solver.split(g),
+        if not isinstance(g, ModelDict):
+            g = solver.split(g, parameters)
+
+        solver.save(g,
                     path +'/'+ 'gradient',
                     parameters=parameters,
                     suffix='_kernel')
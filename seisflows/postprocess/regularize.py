@@ -1,10 +1,12 @@
 
 import sys
 import numpy as np
+from hashlib import sha1
 
 from seisflows.tools import unix
 from seisflows.tools.array import loadnpy, savenpy
-from seisflows.tools.array import grid2mesh, mesh2grid, stack
+from seisflows.tools.array import gaussian_masks, get_interpolator, grid2mesh, \
+    mask_average, mesh2grid, stack
 from seisflows.tools.tools import exists
 from seisflows.config import  ParameterError, custom_import
 from seisflows.tools.math import nabla
@@ -59,22 +61,26 @@ class regularize(custom_import('postprocess', 'base')):
         #	mesh = self.getmesh(iproc)
         #        g[key][iproc] += PAR.LAMBDA *\
         #            self.nabla(mesh, m[key][iproc], g[key][iproc])
-	if (PAR.LAMBDA > 0): 
-	    # apply total variation each 'key' at a time
-	    for key in solver.parameters:
-        	g = solver.merge(solver.load(path +'/'+ 'kernels/sum', parameters=[key], suffix='_kernel'))
-        	m = solver.merge(solver.load(path +'/'+ 'model', parameters=[key]))
-        	mesh = self.getmesh_all()
-        	g += PAR.LAMBDA *\
-	    	    self.nabla(mesh, m, g)
+        if (PAR.LAMBDA > 0):
+            # reuse mesh-grid operators saved in earlier iterations
+            mesh = self.getmesh_all()
+            get_interpolator(mesh, PATH.SCRATCH+'/'+'interpolators')
 
-        	self.save(g, path, parameters=[key])
+            # apply total variation each 'key' at a time
+            for key in solver.parameters:
+                g = solver.merge(solver.load(path +'/'+ 'kernels/sum', parameters=[key], suffix='_kernel'))
+                m = solver.merge(solver.load(path +'/'+ 'model', parameters=[key]))
+                g += PAR.LAMBDA *\
+                    self.nabla(mesh, m, g)
+
+                self.save(g, path, parameters=[key])
 
 
     def process_kernels(self, path, parameters):
         """ Processes kernels in accordance with parameter settings
         """
         assert exists(path)
+        solver.wait_kernels(path, PAR.KERNEL_TIMEOUT)
 
         #system.run_single('solver', 'combine',
 	solver.combine(
@@ -90,62 +96,56 @@ class regularize(custom_import('postprocess', 'base')):
 
 
     def fix_near_field(self, path=''):
+        """ Replaces gradient near sources and receivers with its local
+          Gaussian-weighted average
+
+          Masks are applied one at a time, as before, but are evaluated only
+          within a few standard deviations of each source and receiver
         """
-        """
-        #import preprocess
-	preprocess = sys.modules['seisflows_preprocess']
-        preprocess.setup()
+        sigma = PAR.FIXRADIUS
 
+        sources, receivers = self.getcoords()
+        points = np.vstack((sources, receivers))
 
-        #x,z = self.getxz()
+        mesh = self.getmesh_all()
+        masks = gaussian_masks(mesh, points, sigma, tree=solver.geometry.tree)
 
-        #lx = x.max() - x.min()
-        #lz = z.max() - z.min()
-        #nn = x.size
-        #nx = np.around(np.sqrt(1.0*nn*lx/lz))
-        #nz = np.around(np.sqrt(1.0*nn*lz/lx))
-        #dx = 1.0*lx/nx
-        #dz = 1.0*lz/nz
+        for key in solver.parameters:
+            g = solver.merge(solver.load(path+'/'+'sum_nofix', parameters=[key], suffix='_kernel'))
+            g = mask_average(g, masks)
+            solver.save(solver.split(g), path+'/'+ 'sum', parameters=[key], suffix='_kernel')
 
-        #sigma = 0.5*PAR.FIXRADIUS*(dx+dz)
-        sigma = PAR.FIXRADIUS
 
-	sx = []
-	sy = []
-	sz = []
-	for source_name in solver.source_names:
-            ssx, ssy, ssz = preprocess.get_source_coords(
-                preprocess.reader(
-            	    PATH.SOLVER+'/'+source_name+'/'+'traces/obs', solver.data_filenames[0]))
-	    sx.append(ssx[0])
-	    sy.append(ssy[0])
-	    sz.append(ssz[0])
+    def getcoords(self):
+        """ Returns source and receiver coordinates, reading them from trace
+          headers the first time only
 
-        rx, ry, rz = preprocess.get_receiver_coords(
-            preprocess.reader(
-                PATH.SOLVER+'/'+solver.source_names[0]+'/'+'traces/obs', solver.data_filenames[0]))
+          Coordinates are stored in PATH.SCRATCH in a file named by a hash
+          of the source names, so that they are read again if the set of
+          sources changes
+        """
+        key = sha1(' '.join(solver.source_names)).hexdigest()
+        filename = PATH.SCRATCH +'/'+ 'geometry.%s.npz' % key
 
-        mesh = self.getmesh_all()
-	x = mesh[:,0]
-	z = mesh[:,1]
+        if not exists(filename):
+            preprocess.setup()
 
-        # mask sources & receivers
-	for key in solver.parameters:
-            g = solver.merge(solver.load(path+'/'+'sum_nofix', parameters=[key], suffix='_kernel'))
-	    for isrc in range(PAR.NSRC):
-                mask = np.exp(-0.5*((x-sx[isrc])**2.+(z-sy[isrc])**2.)/sigma**2.)
-            	weight = np.sum(mask*g)/np.sum(mask)
-            	g *= 1.-mask
-            	g += mask*weight
+            sources = []
+            for source_name in solver.source_names:
+                sx, sy, _ = preprocess.get_source_coords(
+                    preprocess.reader(
+                        PATH.SOLVER+'/'+source_name+'/'+'traces/obs', solver.data_filenames[0]))
+                sources += [(sx[0], sy[0])]
 
-	    for ir in range(PAR.NREC):
-                mask = np.exp(-0.5*((x-rx[ir])**2.+(z-ry[ir])**2.)/sigma**2.)
-            	weight = np.sum(mask*g)/np.sum(mask)
-            	g *= 1.-mask
-            	g += mask*weight
+            rx, ry, _ = preprocess.get_receiver_coords(
+                preprocess.reader(
+                    PATH.SOLVER+'/'+solver.source_names[0]+'/'+'traces/obs', solver.data_filenames[0]))
 
+            np.savez(filename, sources=np.array(sources),
+                receivers=stack(rx, ry))
 
-            solver.save(solver.split(g), path+'/'+ 'sum', parameters=[key], suffix='_kernel')
+        geometry = np.load(filename)
+        return geometry['sources'], geometry['receivers']
 
 
     def nabla(self, mesh, m, g):
@@ -153,47 +153,12 @@ class regularize(custom_import('postprocess', 'base')):
 
 
     def getmesh(self, iproc):
-        model_path = PATH.OUTPUT +'/'+ 'model_init'
-        solver = sys.modules['seisflows_solver']
-        try:
-            m = solver.load(model_path)
-            x = m['x'][iproc]
-            z = m['z'][iproc]
-            mesh = stack(x.flatten(), z.flatten())
-        except:
-            x = solver.io.read_slice(model_path, 'x', iproc)
-            z = solver.io.read_slice(model_path, 'z', iproc)
-            mesh = stack(x[0], z[0])
-        return mesh
+        return solver.geometry.slice(iproc)
 
     def getmesh_all(self):
-        model_path = PATH.OUTPUT +'/'+ 'model_init'
-        solver = sys.modules['seisflows_solver']
-        try:
-            m = solver.load(model_path)
-            x = m['x'][:]
-            z = m['z'][:]
-            mesh = stack(x.flatten(), z.flatten())
-        except:
-	    for iproc in range (PAR.NPROC):
-            	x += solver.io.read_slice(model_path, 'x', iproc)
-            	z += solver.io.read_slice(model_path, 'z', iproc)
-	    x = np.concatenate(x[:])
-	    z = np.concatenate(z[:])
-            mesh = stack(x, z)
-        return mesh
+        return solver.geometry.mesh
 
     def getxz(self, iproc):
-        model_path = PATH.OUTPUT +'/'+ 'model_init'
-        solver = sys.modules['seisflows_solver']
-        try:
-            m = solver.load(model_path)
-            x = m['x'][iproc]
-            z = m['z'][iproc]
-        except:
-            x = solver.io.read_slice(model_path, 'x', iproc)
-            z = solver.io.read_slice(model_path, 'z', iproc)
-        #return x, z
-        return np.array(x).flatten(), np.array(z).flatten()
-
+        mesh = solver.geometry.slice(iproc)
+        return mesh[:,0], mesh[:,-1]
 
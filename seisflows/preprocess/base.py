@@ -2,10 +2,14 @@
 import sys
 import os
 import numpy as np
-import obspy
 
-from seisflows.tools import msg, unix
-from seisflows.tools.tools import exists, getset
+from collections import OrderedDict
+from glob import glob
+from hashlib import sha1
+from multiprocessing import Pool
+
+from seisflows.tools import msg, residuals, unix
+from seisflows.tools.tools import exists, getset, nproc
 from seisflows.config import ParameterError
 
 from seisflows.plugins import adjoint, misfit, readers, writers
@@ -15,6 +19,10 @@ from seisflows.tools.seismic import write_source_specfem2d, write_stations_specf
 PAR = sys.modules['seisflows_parameters']
 PATH = sys.modules['seisflows_paths']
 
+# mute masks, keyed by a hash of acquisition geometry and mute parameters
+_mute_masks = OrderedDict()
+_MUTE_CACHE_SIZE = 8
+
 
 class base(object):
     """ Data preprocessing class
@@ -47,6 +55,20 @@ class base(object):
         if 'FILTER' not in PAR:
             setattr(PAR, 'FILTER', None)
 
+        # whether filters are applied forward and backward (zero phase) or
+        # forward only (causal)
+        if 'ZEROPHASE' not in PAR:
+            setattr(PAR, 'ZEROPHASE', False)
+
+        # whether processed observations are cached on disk
+        if 'CACHE_OBS' not in PAR:
+            setattr(PAR, 'CACHE_OBS', True)
+
+        # whether channels are processed in a pool of worker processes,
+        # sized by the cores left over by solver runs
+        if 'PREPROCESS_PARALLEL' not in PAR:
+            setattr(PAR, 'PREPROCESS_PARALLEL', False)
+
 
         # assertions
         if PAR.FORMAT not in dir(readers):
@@ -61,6 +83,9 @@ class base(object):
         self.check_mute()
         self.check_normalize()
 
+        if PAR.MISFIT == 'Dispersion':
+            self.check_dispersion()
+
 
     def setup(self):
         """ Sets up data preprocessing machinery
@@ -86,77 +111,212 @@ class base(object):
         """
         solver = sys.modules['seisflows_solver']
 
-        for filename in solver.data_filenames:
+        jobs = [(path, filename) for filename in solver.data_filenames]
+        self.map('prepare_channel', jobs, self.get_nworkers(len(jobs)))
+
+
+    def prepare_eval_grad_sources(self, paths, filenames=[]):
+        """ Prepares several solver directories for gradient evaluation, as
+          when preprocessing offline, dividing channels of all sources among
+          worker processes
+
+          INPUT
+            PATHS - directories containing observed and synthetic seismic data
+            FILENAMES - names of data files, by default those of the solver
+        """
+        if not filenames:
+            solver = sys.modules['seisflows_solver']
+            filenames = solver.data_filenames
+
+        jobs = [(path, filename) for path in paths for filename in filenames]
+        self.map('prepare_channel', jobs,
+            self.get_nworkers(len(jobs), concurrent=False))
+
+
+    def prepare_channel(self, path, filename):
+        """ Writes residuals and adjoint traces for a single channel
+
+          INPUT
+            PATH - directory containing observed and synthetic seismic data
+            FILENAME - name of data file
+        """
+        syn = self.reader(path+'/'+'traces/syn', filename)
+        syn, = self.process_traces(syn)
+
+        # observations are processed once and then read from cache
+        obs = self.load_processed_obs(path, filename, syn)
+
+        # intermediate results shared by misfit and adjoint computations
+        scratch = {}
+
+        if PAR.MISFIT:
+            self.write_residuals(path, syn, obs, scratch, channel=filename)
+
+        filename = filename.replace('_d.su', '.su')    # names of adjoint traces are without '_d'
+        self.write_adjoint_traces(path+'/'+'traces/adj', syn, obs, filename,
+            scratch)
+
+
+    def map(self, method, jobs, nworkers=1):
+        """ Calls METHOD once for each tuple of arguments in JOBS, in a pool
+          of NWORKERS processes if more than one
+        """
+        if nworkers <= 1:
+            for args in jobs:
+                getattr(self, method)(*args)
+            return
+
+        pool = Pool(nworkers)
+        try:
+            pool.map(_call, [(self, method, args) for args in jobs], 1)
+        finally:
+            pool.close()
+            pool.join()
+
+
+    def get_nworkers(self, njobs, concurrent=True):
+        """ Returns number of preprocessing worker processes
+
+          If CONCURRENT, up to NTASKMAX solver tasks are assumed to run at
+          the same time, and each task receives its own NPROC cores plus an
+          equal share of the cores not used by solver runs. Otherwise all
+          NPROCMAX cores are available.
+        """
+        if not PAR.PREPROCESS_PARALLEL:
+            return 1
+
+        nprocmax = PAR.NPROCMAX if 'NPROCMAX' in PAR else nproc()
+        nproc_task = PAR.NPROC if 'NPROC' in PAR else 1
+        ntaskmax = PAR.NTASKMAX if 'NTASKMAX' in PAR else 1
+
+        if concurrent:
+            budget = nproc_task + \
+                max(0, nprocmax - ntaskmax*nproc_task)//max(1, ntaskmax)
+        else:
+            budget = nprocmax
+
+        return max(1, min(budget, njobs))
+
+
+    def load_processed_obs(self, path, filename, syn):
+        """ Returns processed observations, reading them from cache if
+          processing parameters and observed data are unchanged since they
+          were last processed
+
+          Cached traces are stored as .npy arrays in PATH/traces/obs_processed,
+          with file names containing a hash of the processing parameters and
+          of the size and modification time of the observed data file. Since
+          only traces are stored, cached observations take their headers
+          from synthetics SYN, which share the same acquisition geometry.
+        """
+        if not PAR.CACHE_OBS:
             obs = self.reader(path+'/'+'traces/obs', filename)
-            syn = self.reader(path+'/'+'traces/syn', filename)
+            obs, = self.process_traces(obs)
+            return obs
 
-            # process observations
-            obs = self.apply_filter(obs)
-            obs = self.apply_mute(obs)
-            obs = self.apply_normalize(obs)
+        cache = path+'/'+'traces/obs_processed'
+        key = self.processing_hash(path+'/'+'traces/obs/'+filename)
+        cachefile = '%s/%s.%s.npy' % (cache, filename, key)
+
+        if exists(cachefile):
+            data = np.load(cachefile)
+            if data.shape == syn.data.shape:
+                return syn.copy(data=data)
+
+        obs = self.reader(path+'/'+'traces/obs', filename)
+        obs, = self.process_traces(obs)
+
+        # remove entries made with other parameters, then write atomically
+        unix.mkdir(cache)
+        for stale in glob('%s/%s.*.npy' % (cache, filename)):
+            os.remove(stale)
+        tmpfile = '%s/.%s.%d.npy' % (cache, filename, os.getpid())
+        np.save(tmpfile, obs.data)
+        os.rename(tmpfile, cachefile)
 
-            # process synthetics
-            syn = self.apply_filter(syn)
-            syn = self.apply_mute(syn)
-            syn = self.apply_normalize(syn)
+        return obs
 
-            if PAR.MISFIT:
-                self.write_residuals(path, syn, obs)
 
-            filename = filename.replace('_d.su', '.su')    # names of adjoint traces are without '_d'
-            self.write_adjoint_traces(path+'/'+'traces/adj', syn, obs, filename)
+    def processing_hash(self, filename):
+        """ Returns hash of the parameters that affect trace processing and
+          of the size and modification time of FILENAME
+        """
+        keys = ['FORMAT', 'NT', 'DT', 'ZEROPHASE']
+        prefixes = ('FILTER', 'FREQ', 'MUTE', 'NORMALIZE')
+        settings = [(key, PAR[key]) for key in PAR
+            if key in keys or key.startswith(prefixes)]
+
+        if exists(filename):
+            stat = os.stat(filename)
+            settings += [('FILE', stat.st_size, stat.st_mtime)]
 
+        return sha1(repr(settings)).hexdigest()[:16]
 
-    def write_residuals(self, path, syn, obs):
-        """ Computes residuals from observations and synthetics
+
+    def write_residuals(self, path, syn, obs, scratch=None, channel=''):
+        """ Computes residuals from observations and synthetics and appends
+          them to the binary residuals file in PATH
 
           INPUT
             PATH - location residuals will be written
-            SYN - obspy Stream object containing synthetic data
-            OBS - obspy Stream object containing observed data
+            SYN - Gather containing synthetic data
+            OBS - Gather containing observed data
+            SCRATCH - optional dictionary of intermediate results
+            CHANNEL - name under which residuals are stored
         """
-        nt, dt, _ = self.get_time_scheme(syn)
-        nn, _ = self.get_network_size(syn)
+        rsd = self.get_residuals(syn, obs, scratch)
+        residuals.append(path+'/'+'residuals', rsd, channel)
 
-        residuals = []
-        for ii in range(nn):
-            residuals.append(self.misfit(syn[ii].data, obs[ii].data, nt, dt))
 
-        filename = path+'/'+'residuals'
-        if exists(filename):
-            residuals.extend(list(np.loadtxt(filename)))
+    def get_residuals(self, syn, obs, scratch=None):
+        """ Returns residuals of synthetic gather SYN with respect to observed
+          gather OBS, passing the gather's acquisition geometry to
+          gather-level misfit functions
+        """
+        nt, dt, _ = self.get_time_scheme(syn)
+        return self.misfit(syn.data, obs.data, nt, dt, scratch=scratch,
+            **self.get_gather_options(self.misfit, syn))
+
 
-        np.savetxt(filename, residuals)
+    def get_adjoint_traces(self, syn, obs, scratch=None):
+        """ Returns adjoint traces of synthetic gather SYN with respect to
+          observed gather OBS, passing the gather's acquisition geometry to
+          gather-level adjoint trace generators
+        """
+        nt, dt, _ = self.get_time_scheme(syn)
+        return self.adjoint(syn.data, obs.data, nt, dt, scratch=scratch,
+            **self.get_gather_options(self.adjoint, syn))
 
 
     def sum_residuals(self, files):
         """ Sums squares of residuals
 
+          Only the record headers of each file are read, which hold the sum
+          of squares of the residuals that follow them
+
           INPUT
             FILES - files containing residuals
         """
         total_misfit = 0.
         for file in files:
-            total_misfit += np.sum(np.loadtxt(file)**2.)
+            total_misfit += residuals.sum_squares(file)
         return total_misfit
         
 
-    def write_adjoint_traces(self, path, syn, obs, channel):
+    def write_adjoint_traces(self, path, syn, obs, channel, scratch=None):
         """ Writes "adjoint traces" required for gradient computation
          (overwrites synthetic data in the process)
 
           INPUT
             PATH - location "adjoint traces" will be written
-            SYN - obspy Stream object containing synthetic data
-            OBS - obspy Stream object containing observed data
+            SYN - Gather containing synthetic data
+            OBS - Gather containing observed data
             CHANNEL - channel or component code used by writer
+            SCRATCH - optional dictionary of intermediate results, as filled
+              by write_residuals
         """
-        nt, dt, _ = self.get_time_scheme(syn)
-        nn, _ = self.get_network_size(syn)
-
         adj = syn
-        for ii in range(nn):
-            adj[ii].data = self.adjoint(syn[ii].data, obs[ii].data, nt, dt)
+        adj.data = self.get_adjoint_traces(syn, obs, scratch)
 
         self.writer(adj, path, channel)
 
@@ -165,7 +325,7 @@ class base(object):
         """ Writes observed traces as source for time reversed simulation
           INPUT
             PATH - location time reversed observed traces will be written
-            OBS - obspy Stream object containing "time reversed" observed data
+            OBS - Gather containing "time reversed" observed data
             CHANNEL - channel or component code used by writer
         """
         nt, dt, _ = self.get_time_scheme(obs)
@@ -184,125 +344,169 @@ class base(object):
 
     ### signal processing
 
+    def process_traces(self, *gathers):
+        """ Filters, mutes and normalizes gathers recorded with the same
+          acquisition geometry, such as observations and synthetics from the
+          same source
+
+          Traces of all gathers are filtered as rows of one array, and a
+          single mute mask is applied to all of them
+        """
+        shape = gathers[0].data.shape
+        for gather in gathers:
+            assert gather.data.shape == shape
+
+        data = np.concatenate([gather.data for gather in gathers])
+        data = self.filter_traces(data)
+        data = data.reshape((len(gathers),) + shape)
+
+        if PAR.MUTE:
+            data *= self.get_mute_mask(gathers[0])
+
+        processed = []
+        for gather, d in zip(gathers, data):
+            processed += [self.apply_normalize(gather.copy(data=d))]
+        return processed
+
+
     def apply_filter(self, traces):
+        traces.data = self.filter_traces(traces.data)
+        return traces
+
+
+    def filter_traces(self, data):
+        """ Filters rows of an (nrec, nt) array of traces
+        """
         if not PAR.FILTER:
-            return traces
+            return data
+
+        _, dt, _ = self.get_time_scheme(data)
 
-        elif PAR.FILTER == 'Bandpass':
-            for tr in traces:
-                tr.detrend('demean')
-                tr.detrend('linear')
-                tr.taper(0.05, type='hann')
-                tr.filter('bandpass', freqmin=PAR.FREQMIN, freqmax=PAR.FREQMAX)
+        # demean, detrend and taper
+        data = signal.detrend(np.asarray(data, dtype='float64'))
+        data = signal.taper(data, 0.05)
+
+        if PAR.FILTER == 'Bandpass':
+            return signal.bandpass(data, PAR.FREQMIN, PAR.FREQMAX, dt,
+                zerophase=PAR.ZEROPHASE)
 
         elif PAR.FILTER == 'Lowpass':
-            for tr in traces:
-                tr.detrend('demean')
-                tr.detrend('linear')
-                tr.taper(0.05, type='hann')
-                tr.filter('lowpass', freq=PAR.FREQ)
+            return signal.lowpass(data, PAR.FREQ, dt,
+                zerophase=PAR.ZEROPHASE)
 
         elif PAR.FILTER == 'Highpass':
-            for tr in traces:
-                tr.detrend('demean')
-                tr.detrend('linear')
-                tr.taper(0.05, type='hann')
-                tr.filter('highpass', freq=PAR.FREQ)
+            return signal.highpass(data, PAR.FREQ, dt,
+                zerophase=PAR.ZEROPHASE)
 
         else:
             raise ParameterError()
 
-        return traces
-
 
     def apply_mute(self, traces):
         if not PAR.MUTE:
             return traces
 
+        traces.data = traces.data * self.get_mute_mask(traces)
+        return traces
+
+
+    def get_mute_mask(self, traces):
+        """ Returns (nrec, nt) array by which traces are multiplied to apply
+          all mutes
+
+          Masks depend only on acquisition geometry and mute parameters, so
+          they are cached and shared by observations, synthetics, channels
+          and, within one process, iterations. The returned array is read-only.
+        """
+        nt, dt, t0 = self.get_time_scheme(traces)
+        nr, _ = self.get_network_size(traces)
+
+        s_coords = self.get_source_coords(traces)
+        r_coords = self.get_receiver_coords(traces)
+
+        key = sha1()
+        for coords in s_coords[:2] + r_coords[:2]:
+            key.update(np.ascontiguousarray(coords, dtype='float64'))
+        key.update(repr([(nt, dt, t0)] +
+            [(name, PAR[name]) for name in PAR if name.startswith('MUTE')]))
+        key = key.hexdigest()
+
+        if key in _mute_masks:
+            # move to end as most recently used
+            _mute_masks[key] = _mute_masks.pop(key)
+            return _mute_masks[key]
+
+        # source-receiver distances, computed once for all mutes
+        offsets = signal.offsets(s_coords, r_coords)
+        mask = np.ones((nr, nt))
+
         if 'MuteEarlyArrivals' in PAR.MUTE:
-            traces = signal.mute_early_arrivals(traces,
+            mask *= signal.mask(
                 PAR.MUTE_EARLY_ARRIVALS_SLOPE, # (units: time/distance)
                 PAR.MUTE_EARLY_ARRIVALS_CONST, # (units: time)
-                self.get_time_scheme(traces),
-                self.get_source_coords(traces),
-                self.get_receiver_coords(traces))
+                offsets,
+                (nt, dt, t0))
 
         if 'MuteLateArrivals' in PAR.MUTE:
-            traces = signal.mute_late_arrivals(traces,
+            mask *= 1.-signal.mask(
                 PAR.MUTE_LATE_ARRIVALS_SLOPE, # (units: time/distance)
                 PAR.MUTE_LATE_ARRIVALS_CONST, # (units: time)
-                self.get_time_scheme(traces),
-                self.get_source_coords(traces),
-                self.get_receiver_coords(traces))
+                offsets,
+                (nt, dt, t0))
 
         if 'MuteShortOffsets' in PAR.MUTE:
-            traces = signal.mute_short_offsets(traces,
-                PAR.MUTE_SHORT_OFFSETS_DIST,
-                self.get_source_coords(traces),
-                self.get_receiver_coords(traces))
+            mask[offsets < PAR.MUTE_SHORT_OFFSETS_DIST] = 0.
 
         if 'MuteLongOffsets' in PAR.MUTE:
-            traces = signal.mute_long_offsets(traces,
-                PAR.MUTE_LONG_OFFSETS_DIST,
-                self.get_source_coords(traces),
-                self.get_receiver_coords(traces))
+            mask[offsets > PAR.MUTE_LONG_OFFSETS_DIST] = 0.
 
-        return traces
+        mask.flags.writeable = False
+
+        # keep only the most recently used masks
+        while len(_mute_masks) >= _MUTE_CACHE_SIZE:
+            _mute_masks.popitem(last=False)
+        _mute_masks[key] = mask
+
+        return mask
 
 
     def apply_normalize(self, traces):
         if not PAR.NORMALIZE:
             return traces
 
+        data = np.asarray(traces.data, dtype='float64')
+
         if 'NormalizeEventsL1' in PAR.NORMALIZE:
             # normalize event by L1 norm of all traces
-            w = 0.
-            for tr in traces:
-                w += np.linalg.norm(tr.data, ord=1)
-            for tr in traces:
-                tr.data /= w
+            data = data / np.sum(np.linalg.norm(data, ord=1, axis=1))
 
         elif 'NormalizeEventsL2' in PAR.NORMALIZE:
             # normalize event by L2 norm of all traces
-            w = 0.
-            for tr in traces:
-                w += np.linalg.norm(tr.data, ord=2)
-            for tr in traces:
-                tr.data /= w
+            data = data / np.sum(np.linalg.norm(data, ord=2, axis=1))
 
         if 'NormalizeTracesL1' in PAR.NORMALIZE:
             # normalize each trace by its L1 norm
-            for tr in traces:
-                w = np.linalg.norm(tr.data, ord=1)
-                if w > 0:
-                    tr.data /= w
+            w = np.linalg.norm(data, ord=1, axis=1)
+            data[w > 0] /= w[w > 0, np.newaxis]
 
         elif 'NormalizeTracesL2' in PAR.NORMALIZE:
             # normalize each trace by its L2 norm
-            for tr in traces:
-                w = np.linalg.norm(tr.data, ord=2)
-                if w > 0:
-                    tr.data /= w
+            w = np.linalg.norm(data, ord=2, axis=1)
+            data[w > 0] /= w[w > 0, np.newaxis]
 
+        traces.data = data
         return traces
 
 
     def apply_filter_backwards(self, traces):
-        for tr in traces:
-            tr.data = np.flip(tr.data, 0)
-
+        traces = self.revert_time(traces)
         traces = self.apply_filter(traces)
-
-        for tr in traces:
-            tr.data = np.flip(tr.data, 0)
-
+        traces = self.revert_time(traces)
         return traces
 
 
     def revert_time(self, traces):
-        for tr in traces:
-            tr.data = np.flip(tr.data, 0)
-        
+        traces.data = np.ascontiguousarray(traces.data[:, ::-1])
         return traces
 
 
@@ -322,9 +526,7 @@ class base(object):
             obs = self.revert_time(obs)
 
             # process observations
-            obs = self.apply_filter(obs)
-            obs = self.apply_mute(obs)
-            obs = self.apply_normalize(obs)
+            obs, = self.process_traces(obs)
 
             self.write_obs_as_sources(path, path_out, obs, filename)
 
@@ -432,8 +634,55 @@ class base(object):
             'NormalizeEventsL2'])
 
 
+    def check_dispersion(self):
+        """ Checks dispersion misfit settings
+        """
+        # phase velocity range of dispersion images
+        if 'DISPERSION_CMIN' not in PAR:
+            raise ParameterError(PAR, 'DISPERSION_CMIN')
+
+        if 'DISPERSION_CMAX' not in PAR:
+            raise ParameterError(PAR, 'DISPERSION_CMAX')
+
+        # phase velocity increment
+        if 'DISPERSION_DC' not in PAR:
+            setattr(PAR, 'DISPERSION_DC',
+                (PAR.DISPERSION_CMAX - PAR.DISPERSION_CMIN)/100.)
+
+        # frequency range of dispersion images (default: up to Nyquist)
+        if 'DISPERSION_FMIN' not in PAR:
+            setattr(PAR, 'DISPERSION_FMIN', 0.)
+
+        if 'DISPERSION_FMAX' not in PAR:
+            setattr(PAR, 'DISPERSION_FMAX', None)
+
+        assert 0 < PAR.DISPERSION_CMIN < PAR.DISPERSION_CMAX
+        assert 0 < PAR.DISPERSION_DC
+
+
     ### utility functions
 
+    def get_gather_options(self, func, traces):
+        """ Returns keyword arguments describing the acquisition geometry
+          of TRACES, if FUNC is a gather-level misfit function or adjoint
+          trace generator, which measures whole gathers rather than single
+          traces
+        """
+        if not getattr(func, 'gather', False):
+            return {}
+
+        # receivers are located by their offsets from the source
+        offsets = signal.offsets(self.get_source_coords(traces),
+            self.get_receiver_coords(traces))
+
+        return {
+            'x': offsets,
+            'c': np.arange(PAR.DISPERSION_CMIN, PAR.DISPERSION_CMAX,
+                PAR.DISPERSION_DC),
+            'fmin': PAR.DISPERSION_FMIN,
+            'fmax': PAR.DISPERSION_FMAX}
+
+
     def get_time_scheme(self, traces):
         # FIXME: extract time scheme from trace headers rather than parameters file
         nt = PAR.NT
@@ -450,14 +699,7 @@ class base(object):
 
     def get_receiver_coords(self, traces):
         if PAR.FORMAT in ['SU', 'su']:
-            rx = []
-            ry = []
-            rz = []
-            for trace in traces:
-                rx += [trace.stats.su.trace_header.group_coordinate_x]
-                ry += [trace.stats.su.trace_header.group_coordinate_y]
-                rz += [0.]
-            return rx, ry, rz
+            return traces.receiver_coords()
 
         else:
              raise NotImplementedError
@@ -465,16 +707,14 @@ class base(object):
 
     def get_source_coords(self, traces):
         if PAR.FORMAT in ['SU', 'su']:
-            sx = []
-            sy = []
-            sz = []
-            for trace in traces:
-                sx += [trace.stats.su.trace_header.source_coordinate_x]
-                sy += [trace.stats.su.trace_header.source_coordinate_y]
-                sz += [0.]
-            return sx, sy, sz
+            return traces.source_coords()
 
         else:
              raise NotImplementedError
 
 
+def _call(args):
+    # process pool entry point, since bound methods cannot be pickled
+    obj, method, args = args
+    return getattr(obj, method)(*args)
+
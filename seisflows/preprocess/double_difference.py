@@ -3,10 +3,10 @@ import sys
 import numpy as np
 
 from os.path import exists
-from obspy.core import Stream, Trace
+from scipy.spatial import cKDTree
 
 from seisflows.plugins import adjoint, misfit
-from seisflows.tools import unix
+from seisflows.tools import residuals, signal, unix
 from seisflows.config import ParameterError, custom_import
 
 PAR = sys.modules['seisflows_parameters']
@@ -41,95 +41,73 @@ class double_difference(custom_import('preprocess', 'base')):
             'TraveltimeInexact']
 
 
-    def write_residuals(self, path, syn, dat):
+    def write_residuals(self, path, syn, dat, scratch=None, channel=''):
         """ Computes residuals from observations and synthetics
+
+          Only pairs of stations at most DISTMAX apart are measured. The pair
+          index and differential traveltimes are stored in SCRATCH, if
+          given, and in PATH/double_difference.npz for write_adjoint_traces
         """
         nt, dt, _ = self.get_time_scheme(syn)
         nr, _ = self.get_network_size(syn)
         rx, ry, rz = self.get_receiver_coords(syn)
 
-        # calculate distances between stations
-        dist = np.zeros((nr,nr))
-        count = np.zeros(nr)
-        for i in range(nr):
-            for j in range(i):
-                dist[i,j] = self.distance(rx[i], rx[j], ry[i], ry[j])
+        # find station pairs, with i > j for each pair
+        i, j, dist = self.get_pairs(rx, ry)
 
         # calculate traveltime differences between stations
-        delta_syn = np.zeros((nr,nr))
-        delta_obs = np.zeros((nr,nr))
-
-        for i in range(nr):
-            for j in range(i):
-                if dist[i,j] > PAR.DISTMAX: 
-                    continue
+        delta_syn = self.pair_misfit(syn.data, i, j, nt, dt)
+        delta_obs = self.pair_misfit(dat.data, i, j, nt, dt)
+        rsd_ij = delta_syn - delta_obs
 
-                delta_syn[i,j] = self.misfit(syn[i].data, syn[j].data, nt, dt)
-                delta_obs[i,j] = self.misfit(dat[i].data, dat[j].data, nt, dt)
-                delta_syn[j,i] = -delta_syn[i,j]
-                delta_obs[j,i] = -delta_obs[i,j]
-                count[i] += 1
+        np.savez(path +'/'+ 'double_difference.npz', i=i, j=j, dist=dist,
+            delta_syn=delta_syn, delta_obs=delta_obs, rsd=rsd_ij)
+        np.savetxt(path +'/'+ 'count', np.bincount(i, minlength=nr))
 
-
-        np.savetxt(path +'/'+ 'dist_ij', dist)
-        np.savetxt(path +'/'+ 'count', count)
-        np.savetxt(path +'/'+ 'delta_syn_ij', delta_syn)
-        np.savetxt(path +'/'+ 'delta_obs_ij', delta_obs)
-        np.savetxt(path +'/'+ 'rsd_ij', delta_syn-delta_obs)
+        if scratch is not None:
+            scratch['double_difference'] = (i, j, delta_syn, rsd_ij)
 
         # to get residuals, sum over all station pairs
-        rsd = abs(delta_syn-delta_obs).sum(axis=0)
+        rsd = np.zeros(nr)
+        np.add.at(rsd, i, abs(rsd_ij))
+        np.add.at(rsd, j, abs(rsd_ij))
 
         # apply optional weights
         if PATH.WEIGHTS:
             rsd *= self.load_weights()
 
-        # write residuals to text file
-        filename = path +'/'+ 'residuals'
-        if exists(filename):
-            rsdlist = list(np.loadtxt(filename))
-        else:
-            rsdlist = []
-        rsdlist += [rsd]
-        np.savetxt(filename, rsdlist)
-
-
-    def sum_residuals(self):
-        """ Sums squares of residuals
-        """
-        total_misfit = 0.
-        for path in paths:
-            total_misfit += np.sum(np.loadtxt(path)**2.)
-        return total_misfit
+        # append residuals to binary residuals file
+        residuals.append(path +'/'+ 'residuals', rsd, channel)
 
 
-    def write_adjoint_traces(self, path, syn, dat, channel):
+    def write_adjoint_traces(self, path, syn, dat, channel, scratch=None):
         """ Computes adjoint traces from observed and synthetic traces
         """
         nt, dt, _ = self.get_time_scheme(syn)
         nr, _ = self.get_network_size(syn)
 
-        Del = np.loadtxt(path +'/'+ '../../delta_syn_ij')
-        rsd = np.loadtxt(path +'/'+ '../../rsd_ij')
+        if scratch and 'double_difference' in scratch:
+            i, j, Del, rsd = scratch['double_difference']
+        else:
+            pairs = np.load(path +'/'+ '../../double_difference.npz')
+            i, j, Del, rsd = [pairs[key] for key in
+                ['i', 'j', 'delta_syn', 'rsd']]
 
         # initialize trace arrays
-        adj = Stream()
-        for i in range(nr):
-            adj.append(Trace(
-                data=np.zeros(nt, dtype='float32'),
-                header=syn[i].stats))
-
-        # generate adjoint traces
-        for i in range(nr):
-            for j in range(i):
-                si = syn[i].data
-                sj = syn[j].data
+        adj = syn.copy(data=np.zeros((nr, nt)))
 
-                adj[i].data += rsd[i,j] * \
-                               self.adjoint_dd(si, sj, +Del[i,j], nt, dt)
-                adj[j].data -= rsd[i,j] * \
-                               self.adjoint_dd(sj, si, -Del[i,j], nt, dt)
+        # generate adjoint traces, accumulating contributions of pairs in
+        # chunks to bound memory use
+        chunk = max(1, 2**22 // nt)
+        for k in range(0, len(i), chunk):
+            ik, jk, rk = i[k:k+chunk], j[k:k+chunk], rsd[k:k+chunk, np.newaxis]
+            si = syn.data[ik]
+            sj = syn.data[jk]
 
+            np.add.at(adj.data, ik,
+                rk * self.adjoint_dd(si, sj, +Del[k:k+chunk], nt, dt))
+            np.add.at(adj.data, jk,
+                -rk * self.adjoint_dd(sj, si, -Del[k:k+chunk], nt, dt))
 
         # optional weighting
         adj = self.apply_weights(adj)
@@ -139,33 +117,73 @@ class double_difference(custom_import('preprocess', 'base')):
 
 
     def adjoint_dd(self, si, sj, t0, nt, dt):
-        """ Returns contribution to adjoint source from a single double 
-         difference measurement
+        """ Returns contributions to adjoint sources from double difference
+         measurements, given (npair, nt) arrays of traces and per-pair
+         differential traveltimes T0
         """
-        vi = np.zeros(nt)
-        vj = np.zeros(nt)
-
-        vi[1:-1] = (si[2:] - si[0:-2])/(2.*dt)
-        vj[1:-1] = (sj[2:] - sj[0:-2])/(2.*dt)
+        vj = np.zeros(np.shape(sj))
+        vj[..., 1:-1] = (sj[..., 2:] - sj[..., 0:-2])/(2.*dt)
 
-        vjo = self.shift(vj, -t0/dt)
+        vjo = self.shift(vj, -np.rint(np.asarray(t0)/dt).astype(int))
 
-        w  = sum(vi*vjo*dt)
-        w = max(vjo)
-        if w:
-            vjo /= w
+        w = vjo.max(axis=-1)
+        w = np.where(w != 0., w, 1.)
+        vjo /= np.expand_dims(w, -1)
 
         return vjo
 
 
+    def pair_misfit(self, traces, i, j, nt, dt):
+        """ Returns misfit function evaluated on pairs of traces I, J
+        """
+        if PAR.MISFIT == 'Traveltime':
+            # Fourier transforms of traces are shared by all pairs
+            return signal.correlation_lags(traces, i, j, dt)
+
+        delta = np.empty(len(i))
+        chunk = max(1, 2**22 // nt)
+        for k in range(0, len(i), chunk):
+            delta[k:k+chunk] = self.misfit(traces[i[k:k+chunk]],
+                traces[j[k:k+chunk]], nt, dt)
+        return delta
+
+
+    def get_pairs(self, rx, ry):
+        """ Returns indices I > J and distances of all station pairs at most
+          DISTMAX apart
+        """
+        rx = np.asarray(rx, dtype=float)
+        ry = np.asarray(ry, dtype=float)
+
+        if PAR.UNITS in ['lonlat']:
+            # points on unit sphere, compared by chord length
+            lon, lat = np.radians(rx), np.radians(ry)
+            points = np.column_stack([np.cos(lat)*np.cos(lon),
+                np.cos(lat)*np.sin(lon), np.sin(lat)])
+            r = 2.*np.sin(np.radians(min(PAR.DISTMAX, 180.))/2.)
+        else:
+            points = np.column_stack([rx, ry])
+            r = PAR.DISTMAX
+
+        # tree search with slightly enlarged radius, then exact distances
+        tree = cKDTree(points)
+        pairs = tree.query_pairs(r*(1.+1.e-9), output_type='ndarray')
+        pairs = pairs.reshape(-1, 2)
+        j, i = pairs[:, 0], pairs[:, 1]
+
+        dist = self.distance(rx[i], ry[i], rx[j], ry[j])
+        keep = dist <= PAR.DISTMAX
+
+        return i[keep], j[keep], dist[keep]
+
+
     def apply_weights(self, traces):
         if not PATH.WEIGHTS:
             return traces
 
         else:
             w = self.load_weights()
-            for i,trace in enumerate(traces):
-                trace.data *= w[i]
+            traces.data = traces.data * w[:, np.newaxis]
             return traces
 
 
@@ -174,20 +192,19 @@ class double_difference(custom_import('preprocess', 'base')):
 
 
     def shift(self, v, it):
-        """ Shifts time series a given number of steps
+        """ Shifts time series a given number of steps, to the right if IT is
+          positive, padding with zeros
+
+          For (n, nt) arrays, IT may hold one shift per row
         """
-        if it == 0:
-            return v
-
-        nt = len(v)
-        vo = np.zeros(nt)
-        if it > 0:
-            # shift right
-            vo[it:] = v[:-it]
-        else:
-            # shift left
-            vo[:it] = v[-it:]
-        return vo
+        v = np.asarray(v)
+        nt = v.shape[-1]
+        idx = np.arange(nt) - np.expand_dims(it, -1)
+        valid = (0 <= idx) & (idx < nt)
+        idx = np.clip(idx, 0, nt-1)
+        if v.ndim == 1:
+            return np.where(valid, v[idx], 0.)
+        return np.where(valid, v[np.arange(len(v))[:, np.newaxis], idx], 0.)
 
 
     def distance(self, x1, y1, x2, y2):
@@ -2,17 +2,18 @@
 import subprocess
 import sys
 import numpy as np
-import time
 
 from functools import partial
 from glob import glob
 from importlib import import_module
-from os.path import basename, join
+from multiprocessing.pool import ThreadPool
+from os.path import abspath, basename, join
 from seisflows.config import ParameterError, custom_import
 from seisflows.plugins import solver_io
-from seisflows.tools import msg, unix
-from seisflows.tools.seismic import ModelDict, call_solver
-from seisflows.tools.tools import Struct, diff, exists
+from seisflows.tools import msg, su, unix
+from seisflows.tools.array import MeshGeometry
+from seisflows.tools.seismic import ModelDict, SliceArray, call_solver
+from seisflows.tools.tools import Struct, exists
 
 
 
@@ -97,6 +98,15 @@ class base(object):
         if 'SOLVERIO' not in PAR:
             setattr(PAR, 'SOLVERIO', 'fortran_binary')
 
+        # whether model slices are memory-mapped on read and, where possible,
+        # overwritten in place on write
+        if 'MMAP' not in PAR:
+            setattr(PAR, 'MMAP', False)
+
+        # number of threads used to read and write model slices
+        if 'NTHREADIO' not in PAR:
+            setattr(PAR, 'NTHREADIO', 4)
+
 
         # solver scratch paths
         if 'SCRATCH' not in PATH:
@@ -118,11 +128,26 @@ class base(object):
         if 'SPECFEM_DATA' not in PATH:
             raise ParameterError(PATH, 'SPECFEM_DATA')
 
+        # how files are transferred into and out of solver directories
+        # ('copy', 'reflink', 'hardlink' or 'symlink'), by type of file
+        if 'TRANSFER_BIN' not in PAR:
+            setattr(PAR, 'TRANSFER_BIN', 'reflink')
+
+        if 'TRANSFER_DATA' not in PAR:
+            setattr(PAR, 'TRANSFER_DATA', 'reflink')
+
+        if 'TRANSFER_MODEL' not in PAR:
+            setattr(PAR, 'TRANSFER_MODEL', 'reflink')
+
+        if 'TRANSFER_TRACES' not in PAR:
+            setattr(PAR, 'TRANSFER_TRACES', 'reflink')
+
         # assertions
         assert self.parameters != []
         assert hasattr(solver_io, PAR.SOLVERIO)
         assert hasattr(self.io, 'read_slice')
         assert hasattr(self.io, 'write_slice')
+        assert hasattr(self.io, 'exists_slice')
 
 
     def setup(self):
@@ -146,7 +171,7 @@ class base(object):
 
             src = glob(PATH.DATA +'/'+ self.source_name +'/'+ '*')
             dst = 'traces/obs/'
-            unix.cp(src, dst)
+            self.transfer(src, dst, 'traces')
 
         else:
             # generate data on the fly
@@ -291,17 +316,37 @@ class base(object):
               PREFIX - optional filename prefix
               SUFFIX - optional filename suffix, eg '_kernel'
         """
+        nproc = self.mesh_properties.nproc
+        ngll = self.mesh_properties.ngll
+
         dict = ModelDict()
-        for iproc in range(self.mesh_properties.nproc):
-            for key in parameters or self.parameters:
-                dict[key] += self.io.read_slice(
-                    path, prefix+key+suffix, iproc)
+        tasks = []
+        for key in parameters or self.parameters:
+            dict[key] = SliceArray(ngll)
+            for iproc in range(nproc):
+                tasks += [(key, iproc)]
+
+        def read(task):
+            key, iproc = task
+            return self.io.read_slice(
+                path, prefix+key+suffix, iproc, mmap=PAR.MMAP)[0]
+
+        # slices are read concurrently but copied into place one at a time
+        for (key, iproc), val in zip(tasks, self._imap(read, tasks)):
+            dict[key][iproc] = val
         return dict
 
 
     def save(self, dict, path, parameters=['vp','vs','rho'], prefix='', suffix=''):
         """ Writes SPECFEM model or kernels
 
+          Parameters missing from DICT are taken from PATH.MODEL_INIT, which
+          is read only once per solver instance
+
+          Models saved to the solver's own databases are written as Fortran
+          binary files, which is the only format SPECFEM reads, regardless
+          of PAR.SOLVERIO
+
           INPUT
               DICT - ModelDict object containing model
               PATH - the directory to which model is saved
@@ -312,45 +357,114 @@ class base(object):
         unix.mkdir(path)
 
         # fill in any missing parameters
-        missing_keys = diff(parameters, dict.keys())
-        for iproc in range(self.mesh_properties.nproc):
-            for key in missing_keys:
-                dict[key] += self.io.read_slice(
-                    PATH.MODEL_INIT, prefix+key+suffix, iproc)
+        missing_keys = [key for key in parameters if key not in dict]
+        model_init = self._load_model_init(missing_keys, prefix, suffix)
+
+        # SPECFEM reads models from its databases as Fortran binary files
+        # only, whatever format is used elsewhere
+        if abspath(path) == abspath(self.model_databases):
+            io = solver_io.fortran_binary
+        else:
+            io = self.io
+
+        tasks = []
+        for key in parameters:
+            for iproc in range(self.mesh_properties.nproc):
+                tasks += [(key, iproc)]
+
+        def write(task):
+            key, iproc = task
+            if key in missing_keys:
+                val = model_init[prefix+key+suffix][iproc]
+            else:
+                val = dict[key][iproc]
+            io.write_slice(
+                val, path, prefix+key+suffix, iproc, inplace=PAR.MMAP)
 
         # write slices to disk
-        for iproc in range(self.mesh_properties.nproc):
-            for key in parameters:
-                self.io.write_slice(
-                    dict[key][iproc], path, prefix+key+suffix, iproc)
+        for _ in self._imap(write, tasks):
+            pass
 
 
     def merge(self, model, parameters=[]):
         """ Converts model from dictionary to vector representation
         """
-        m = np.array([])
-        for key in parameters or self.parameters:
-            for iproc in range(self.mesh_properties.nproc):
-                m = np.append(m, model[key][iproc])
+        keys = parameters or self.parameters
+        nproc = self.mesh_properties.nproc
+        offsets = self.mesh_properties.offsets
+        ntot = offsets[-1]
+
+        # fill preallocated vector, one parameter at a time
+        m = np.empty(len(keys)*ntot)
+        for idim, key in enumerate(keys):
+            if isinstance(model[key], SliceArray):
+                m[ntot*idim:ntot*(idim+1)] = model[key].data
+                continue
+            for iproc in range(nproc):
+                imin = ntot*idim + offsets[iproc]
+                imax = ntot*idim + offsets[iproc+1]
+                m[imin:imax] = model[key][iproc]
         return m
 
 
     def split(self, m, parameters=[]):
         """ Converts model from vector to dictionary representation
+
+          Slices of the returned dictionary are views into M rather than copies
         """
-        nproc = self.mesh_properties.nproc
         ngll = self.mesh_properties.ngll
+        ntot = self.mesh_properties.offsets[-1]
         model = ModelDict()
         for idim, key in enumerate(parameters or self.parameters):
-            model[key] = []
-            for iproc in range(nproc):
-                imin = sum(ngll)*idim + sum(ngll[:iproc])
-                imax = sum(ngll)*idim + sum(ngll[:iproc+1])
-                model[key] += [m[imin:imax]]
+            model[key] = SliceArray(ngll, data=m[ntot*idim:ntot*(idim+1)])
         return model
 
 
 
+    def _load_model_init(self, parameters, prefix='', suffix=''):
+        """ Returns slices of initial model, reading from PATH.MODEL_INIT only
+          those parameters not already in memory
+        """
+        if not hasattr(self, '_model_init'):
+            self._model_init = {}
+
+        keys = [key for key in parameters
+                if prefix+key+suffix not in self._model_init]
+        if keys:
+            model = self.load(PATH.MODEL_INIT, keys, prefix, suffix)
+            for key in keys:
+                self._model_init[prefix+key+suffix] = model[key]
+        return self._model_init
+
+
+    def _imap(self, func, tasks):
+        """ Applies FUNC to each of TASKS using a pool of PAR.NTHREADIO threads,
+          yielding results in order
+        """
+        if PAR.NTHREADIO <= 1 or len(tasks) <= 1:
+            for task in tasks:
+                yield func(task)
+            return
+
+        pool = ThreadPool(min(PAR.NTHREADIO, len(tasks)))
+        try:
+            for result in pool.imap(func, tasks):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+    def __getstate__(self):
+        # cached model slices and coordinates are not worth pickling along
+        # with the solver
+        state = self.__dict__.copy()
+        state.pop('_model_init', None)
+        state.pop('_geometry', None)
+        return state
+
+
+
     ### postprocessing wrappers
 
     def combine(self, input_path='', output_path='', parameters=[]):
@@ -364,15 +478,9 @@ class base(object):
             unix.mkdir(output_path)
 
         unix.cd(self.cwd)
-        workflow = sys.modules['seisflows_workflow']
         with open('kernel_paths', 'w') as file:
-            if (workflow._mini_batch is None) | (PAR.NMINIBATCH == PAR.NTASK):
-                file.writelines([join(input_path, name+'\n')
-                    for name in self.source_names])
-            else:
-                self.source_names_mini_batch = [str(si).zfill(6) for si in workflow._mini_batch]
-                file.writelines([join(input_path, name+'\n')
-                    for name in self.source_names_mini_batch])
+            file.writelines([join(input_path, name+'\n')
+                for name in self.kernel_source_names()])
 
         for name in parameters or self.parameters:
             call_solver(
@@ -383,6 +491,25 @@ class base(object):
                 + output_path)
 
 
+    def wait_kernels(self, path, timeout=None):
+        """ Waits until kernels from all sources contributing to the current
+          gradient have been exported to PATH
+        """
+        unix.wait_complete([join(path, name)
+            for name in self.kernel_source_names()], timeout)
+
+
+    def kernel_source_names(self):
+        """ Returns names of sources contributing to the current gradient
+        """
+        workflow = sys.modules['seisflows_workflow']
+        if (workflow._mini_batch is None) | (PAR.NMINIBATCH == PAR.NTASK):
+            return self.source_names
+        else:
+            self.source_names_mini_batch = [str(si).zfill(6) for si in workflow._mini_batch]
+            return self.source_names_mini_batch
+
+
     def smooth(self, input_path='', output_path='', parameters=[], span=0.):
         """ Smooths kernels by convolving them with a Gaussian.  Wrapper over 
             xsmooth_sem utility.
@@ -423,14 +550,14 @@ class base(object):
     def import_traces(self, path):
         src = glob(join(path, 'traces', self.source_name, '*'))
         dst = join(self.cwd, 'traces/obs')
-        unix.cp(src, dst)
+        self.transfer(src, dst, 'traces')
 
     def export_model(self, path, parameters=['rho', 'vp', 'vs']):
         if self.taskid == 0:
             unix.mkdir(path)
             for key in parameters:
                 files = glob(join(self.model_databases, '*'+key+'.bin'))
-                unix.cp(files, path)
+                self.transfer(files, path, 'model', export=True)
 
     def export_kernels(self, path):
         unix.cd(self.kernel_databases)
@@ -442,7 +569,9 @@ class base(object):
         dst = join(path, 'kernels', self.source_name)
         unix.mkdir(dst)
         unix.mv(src, dst)
-        time.sleep(15.0)
+
+        # signal that kernels can be combined
+        unix.mark_complete(dst, src)
 
     def export_residuals(self, path):
         unix.mkdir(join(path, 'residuals'))
@@ -456,8 +585,20 @@ class base(object):
 
         src = join(self.cwd, prefix)
         dst = join(path, self.source_name)
-        unix.cp(src, dst)
-        #time.sleep(2.0)
+        self.transfer(src, dst, 'traces', export=True)
+
+
+    def transfer(self, src, dst, filetype, export=False):
+        """ Copies or links files using the method selected for the given
+          type of file ('bin', 'data', 'model' or 'traces')
+
+          Exported files must outlive the solver directories, so they are
+          hard linked rather than symlinked
+        """
+        method = PAR['TRANSFER_'+filetype.upper()]
+        if export and method == 'symlink':
+            method = 'hardlink'
+        unix.transfer(src, dst, method)
 
 
     def rename_kernels(self):
@@ -510,16 +651,16 @@ class base(object):
         # copy exectuables
         src = glob(PATH.SPECFEM_BIN +'/'+ '*')
         dst = 'bin/'
-        unix.cp(src, dst)
+        self.transfer(src, dst, 'bin')
 
         # copy input files
         src = glob(PATH.SPECFEM_DATA +'/'+ '*')
         dst = 'DATA/'
-        unix.cp(src, dst)
+        self.transfer(src, dst, 'data')
 
         src = 'DATA/' + self.source_prefix +'_'+ self.source_name
         dst = 'DATA/' + self.source_prefix
-        unix.cp(src, dst)
+        self.transfer(src, dst, 'data')
 
         self.check_solver_parameter_files()
 
@@ -528,14 +669,22 @@ class base(object):
         """ Puts in place "adjoint traces" expected by SPECFEM
         """
         for filename in self.data_filenames:
+            if PAR.FORMAT in ['SU', 'su']:
+                # only headers are needed, so traces need not be read
+                d = su.read(self.cwd +'/'+ 'traces/obs/'+ filename, mmap=True)
+                d = d.copy(data=np.zeros(d.data.shape, dtype='float32'))
+
+                filename = filename.replace('_d.su', '.su')
+                su.write(d, self.cwd +'/'+ 'traces/adj/'+ filename)
+                continue
+
             # read traces
             d = preprocess.reader(self.cwd +'/'+ 'traces/obs', filename)
 
             # Adjoint traces are initialized by writing zeros for all channels.
             # Channels actually in use during an inversion or migration will be
             # overwritten with nonzero values later on.
-            for t in d:
-                t.data[:] = 0.
+            d.data[:] = 0.
 
             # write traces
             filename = filename.replace('_d.su', '.su')    # names of adjoint traces are without '_d'
@@ -553,10 +702,10 @@ class base(object):
         iproc = 0
         ngll = []
         while True:
-            dummy = self.io.read_slice(path, key, iproc)[0]
+            dummy = self.io.read_slice(path, key, iproc, mmap=True)[0]
             ngll += [len(dummy)]
             iproc += 1
-            if not exists('%s/proc%06d_%s.bin' % (path, iproc, key)):
+            if not self.io.exists_slice(path, key, iproc):
                 break
         nproc = iproc
 
@@ -568,10 +717,28 @@ class base(object):
         self._mesh_properties = Struct([
             ['nproc', nproc],
             ['ngll', ngll],
+            ['offsets', np.cumsum([0]+ngll)],
             ['path', path],
             ['coords', coords]])
 
 
+    def check_geometry(self):
+        """ Reads mesh coordinates from PATH.MODEL_INIT through memory maps,
+          once per solver instance
+        """
+        path = self.mesh_properties.path
+        nproc = self.mesh_properties.nproc
+
+        coords = []
+        for key in ['x', 'y', 'z']:
+            if self.io.exists_slice(path, key, 0):
+                coords += [np.concatenate([
+                    self.io.read_slice(path, key, iproc, mmap=True)[0]
+                    for iproc in range(nproc)])]
+
+        self._geometry = MeshGeometry(coords, self.mesh_properties.offsets)
+
+
     def check_source_names(self):
         """ Determines names of sources by applying wildcard rule to user-
           supplied input files
@@ -627,6 +794,12 @@ class base(object):
             self.check_mesh_properties()
         return self._mesh_properties
 
+    @property
+    def geometry(self):
+        if not hasattr(self, '_geometry'):
+            self.check_geometry()
+        return self._geometry
+
     @property
     def data_filenames(self):
         # required method, must be implemented by subclass
@@ -6,7 +6,7 @@ from glob import glob
 import numpy as np
 
 from seisflows.plugins.solver.specfem2d import smooth_legacy
-from seisflows.tools.seismic import getpar, setpar
+from seisflows.tools.seismic import Parfile, getpar, setpar
 
 from seisflows.tools import msg
 from seisflows.tools import unix
@@ -57,17 +57,18 @@ class specfem2d(custom_import('solver', 'base')):
     def check_solver_parameter_files(self):
         """ Checks solver parameters
         """
-        nt = getpar('nt', cast=int)
-        dt = getpar('deltat', cast=float)
+        parfile = Parfile()
+        nt = parfile.get('nt', cast=int)
+        dt = parfile.get('deltat', cast=float)
         f0 = getpar('f0', file='DATA/SOURCE', cast=float)
 
         if nt != PAR.NT:
             if self.taskid == 0: print "WARNING: nt != PAR.NT"
-            setpar('nt', PAR.NT)
+            parfile['nt'] = PAR.NT
 
         if dt != PAR.DT:
             if self.taskid == 0: print "WARNING: dt != PAR.DT"
-            setpar('deltat', PAR.DT)
+            parfile['deltat'] = PAR.DT
 
         if f0 != PAR.F0:
             if self.taskid == 0: print "WARNING: f0 != PAR.F0"
@@ -79,9 +80,11 @@ class specfem2d(custom_import('solver', 'base')):
 
         if 'MULTIPLES' in PAR:
             if PAR.MULTIPLES:
-                setpar('absorbtop', '.false.')
+                parfile['absorbtop'] = '.false.'
             else:
-                setpar('absorbtop', '.true.')
+                parfile['absorbtop'] = '.true.'
+
+        parfile.write()
 
 
     def generate_data(self, **model_kwargs):
@@ -90,8 +93,9 @@ class specfem2d(custom_import('solver', 'base')):
         self.generate_mesh(**model_kwargs)
 
         unix.cd(self.cwd)
-        setpar('SIMULATION_TYPE', '1')
-        setpar('SAVE_FORWARD', '.false.')
+        with Parfile() as parfile:
+            parfile['SIMULATION_TYPE'] = 1
+            parfile['SAVE_FORWARD'] = '.false.'
 
         call_solver(system.mpiexec(), 'bin/xmeshfem2D')
         call_solver(system.mpiexec(), 'bin/xspecfem2D')
@@ -139,7 +143,7 @@ class specfem2d(custom_import('solver', 'base')):
 
         src = glob(join(model_path, '*'))
         dst = join(self.cwd, 'DATA')
-        unix.cp(src, dst)
+        self.transfer(src, dst, 'model')
 
         if self.taskid == 0:
             self.export_model(PATH.OUTPUT +'/'+ model_name)
@@ -150,8 +154,9 @@ class specfem2d(custom_import('solver', 'base')):
     def forward(self, path='traces/syn'):
         """ Calls SPECFEM2D forward solver
         """
-        setpar('SIMULATION_TYPE', '1')
-        setpar('SAVE_FORWARD', '.true.')
+        with Parfile() as parfile:
+            parfile['SIMULATION_TYPE'] = 1
+            parfile['SAVE_FORWARD'] = '.true.'
 
         call_solver(system.mpiexec(), 'bin/xmeshfem2D')
         call_solver(system.mpiexec(), 'bin/xspecfem2D')
@@ -164,8 +169,9 @@ class specfem2d(custom_import('solver', 'base')):
     def adjoint(self):
         """ Calls SPECFEM2D adjoint solver
         """
-        setpar('SIMULATION_TYPE', '3')
-        setpar('SAVE_FORWARD', '.false.')
+        with Parfile() as parfile:
+            parfile['SIMULATION_TYPE'] = 3
+            parfile['SAVE_FORWARD'] = '.false.'
         unix.rm('SEM')
         unix.ln('traces/adj', 'SEM')
 
@@ -184,13 +190,13 @@ class specfem2d(custom_import('solver', 'base')):
     def import_model(self, path):
         src = glob(path +'/'+ 'model/*')
         dst = join(self.cwd, 'DATA/')
-        unix.cp(src, dst)
+        self.transfer(src, dst, 'model')
 
     def export_model(self, path):
         unix.mkdir(path)
         src = glob(join(self.cwd, 'DATA/*.bin'))
         dst = path
-        unix.cp(src, dst)
+        self.transfer(src, dst, 'model', export=True)
 
 
     @property
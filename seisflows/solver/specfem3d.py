@@ -7,7 +7,7 @@ import sys
 import numpy as np
 
 import seisflows.plugins.solver.specfem3d as solvertools
-from seisflows.tools.seismic import getpar, setpar
+from seisflows.tools.seismic import Parfile, getpar, setpar
 
 from seisflows.tools import unix
 from seisflows.tools.seismic import call_solver
@@ -56,8 +56,9 @@ class specfem3d(custom_import('solver', 'base')):
         self.generate_mesh(**model_kwargs)
 
         unix.cd(self.cwd)
-        setpar('SIMULATION_TYPE', '1')
-        setpar('SAVE_FORWARD', '.true.')
+        with Parfile() as parfile:
+            parfile['SIMULATION_TYPE'] = 1
+            parfile['SAVE_FORWARD'] = '.true.'
         call_solver(system.mpiexec(), 'bin/xspecfem3D')
 
         if PAR.FORMAT in ['SU', 'su']:
@@ -90,7 +91,7 @@ class specfem3d(custom_import('solver', 'base')):
 
             src = glob(model_path +'/'+ '*')
             dst = self.model_databases
-            unix.cp(src, dst)
+            self.transfer(src, dst, 'model')
 
             call_solver(system.mpiexec(), 'bin/xmeshfem3D')
             call_solver(system.mpiexec(), 'bin/xgenerate_databases')
@@ -114,8 +115,9 @@ class specfem3d(custom_import('solver', 'base')):
     def forward(self, path='traces/syn'):
         """ Calls SPECFEM3D forward solver
         """
-        setpar('SIMULATION_TYPE', '1')
-        setpar('SAVE_FORWARD', '.true.')
+        with Parfile() as parfile:
+            parfile['SIMULATION_TYPE'] = 1
+            parfile['SAVE_FORWARD'] = '.true.'
         call_solver(system.mpiexec(), 'bin/xgenerate_databases')
         call_solver(system.mpiexec(), 'bin/xspecfem3D')
 
@@ -128,8 +130,9 @@ class specfem3d(custom_import('solver', 'base')):
     def adjoint(self):
         """ Calls SPECFEM3D adjoint solver
         """
-        setpar('SIMULATION_TYPE', '3')
-        setpar('SAVE_FORWARD', '.false.')
+        with Parfile() as parfile:
+            parfile['SIMULATION_TYPE'] = 3
+            parfile['SAVE_FORWARD'] = '.false.'
         unix.rm('SEM')
         unix.ln('traces/adj', 'SEM')
         call_solver(system.mpiexec(), 'bin/xspecfem3D')
@@ -140,16 +143,17 @@ class specfem3d(custom_import('solver', 'base')):
     def check_solver_parameter_files(self):
         """ Checks solver parameters
         """
-        nt = getpar('NSTEP', cast=int)
-        dt = getpar('DT', cast=float)
+        parfile = Parfile()
+        nt = parfile.get('NSTEP', cast=int)
+        dt = parfile.get('DT', cast=float)
 
         if nt != PAR.NT:
             if self.taskid == 0: print "WARNING: nt != PAR.NT"
-            setpar('NSTEP', PAR.NT)
+            parfile['NSTEP'] = PAR.NT
 
         if dt != PAR.DT:
             if self.taskid == 0: print "WARNING: dt != PAR.DT"
-            setpar('DT', PAR.DT)
+            parfile['DT'] = PAR.DT
 
         if self.mesh_properties.nproc != PAR.NPROC:
             if self.taskid == 0:
@@ -158,6 +162,8 @@ class specfem3d(custom_import('solver', 'base')):
         if 'MULTIPLES' in PAR:
             raise NotImplementedError
 
+        parfile.write()
+
 
     def initialize_adjoint_traces(self):
         super(specfem3d, self).initialize_adjoint_traces()
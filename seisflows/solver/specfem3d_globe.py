@@ -191,7 +191,8 @@ class specfem3d_globe(custom_import('solver', 'base')):
 
             self._mesh_properties = Struct([
                 ['nproc', nproc],
-                ['ngll', ngll]])
+                ['ngll', ngll],
+                ['offsets', np.cumsum([0]+ngll)]])
 
         return self._mesh_properties
 
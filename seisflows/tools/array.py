@@ -1,10 +1,17 @@
 import os
+from collections import OrderedDict
+from glob import glob
+from hashlib import sha1
 
 import numpy as np
-import scipy.signal as _signal
+import scipy.ndimage as _ndimage
 import scipy.interpolate as _interp
+import scipy.sparse as _sparse
+from scipy.spatial import cKDTree, Delaunay
 
-from seisflows.tools.math import gauss2
+
+_interpolators = OrderedDict()
+_INTERPOLATOR_CACHE_SIZE = 4
 
 
 def count_zeros(a):
@@ -85,22 +92,31 @@ def savenpy(filename, v):
 
 
 def gridsmooth(Z, span):
-    """ Smooths values on 2D rectangular grid
-    """
-    import warnings
-    warnings.filterwarnings('ignore')
-
-    x = np.linspace(-2.*span, 2.*span, 2.*span + 1.)
-    y = np.linspace(-2.*span, 2.*span, 2.*span + 1.)
-    (X, Y) = np.meshgrid(x, y)
-    mu = np.array([0., 0.])
-    sigma = np.diag([span, span])**2.
-    F = gauss2(X, Y, mu, sigma)
-    F = F/np.sum(F)
-    W = np.ones(Z.shape)
-    Z = _signal.convolve2d(Z, F, 'same')
-    W = _signal.convolve2d(W, F, 'same')
-    Z = Z/W
+    """ Smooths values on 2D or 3D rectangular grid
+
+      SPAN is the width of the Gaussian smoothing window in grid cells,
+      either for all axes or as a sequence with one entry per axis of Z,
+      e.g. (vertical, horizontal) for smoothing anisotropically
+    """
+    Z, W = gaussian_filter(np.array([Z, np.ones(Z.shape)]), span)
+    return Z/W
+
+
+def gaussian_filter(Z, span):
+    """ Convolves each of the grids stacked along the first axis of Z with a
+      separable Gaussian window
+
+      The window extends SPAN cells either side of its centre, with standard
+      deviation SPAN/2 cells; grids are padded with zeros. Axes with spans
+      below one cell are not smoothed.
+    """
+    spans = np.broadcast_to(np.asarray(span, dtype='float64'), Z.ndim-1)
+    for axis, span in enumerate(spans):
+        n = int(span)
+        if n < 1:
+            continue
+        f = np.exp(-2.*np.arange(-n, n+1)**2/span**2)
+        Z = _ndimage.convolve1d(Z, f/f.sum(), axis=axis+1, mode='constant')
     return Z
 
 
@@ -128,9 +144,10 @@ def meshsmooth(v, mesh, span):
         V[inan] = 0.
         W[inan] = 0.
 
-    # apply smoother
-    V = gridsmooth(V, span)
-    W = gridsmooth(W, span)
+    # apply smoother; spans are given in mesh coordinate order (x, z),
+    # whereas grid axes are ordered (z, x)
+    V, W = gaussian_filter(np.array([V, W]),
+        np.broadcast_to(span, mesh.shape[1])[::-1])
     V = V/W
 
     if np.any(inan):
@@ -145,43 +162,285 @@ def meshsmooth(v, mesh, span):
 
     return vss
 
-def mesh2grid(v, mesh):
-    """ Interpolates from an unstructured coordinates (mesh) to a structured 
-        coordinates (grid)
+def smoothing_operator(mesh, sigma, truncate=3.):
+    """ Returns sparse matrix that smooths values on 2D unstructured mesh
+
+      Rows hold Gaussian weights of standard deviation SIGMA, in units of
+      distance, normalized to sum to one. SIGMA is either the same for all
+      coordinates or a sequence with one entry per coordinate. Weights are
+      computed only for pairs of points closer than TRUNCATE standard
+      deviations, found by KD-tree search.
+    """
+    npts = len(mesh)
+
+    # scale coordinates to units of standard deviations
+    mesh = mesh/np.asarray(sigma, dtype='float64')
+
+    pairs = cKDTree(mesh).query_pairs(truncate, output_type='ndarray')
+    i, j = pairs[:,0], pairs[:,1]
+    w = np.exp(-0.5*np.sum((mesh[i] - mesh[j])**2, axis=1))
+
+    # assemble symmetric matrix of weights, including diagonal
+    diag = np.arange(npts)
+    G = _sparse.csr_matrix((np.concatenate((w, w, np.ones(npts))),
+        (np.concatenate((i, j, diag)), np.concatenate((j, i, diag)))),
+        shape=(npts, npts))
+
+    # normalize rows
+    G = _sparse.diags(1./np.asarray(G.sum(axis=1)).ravel()).dot(G)
+    return G.tocsr().astype('float32')
+
+
+def gaussian_masks(mesh, points, sigma, truncate=6., tree=None):
+    """ Returns sparse matrix whose rows hold Gaussian masks of standard
+      deviation SIGMA, centred on each of POINTS and evaluated on MESH
+
+      Masks are evaluated only at mesh points closer than TRUNCATE*SIGMA
+      to their centres, found by searching TREE, a KD-tree of MESH that is
+      built if not given.
+    """
+    if tree is None:
+        tree = cKDTree(mesh)
+    neighbours = tree.query_ball_point(points, truncate*sigma)
+    rows = np.repeat(np.arange(len(points)), [len(n) for n in neighbours])
+    cols = np.concatenate(list(neighbours) + [[]]).astype(int)
+
+    d2 = np.sum((mesh[cols] - points[rows])**2, axis=1)
+    return _sparse.csr_matrix((np.exp(-0.5*d2/sigma**2), (rows, cols)),
+        shape=(len(points), len(mesh)))
+
+
+def mask_average(v, masks):
+    """ Blends values V under each mask towards their mask-weighted average,
+      one mask at a time, each acting on values already blended by previous
+      masks
+
+      MASKS is a sparse matrix with one mask per row, as returned by
+      gaussian_masks, so that each step touches only points under its mask
+    """
+    v = np.array(v, dtype='float64')
+    masks = masks.tocsr()
+    for i in range(masks.shape[0]):
+        cols = masks.indices[masks.indptr[i]:masks.indptr[i+1]]
+        mask = masks.data[masks.indptr[i]:masks.indptr[i+1]]
+        if not mask.any():
+            continue
+        weight = np.dot(mask, v[cols])/np.sum(mask)
+        v[cols] = (1.-mask)*v[cols] + mask*weight
+    return v
+
+
+def grid_spacing(mesh):
+    """ Returns horizontal and vertical spacing of the structured grid onto
+      which mesh2grid interpolates values on MESH
     """
     x = mesh[:,0]
     z = mesh[:,1]
     lx = x.max() - x.min()
     lz = z.max() - z.min()
-    nn = v.size
-
-    nx = int(np.around(np.sqrt(nn*lx/lz)))
-    nz = int(np.around(np.sqrt(nn*lz/lx)))
-    dx = lx/nx
-    dz = lz/nz
+    nx = int(np.around(np.sqrt(len(mesh)*lx/lz)))
+    nz = int(np.around(np.sqrt(len(mesh)*lz/lx)))
+    return np.array([lx/nx, lz/nz])
 
-    # construct structured grid
-    x = np.linspace(x.min(), x.max(), nx)
-    z = np.linspace(z.min(), z.max(), nz)
-    X, Z = np.meshgrid(x, z)
-    grid = stack(X.flatten(), Z.flatten())
 
-    # interpolate to structured grid
-    V = _interp.griddata(mesh, v, grid, 'linear')
-
-    # workaround edge issues
-    if np.any(np.isnan(V)):
-        W = _interp.griddata(mesh, v, grid, 'nearest')
-        for i in np.where(np.isnan(V)):
-            V[i] = W[i]
-
-    V = np.reshape(V, (nz, nx))
-    return V, grid
+def mesh2grid(v, mesh):
+    """ Interpolates from an unstructured coordinates (mesh) to a structured 
+        coordinates (grid)
+    """
+    interpolator = get_interpolator(mesh)
+    return interpolator.mesh2grid(v), interpolator.grid
 
 
 def grid2mesh(V, grid, mesh):
     """ Interpolates from structured coordinates (grid) to unstructured 
         coordinates (mesh)
     """
+    interpolator = get_interpolator(mesh)
+    if grid is interpolator.grid or np.array_equal(grid, interpolator.grid):
+        return interpolator.grid2mesh(V)
     return _interp.griddata(grid, V.flatten(), mesh, 'linear')
 
+
+def get_interpolator(mesh, path=None):
+    """ Returns interpolator between MESH and its structured grid, reusing
+      interpolators built for recently seen meshes
+
+      If PATH is given, interpolators are also saved there as .npz files,
+      named by a hash of the mesh coordinates, and read back by later
+      processes instead of being rebuilt
+    """
+    mesh = np.ascontiguousarray(mesh, dtype='float64')
+    key = sha1(mesh.tostring()).hexdigest()
+
+    if key in _interpolators:
+        # move to end as most recently used
+        _interpolators[key] = _interpolators.pop(key)
+        return _interpolators[key]
+
+    filename = '%s/interpolator.%s.npz' % (path, key)
+    if path and os.path.exists(filename):
+        interpolator = MeshInterpolator.load(filename)
+    else:
+        interpolator = MeshInterpolator(mesh)
+        if path:
+            interpolator.save(filename)
+
+    while len(_interpolators) >= _INTERPOLATOR_CACHE_SIZE:
+        _interpolators.popitem(last=False)
+    _interpolators[key] = interpolator
+
+    return interpolator
+
+
+class MeshInterpolator(object):
+    """ Linear interpolation between unstructured coordinates (mesh) and
+      structured coordinates (grid)
+
+      Triangulations are computed once, and simplex indices and barycentric
+      weights are stored as sparse matrices, so that each interpolation is a
+      single sparse matrix-vector product. Points outside the convex hull
+      of the input coordinates take the value of the nearest input point.
+    """
+    def __init__(self, mesh):
+        x = mesh[:,0]
+        z = mesh[:,1]
+        lx = x.max() - x.min()
+        lz = z.max() - z.min()
+        nn = len(mesh)
+
+        nx = int(np.around(np.sqrt(nn*lx/lz)))
+        nz = int(np.around(np.sqrt(nn*lz/lx)))
+
+        # construct structured grid
+        x = np.linspace(x.min(), x.max(), nx)
+        z = np.linspace(z.min(), z.max(), nz)
+        X, Z = np.meshgrid(x, z)
+        self.grid = stack(X.flatten(), Z.flatten())
+        self.shape = (nz, nx)
+
+        self._mesh2grid = interpolation_matrix(mesh, self.grid)
+        self._grid2mesh = interpolation_matrix(self.grid, mesh)
+
+    @classmethod
+    def load(cls, filename):
+        """ Reads interpolator written by save
+        """
+        self = cls.__new__(cls)
+        with np.load(filename) as data:
+            self.grid = data['grid']
+            self.shape = tuple(data['shape'])
+            for name in ['_mesh2grid', '_grid2mesh']:
+                self.__dict__[name] = _sparse.csr_matrix(
+                    (data[name+'_data'], data[name+'_indices'],
+                     data[name+'_indptr']), shape=tuple(data[name+'_shape']))
+        return self
+
+    def save(self, filename):
+        """ Writes grid and interpolation matrices to .npz file, replacing
+          any interpolators saved for other meshes
+        """
+        arrays = {'grid': self.grid, 'shape': self.shape}
+        for name in ['_mesh2grid', '_grid2mesh']:
+            matrix = getattr(self, name)
+            for attr in ['data', 'indices', 'indptr', 'shape']:
+                arrays[name+'_'+attr] = getattr(matrix, attr)
+
+        path = os.path.dirname(filename)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for stale in glob(path+'/'+'interpolator.*.npz'):
+            os.remove(stale)
+
+        # write atomically, since other processes may be reading
+        tmpfile = '%s/.interpolator.%d.npz' % (path, os.getpid())
+        np.savez(tmpfile, **arrays)
+        os.rename(tmpfile, filename)
+
+    def mesh2grid(self, v):
+        return self._mesh2grid.dot(v).reshape(self.shape)
+
+    def grid2mesh(self, V):
+        return self._grid2mesh.dot(V.flatten())
+
+
+class MeshGeometry(object):
+    """ Coordinates of an unstructured mesh split into slices, along with
+      quantities derived from them
+
+      Bounds are computed on construction; the KD-tree and the mesh-grid
+      interpolator are built the first time they are used and kept for the
+      lifetime of the object.
+    """
+    def __init__(self, coords, offsets):
+        self.mesh = stack(*coords)
+        self.offsets = np.array(offsets)
+        self.bounds = np.column_stack((self.mesh.min(axis=0),
+                                       self.mesh.max(axis=0)))
+
+    def __getstate__(self):
+        # derived quantities are cheaper to rebuild than to pickle
+        state = self.__dict__.copy()
+        state.pop('_tree', None)
+        state.pop('_interpolator', None)
+        return state
+
+    @property
+    def nproc(self):
+        return len(self.offsets) - 1
+
+    @property
+    def tree(self):
+        if not hasattr(self, '_tree'):
+            self._tree = cKDTree(self.mesh)
+        return self._tree
+
+    @property
+    def interpolator(self):
+        if not hasattr(self, '_interpolator'):
+            self._interpolator = get_interpolator(self.mesh)
+        return self._interpolator
+
+    @property
+    def spacing(self):
+        return grid_spacing(self.mesh)
+
+    def slice(self, iproc):
+        """ Returns coordinates of mesh slice IPROC
+        """
+        return self.mesh[self.offsets[iproc]:self.offsets[iproc+1]]
+
+    def neighbours(self, points, radius):
+        """ Returns indices of mesh points within RADIUS of each of POINTS
+        """
+        return self.tree.query_ball_point(points, radius)
+
+
+def interpolation_matrix(points, xi):
+    """ Returns sparse matrix that linearly interpolates values on POINTS
+      onto coordinates XI, using barycentric weights on a Delaunay
+      triangulation and nearest neighbours outside its convex hull
+    """
+    tri = Delaunay(points)
+    simplex = tri.find_simplex(xi)
+    inside = simplex >= 0
+    ndim = points.shape[1]
+
+    # barycentric coordinates of points inside triangulation
+    T = tri.transform[simplex[inside]]
+    b = np.einsum('ijk,ik->ij', T[:,:ndim], xi[inside] - T[:,ndim])
+    b = np.column_stack((b, 1. - b.sum(axis=1)))
+
+    rows = [np.repeat(np.where(inside)[0], ndim+1)]
+    cols = [tri.simplices[simplex[inside]].flatten()]
+    data = [b.flatten()]
+
+    # nearest neighbours of points outside triangulation
+    if not inside.all():
+        _, nearest = cKDTree(points).query(xi[~inside])
+        rows += [np.where(~inside)[0]]
+        cols += [nearest]
+        data += [np.ones(len(nearest))]
+
+    return _sparse.csr_matrix(
+        (np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(len(xi), len(points)))
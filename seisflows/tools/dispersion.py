@@ -3,7 +3,11 @@
 import numpy as np
 import scipy.fftpack
 import cmath
-import matplotlib.pyplot as plt
+
+from multiprocessing.pool import ThreadPool
+
+from seisflows.tools.signal import taper
+from seisflows.tools.su import Gather
 
 
 def get_fft(traces, dt, nt):
@@ -35,13 +39,14 @@ def get_fk(traces, dt, nt, dx, nr):
     return U, k, f[0:nt//2]
 
 
-def get_dispersion(traces,dx,cmin,cmax,dc,fmax):
+def get_dispersion(traces,dx,cmin,cmax,dc,fmax,nthreads=1):
     """ calculate dispersion curves after Park et al. 1998
     INPUTS
-    traces: SU traces
+    traces: SU traces, as obspy stream or gather
     dx: distance between stations (m)
     cmax: upper velocity limit (m/s)
     fmax: upper frequency limit (Hz)
+    nthreads: number of threads across which frequencies are divided
     OUTPUTS
     f: 1d array frequency vector
     c: 1d array phase velocity vector
@@ -50,42 +55,33 @@ def get_dispersion(traces,dx,cmin,cmax,dc,fmax):
     U: 2d array (nr x npts//2) Fourier transform of traces
     t: 1d array time vector
     """
-    nr = len(traces) 
-    dt = traces[0].stats.delta
+    u, dt = prepare_traces(traces)
+    nr, nt = u.shape
     print('dt: ', dt)
-    nt = traces[0].stats.npts
     print('nt: ', nt)
     t = np.linspace(0.0, nt*dt, nt)
-    traces.detrend()
-    traces.taper(0.05,type='hann')
-    U, f = get_fft(traces, dt, nt)
+    U, f = get_fft(u, dt, nt)
     #dc = 10.0 # phase velocity increment
     c = np.arange(cmin,cmax,dc) # set phase velocity range
     df = f[1] - f[0]
     fmax_idx = int(fmax//df)
     print('Frequency resolution up to %5.2f kHz: %i bins' % (fmax, fmax_idx))
     print('Phase velocity resolution up to %5.2f m/s: %i bins' % (cmax, len(c)))
-    img = np.zeros((len(c),fmax_idx))
     x = np.linspace(0.0, (nr-1)*dx, nr)
-    for fi in range(fmax_idx): # loop over frequency range
-        for ci in range(len(c)): # loop over phase velocity range
-            k = 2.0*np.pi*f[fi]/(c[ci])
-            img[ci,fi] = np.abs(np.dot(dx * np.exp(1.0j*k*x), U[:,fi]/np.abs(U[:,fi])))
+    img = np.abs(phase_shift(_normalize(U[:,:fmax_idx]), f[:fmax_idx], x, 1./c,
+        dx, nthreads))
 
     return f,c,img,fmax_idx,U,t
 
 
-def slant_stack_frequency(traces, dx, cmax, fmax):
+def slant_stack_frequency(traces, dx, cmax, fmax, nthreads=1):
     """
     Slant stack method after McMechan and Yedlin 1981
     """
-    nr = len(traces) 
-    dt = traces[0].stats.delta
-    nt = traces[0].stats.npts
+    u, dt = prepare_traces(traces)
+    nr, nt = u.shape
     t = np.linspace(0.0, nt*dt, nt)
-    traces.detrend()
-    traces.taper(0.05,type='hann')
-    U, f = get_fft(traces, dt, nt)  # u(r,t) -> u(r,f)
+    U, f = get_fft(u, dt, nt)  # u(r,t) -> u(r,f)
     df = f[1] - f[0]
     fmax_idx = int(fmax//df)
 
@@ -96,14 +92,10 @@ def slant_stack_frequency(traces, dx, cmax, fmax):
 
     Upf = np.zeros((len(p), len(f)), dtype = complex)
     x = np.linspace(0.0, (nr-1)*dx, nr)
-    for fi in range(fmax_idx): # loop over frequency range
-        for pi in range(len(p)): # loop over slowness
-            k = 2.0*np.pi*f[fi]*p[pi]
-            Upf[pi,fi] = np.dot(dx * np.exp(1.0j*k*x), U[:,fi]/np.abs(U[:,fi]))
+    Upf[:,:fmax_idx] = phase_shift(_normalize(U[:,:fmax_idx]), f[:fmax_idx],
+        x, p, dx, nthreads)
 
-    Utaup = np.zeros((len(t)//2, len(p)), dtype = complex)
-    for pi in range(len(p)):
-        Utaup[:,pi] = get_ifft(Upf[pi,:])
+    Utaup = get_ifft(Upf).T
 
     return f, p, fmax_idx, Upf[:,:fmax_idx], Utaup
 
@@ -125,39 +117,152 @@ def slant_stack_frequency(traces, dx, cmax, fmax):
 def slant_stack_time(traces,dx,cmax):
     """
     Slant stack method after McMechan and Yedlin 1981
+
+    Traces are sampled at times tau + p*x by linear interpolation
     """
-    nr = len(traces) 
-    dt = traces[0].stats.delta
-    nt = traces[0].stats.npts
+    u, dt = prepare_traces(traces)
+    nr, nt = u.shape
     t = np.linspace(0.0, nt*dt, nt)
-    traces.detrend() 
-    traces.taper(0.05,type='hann') 
     dc = 50.0 # phase velocity increment 
     c = np.arange(50.0,cmax,dc) # set phase velocity range 
     p = 1.0/c # sorted in p_max,..,p_min order 
     print('Phase slowness resolution up to %5.2f m/s: %i bins' % (cmax, len(c)))
     tau = np.linspace(0.0, np.max(t), len(t))
     U = np.zeros((len(p),len(tau)))
-    u = np.array(traces) # obspy stream to 2d array
     x = np.linspace(0.0, (nr-1)*dx, nr) # array coordinates
+    ir = np.arange(nr)
     for pi in range(len(p)):
-        print('slowness is %f: ' % p[pi])
-        for taui in range(len(tau)):
-        #   x = 0.0
-        #   ux = 0.0
-        #   for rcv_i in range(nr):
-        #      ti = tau[taui] + p[pi]*x
-        #      ti_idx = int(ti//dt)
-        #      #print(ti, ti_idx)
-        #      if ti_idx < nt:
-        #           ux += traces[rcv_i].data[ti_idx]
-        #      x += dx
-            ti = tau[taui] + p[pi]*x
-            ti_idx = (ti//dt).astype(int)
-            for rcv_i in range(nr):
-                #U[pi,taui] += (u[rcv_i,ti_idx[rcv_i]] if ti_idx[rcv_i] < nt else 0.0)
-                if ((ti_idx[rcv_i] < nt) and (ti_idx[rcv_i] > 0)):
-                    U[pi,taui] += u[rcv_i,ti_idx[rcv_i]]
+        # fractional sample indices, (ntau, nr)
+        ti = (tau[:,np.newaxis] + p[pi]*x)/dt
+        it = np.floor(ti).astype(int)
+        w = ti - it
+        valid = (it >= 0) & (it < nt-1)
+        it = np.clip(it, 0, nt-2)
+        ut = (1.-w)*u[ir,it] + w*u[ir,it+1]
+        U[pi] = np.sum(np.where(valid, ut, 0.), axis=1)
 
     return p,tau,U
 
+
+def phase_shift(U, f, x, p, dx=1., nthreads=1, chunk=2**22):
+    """ Phase shift transform of frequency-domain traces
+
+      Returns (np, nf) array of sum_r dx exp(i 2 pi f p x_r) U[r, f] for
+      (nr, nf) spectra U, frequencies F, receiver positions X and slownesses
+      P. Steering matrices for blocks of frequencies are built at once and
+      applied as batched matrix products; with NTHREADS > 1, blocks are
+      divided among threads. CHUNK bounds the size of steering blocks.
+    """
+    U = np.asarray(U)
+    f = np.asarray(f, dtype=float)
+    x = np.asarray(x, dtype=float)
+    p = np.asarray(p, dtype=float)
+    nr, nf = U.shape
+
+    out = np.empty((len(p), nf), dtype=complex)
+    nblock = max(1, chunk // max(1, len(p)*nr))
+    blocks = [slice(i, min(i+nblock, nf)) for i in range(0, nf, nblock)]
+
+    def apply(block):
+        # steering matrices, (nfb, np, nr)
+        k = 2.0*np.pi*f[block,np.newaxis]*p
+        steer = dx*np.exp(1.0j*k[:,:,np.newaxis]*x)
+        out[:,block] = np.matmul(steer, U[:,block].T[:,:,np.newaxis])[:,:,0].T
+
+    if nthreads > 1 and len(blocks) > 1:
+        pool = ThreadPool(nthreads)
+        try:
+            pool.map(apply, blocks)
+        finally:
+            pool.close()
+    else:
+        for block in blocks:
+            apply(block)
+
+    return out
+
+
+def image(u, dt, x, c, fmin=0., fmax=None, eps=0., nthreads=1):
+    """ Dispersion image of (nr, nt) array of traces recorded at offsets X,
+      for phase velocities C and frequencies between FMIN and FMAX
+
+      Spectra are normalized by their amplitude plus EPS times the largest
+      amplitude, which stabilizes the image where there is little energy.
+      Returns indices of selected frequencies among those of np.fft.rfft,
+      spectra, normalized spectra, phase-shift transform and image, as
+      needed by image_adjoint
+    """
+    nt = u.shape[1]
+    f = np.fft.rfftfreq(nt, dt)
+    fidx = _frequency_indices(f, nt, fmin, fmax)
+
+    U = np.fft.rfft(u, axis=1)[:,fidx]
+    N = _normalize(U, eps)
+    S = phase_shift(N, f[fidx], x, 1./np.asarray(c), 1., nthreads)
+    return fidx, U, N, S, np.abs(S)
+
+
+def image_adjoint(dI, nt, dt, x, c, fidx, U, N, S, eps=0., nthreads=1):
+    """ Returns (nr, nt) gradient of sum(DI*I) with respect to traces, where
+      I is the dispersion image computed by image(...), which also returns
+      FIDX, U, N and S
+
+      Since steering matrices are symmetric in offset and slowness, the
+      transposed transform is phase_shift with their roles exchanged
+    """
+    f = np.fft.rfftfreq(nt, dt)[fidx]
+    W = dI*np.conj(_normalize(S))
+    G = phase_shift(W, f, 1./np.asarray(c), x, 1., nthreads)
+
+    # derivative of N = U/(|U| + e) with respect to U
+    a = np.abs(U)
+    e = eps*a.max() if a.size else 0.
+    b = np.where(a+e > 0., a+e, 1.)
+    E = G/b - np.real(G*U)*np.conj(U)/(np.where(a > 0., a, 1.)*b**2)
+    E[a+e == 0.] = 0.
+
+    # contribution of water level, through largest amplitude
+    if e > 0.:
+        k = np.unravel_index(np.argmax(a), a.shape)
+        E[k] -= eps*np.sum(np.real(G*U)/b**2)*np.conj(U[k])/a[k]
+
+    Z = np.zeros((len(U), nt//2+1), dtype=complex)
+    Z[:,fidx] = np.conj(E)
+    return np.fft.irfft(Z, nt, axis=1)*nt/2.
+
+
+def prepare_traces(traces):
+    """ Returns detrended and tapered (nr, nt) array of traces and time step
+
+      Accepts obspy streams, which are detrended and tapered in place, or
+      gathers
+    """
+    if isinstance(traces, Gather):
+        # as obspy's default detrend, remove line through end points
+        u = np.array(traces.data, dtype=float)
+        u -= u[:,:1] + (u[:,-1:] - u[:,:1])*np.linspace(0.0, 1.0, u.shape[1])
+        return taper(u, 0.05), traces.dt
+
+    traces.detrend()
+    traces.taper(0.05,type='hann')
+    return np.array([tr.data for tr in traces]), traces[0].stats.delta
+
+
+def _normalize(U, eps=0.):
+    # spectra scaled to unit amplitude, zero where amplitude vanishes; with
+    # EPS > 0, divided by amplitude plus EPS times largest amplitude instead
+    a = np.abs(U)
+    if eps and a.size:
+        a = a + eps*a.max()
+    return np.where(a > 0., U/np.where(a > 0., a, 1.), 0.)
+
+
+def _frequency_indices(f, nt, fmin, fmax):
+    # indices of frequencies in [FMIN, FMAX], excluding zero and Nyquist
+    keep = (f > 0.) & (f >= fmin)
+    if fmax is not None:
+        keep &= f <= fmax
+    if nt % 2 == 0:
+        keep[-1] = False
+    return np.flatnonzero(keep)
+
@@ -0,0 +1,86 @@
+
+# Binary store for data residuals. Each source writes one file, to which
+# residuals are appended channel by channel as records consisting of a short
+# header followed by float64 values. Headers hold the channel name, the
+# number of residuals and their sum of squares, so that totals can be
+# computed without reading the residuals themselves. Appends are locked, so
+# that several processes may write to the same file.
+
+import fcntl
+import numpy as np
+
+
+HEADER = np.dtype([
+    ('channel', 'S32'),
+    ('count', '<i8'),
+    ('sumsq', '<f8')])
+
+
+def append(filename, values, channel=''):
+    """ Appends residuals of one channel to FILENAME
+
+      Raises ValueError if CHANNEL does not fit in the record header, since
+      truncated names would be indistinguishable from one another
+    """
+    if len(channel) > HEADER['channel'].itemsize:
+        raise ValueError('Channel name longer than %d characters: %s'
+            % (HEADER['channel'].itemsize, channel))
+
+    values = np.asarray(values, dtype='<f8').ravel()
+
+    header = np.zeros(1, dtype=HEADER)
+    header['channel'] = channel
+    header['count'] = len(values)
+    header['sumsq'] = np.sum(values**2.)
+
+    with open(filename, 'ab') as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            file.write(header.tobytes() + values.tobytes())
+            file.flush()
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def load(filename, channel=None):
+    """ Returns residuals from FILENAME, either all of them or, if CHANNEL is
+      given, those of that channel only
+    """
+    values = []
+    with open(filename, 'rb') as file:
+        for header, offset in _headers(filename):
+            if channel is None or header['channel'] == channel:
+                file.seek(offset)
+                values += [np.fromfile(file, dtype='<f8',
+                    count=int(header['count']))]
+    if not values:
+        return np.array([])
+    return np.concatenate(values)
+
+
+def sum_squares(filename):
+    """ Returns sum of squares of all residuals in FILENAME
+    """
+    return sum(float(header['sumsq']) for header, _ in _headers(filename))
+
+
+def channels(filename):
+    """ Returns channel names in FILENAME, in order written
+    """
+    return [header['channel'] for header, _ in _headers(filename)]
+
+
+def _headers(filename):
+    # yields each record header and the byte offset of its values
+    with open(filename, 'rb') as file:
+        while True:
+            buf = file.read(HEADER.itemsize)
+            if not buf:
+                break
+            if len(buf) < HEADER.itemsize:
+                raise IOError('Truncated residuals file: %s' % filename)
+            header = np.frombuffer(buf, dtype=HEADER)[0]
+            offset = file.tell()
+            yield header, offset
+            file.seek(offset + 8*int(header['count']))
+
@@ -2,6 +2,7 @@
 import os
 import sys
 import numpy as np
+import shutil
 import subprocess
 
 from collections import defaultdict
@@ -36,56 +37,133 @@ def call_solver(mpiexec, executable, output='solver.log'):
 def getpar(key, file='DATA/Par_file', sep='=', cast=str):
     """ Reads parameter from SPECFEM parfile
     """
-    val = None
-    with open(file, 'r') as f:
-        # read line by line
-        for line in f:
-            if find(line, key) == 0:
-                # read key
-                key, val = _split(line, sep)
-                if not key:
-                    continue
-                # read val
-                val, _ = _split(val, '#')
-                val.strip()
-                break
-
-    if val:
-        if cast == float:
-            val = val.replace('d', 'e')
-        return cast(val)
-
-    else:
-        print 'Not found in parameter file: %s\n' % key
-        raise Exception
+    return Parfile(file, sep=sep).get(key, cast)
 
 
 def setpar(key, val, filename='DATA/Par_file', path='.', sep='='):
     """ Writes parameter to SPECFEM parfile
+
+      To change several parameters at once, use a Parfile object instead
     """
+    with Parfile(filename, path, sep) as parfile:
+        parfile[key] = val
 
-    val = str(val)
-
-    # read line by line
-    with open(path +'/'+ filename, 'r') as file:
-        lines = []
-        for line in file:
-            if find(line, key) == 0:
-                # read key
-                key, _ = _split(line, sep)
-                # read comment
-                _, comment = _split(line, '#')
-                n = len(line) - len(key) - len(val) - len(comment) - 2
-                # replace line
-                if comment:
-                    line = _merge(key, sep, val, ' '*n, '#', comment)
-                else:
-                    line = _merge(key, sep, str(val), '\n')
-            lines.append(line)
 
-    # write file
-    with open(path +'/'+ filename, 'w') as file:
-        file.writelines(lines)
+class Parfile(object):
+    """ Parsed SPECFEM parameter file
+
+      Lines are read once and cached for as long as the file is unchanged.
+      Assignments are applied in memory and written together, in one atomic
+      replace, by write() or on leaving a with block:
+
+        with Parfile() as parfile:
+            parfile['SIMULATION_TYPE'] = 1
+            parfile['SAVE_FORWARD'] = '.true.'
+    """
+    _cache = {}
+
+    def __init__(self, filename='DATA/Par_file', path='.', sep='='):
+        self.filename = join(path, filename)
+        self.sep = sep
+        self.lines = list(self._read())
+        self.modified = False
+
+        # line numbers of each key, in order of appearance
+        self.index = defaultdict(list)
+        for i, line in enumerate(self.lines):
+            key, val = _split(line, sep)
+            if val and not key.lstrip().startswith('#'):
+                self.index[key.strip()] += [i]
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __getitem__(self, key):
+        if key not in self.index:
+            raise KeyError(key)
+        _, val = _split(self.lines[self.index[key][0]], self.sep)
+        val, _ = _split(val, '#')
+        return val.strip()
+
+    def __setitem__(self, key, val):
+        # as with setpar, keys absent from the file are ignored; every
+        # occurrence is changed, as in SOURCE files with several sources
+        for i in self.index.get(key, ()):
+            line = self._format(self.lines[i], str(val))
+            if line != self.lines[i]:
+                self.lines[i] = line
+                self.modified = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.write()
+
+    def get(self, key, cast=str):
+        """ Returns value of parameter, converted by CAST
+        """
+        val = self[key] if key in self else None
+
+        if val:
+            if cast == float:
+                val = val.replace('d', 'e')
+            return cast(val)
+
+        else:
+            print 'Not found in parameter file: %s\n' % key
+            raise Exception
+
+    def update(self, items):
+        """ Sets several parameters at once
+        """
+        for key, val in dict(items).items():
+            self[key] = val
+
+    def write(self):
+        """ Writes modified lines, replacing the file atomically
+        """
+        if not self.modified:
+            return
+
+        tmpfile = self.filename+'.tmp'
+        with open(tmpfile, 'w') as file:
+            file.writelines(self.lines)
+        if exists(self.filename):
+            shutil.copymode(self.filename, tmpfile)
+
+        # renaming also detaches the file from any links
+        os.rename(tmpfile, self.filename)
+        self._cache[abspath(self.filename)] = (self._stat(), tuple(self.lines))
+        self.modified = False
+
+    def _format(self, line, val):
+        key, rest = _split(line, self.sep)
+        old, comment = _split(rest, '#')
+
+        # keep spacing around value and alignment of comment
+        lead = old[:len(old)-len(old.lstrip())]
+        if comment:
+            n = max(len(old)-len(lead)-len(val), 1)
+            return _merge(key, self.sep, lead, val, ' '*n, '#', comment)
+        else:
+            return _merge(key, self.sep, lead, val, '\n')
+
+    def _read(self):
+        filename = abspath(self.filename)
+        stat = self._stat()
+        if filename in self._cache and self._cache[filename][0] == stat:
+            return self._cache[filename][1]
+
+        with open(filename, 'r') as file:
+            lines = tuple(file.readlines())
+        self._cache[filename] = (stat, lines)
+        return lines
+
+    def _stat(self):
+        stat = os.stat(self.filename)
+        return (stat.st_ino, stat.st_size, stat.st_mtime)
 
 
 def write_source_specfem2d(s_coords_x, s_coords_y, f0, source_files='', source_type=1, stf_type=8, path='.', filename='DATA/SOURCE'):
@@ -110,6 +188,7 @@ def write_source_specfem2d(s_coords_x, s_coords_y, f0, source_files='', source_t
             + 'factor = 1e10 \n']
 
     # write file
+    unix.detach(path +'/'+ filename)
     with open(path +'/'+ filename, 'w') as file:
         file.writelines(lines)
 
@@ -122,6 +201,7 @@ def write_stations_specfem2d(r_coords_x, r_coords_y, path='.', filename='DATA/ST
         lines += ['S{0} \t AA \t {1} \t {2} \t 0.0 \t 0.0 \n'.format(str(i).zfill(4), r_coords_x[i], r_coords_y[i])]
 
     # write file
+    unix.detach(path +'/'+ filename)
     with open(path +'/'+ filename, 'w') as file:
         file.writelines(lines)
 
@@ -134,21 +214,162 @@ class Minmax(defaultdict):
 
     def update(self, keys, vals):
         for key, val in _zip(keys, vals):
-            if min(val) < self.dict[key][0]:
-                self.dict[key][0] = min(val)
-            if max(val) > self.dict[key][1]:
-                self.dict[key][1] = max(val)
+            if len(val) == 0:
+                continue
+            if np.min(val) < self[key][0]:
+                self[key][0] = np.min(val)
+            if np.max(val) > self[key][1]:
+                self[key][1] = np.max(val)
 
     def __call__(self, key):
-        return self.dict[key]
+        return self[key]
+
+
+class SliceArray(object):
+    """ Holds all slices of a single material parameter in one contiguous
+      buffer
+
+      Indexing by processor rank returns a view into the buffer. Slices can
+      either be preallocated from a list of slice sizes and filled by
+      assignment, or appended one at a time. Min and max values are updated
+      as slices are written; arrays wrapping existing DATA compute them on
+      first access.
+    """
+    def __init__(self, ngll=[], data=None, dtype='float32'):
+        self.offsets = [0]
+        for n in ngll:
+            self.offsets += [self.offsets[-1] + n]
+
+        if data is None:
+            self._buffer = np.zeros(self.offsets[-1], dtype)
+            self._minmax = [+np.inf, -np.inf]
+        else:
+            assert len(data) == self.offsets[-1]
+            self._buffer = data
+            self._minmax = None
+
+    @property
+    def data(self):
+        """ Contiguous array holding all slices
+        """
+        return self._buffer[:self.offsets[-1]]
+
+    @property
+    def minmax(self):
+        if self._minmax is None:
+            self._minmax = [+np.inf, -np.inf]
+            self._update_minmax(self.data)
+        return self._minmax
+
+    def append(self, val):
+        """ Appends slice, growing buffer geometrically if needed
+        """
+        imin = self.offsets[-1]
+        imax = imin + len(val)
+        if imax > len(self._buffer):
+            buffer = np.empty(max(imax, 2*len(self._buffer)),
+                self._buffer.dtype)
+            buffer[:imin] = self._buffer[:imin]
+            self._buffer = buffer
+        self._buffer[imin:imax] = val
+        self.offsets += [imax]
+        self._update_minmax(self._buffer[imin:imax])
+
+    def copy(self, data=None):
+        """ Returns array with same slice layout, holding either a copy of
+          this array's data or the given DATA
+        """
+        if data is None:
+            data = self.data.copy()
+        return SliceArray(np.diff(self.offsets), data=data)
+
+    def _update_minmax(self, val):
+        if self._minmax is None or len(val) == 0:
+            return
+        self._minmax[0] = min(self._minmax[0], np.min(val))
+        self._minmax[1] = max(self._minmax[1], np.max(val))
+
+    def __iadd__(self, vals):
+        for val in vals:
+            self.append(val)
+        return self
+
+    def __getitem__(self, iproc):
+        if isinstance(iproc, slice):
+            return [self[i] for i in range(len(self))[iproc]]
+        if iproc < 0:
+            iproc += len(self)
+        if not 0 <= iproc < len(self):
+            raise IndexError(iproc)
+        return self._buffer[self.offsets[iproc]:self.offsets[iproc+1]]
+
+    def __setitem__(self, iproc, val):
+        view = self[iproc]
+        view[:] = val
+        self._update_minmax(view)
+
+    def __iter__(self):
+        for iproc in range(len(self)):
+            yield self[iproc]
+
+    def __len__(self):
+        return len(self.offsets) - 1
 
 
 class ModelDict(defaultdict):
     """ Dictionary-like object for holding models or kernels
+
+      Each material parameter is stored as a SliceArray. Arithmetic between
+      models, or between models and scalars, acts on whole buffers at once
     """
     def __init__(self):
-        super(ModelDict, self).__init__(lambda: [])
-        self.minmax = Minmax()
+        super(ModelDict, self).__init__(SliceArray)
+
+    def minmax(self, key):
+        """ Returns min,max values of given parameter
+        """
+        return self[key].minmax
+
+    def _apply(self, other, op):
+        model = ModelDict()
+        for key in self.keys():
+            model[key] = self[key].copy(op(self[key].data, _data(other, key)))
+        return model
+
+    def _iapply(self, other, op):
+        for key in self.keys():
+            op(self[key].data, _data(other, key), out=self[key].data)
+            self[key]._minmax = None
+        return self
+
+    def __add__(self, other):
+        return self._apply(other, np.add)
+
+    def __sub__(self, other):
+        return self._apply(other, np.subtract)
+
+    def __mul__(self, other):
+        return self._apply(other, np.multiply)
+
+    def __div__(self, other):
+        return self._apply(other, np.true_divide)
+
+    def __iadd__(self, other):
+        return self._iapply(other, np.add)
+
+    def __isub__(self, other):
+        return self._iapply(other, np.subtract)
+
+    def __imul__(self, other):
+        return self._iapply(other, np.multiply)
+
+    def __idiv__(self, other):
+        return self._iapply(other, np.true_divide)
+
+    __radd__ = __add__
+    __rmul__ = __mul__
+    __truediv__ = __div__
+    __itruediv__ = __idiv__
 
 
 class StepWriter(object):
@@ -230,3 +451,13 @@ def _merge(*parts):
 
 def _zip(keys, vals):
     return zip(iterable(keys), iterable(vals))
+
+
+def _data(other, key):
+    # operand for arithmetic on ModelDict objects
+    if isinstance(other, ModelDict):
+        if key not in other:
+            raise KeyError(key)
+        return other[key].data
+    else:
+        return other
@@ -1,5 +1,7 @@
 
 import numpy as np
+import scipy.fftpack as _fftpack
+import scipy.signal as _signal
 
 
 ### functions acting on whole record sections
@@ -19,6 +21,73 @@ def sconvolve(s, h, w, inplace=True):
         return s2
 
 
+def detrend(traces):
+    """ Removes mean and linear trend from each row of a record section
+    """
+    return _signal.detrend(traces, axis=1, type='linear')
+
+
+def taper(traces, percentage=0.05):
+    """ Applies Hann taper to both ends of each row of a record section, in
+      the same way as obspy's Trace.taper
+    """
+    nt = traces.shape[1]
+    wlen = min(int(percentage*nt), int(nt/2))
+
+    if 2*wlen == nt:
+        sides = np.hanning(2*wlen)
+    else:
+        sides = np.hanning(2*wlen+1)
+
+    win = np.ones(nt)
+    win[:wlen] = sides[:wlen]
+    win[nt-wlen:] = sides[len(sides)-wlen:]
+
+    traces *= win
+    return traces
+
+
+def bandpass(traces, freqmin, freqmax, dt, corners=4, zerophase=False):
+    """ Applies Butterworth bandpass filter along each row of a record section
+    """
+    fe = 0.5/dt
+    if freqmax/fe >= 1.:
+        # as in obspy, fall back to highpass above Nyquist
+        return highpass(traces, freqmin, dt, corners, zerophase)
+
+    sos = _signal.iirfilter(corners, [freqmin/fe, freqmax/fe],
+        btype='band', ftype='butter', output='sos')
+    return _sosfilt(sos, traces, zerophase)
+
+
+def lowpass(traces, freq, dt, corners=4, zerophase=False):
+    """ Applies Butterworth lowpass filter along each row of a record section
+    """
+    fe = 0.5/dt
+    if freq/fe >= 1.:
+        return traces
+
+    sos = _signal.iirfilter(corners, freq/fe,
+        btype='lowpass', ftype='butter', output='sos')
+    return _sosfilt(sos, traces, zerophase)
+
+
+def highpass(traces, freq, dt, corners=4, zerophase=False):
+    """ Applies Butterworth highpass filter along each row of a record section
+    """
+    fe = 0.5/dt
+    sos = _signal.iirfilter(corners, freq/fe,
+        btype='highpass', ftype='butter', output='sos')
+    return _sosfilt(sos, traces, zerophase)
+
+
+def _sosfilt(sos, traces, zerophase):
+    if zerophase:
+        return _signal.sosfiltfilt(sos, traces, axis=1)
+    else:
+        return _signal.sosfilt(sos, traces, axis=1)
+
+
 def mute_early_arrivals(traces, slope, const, time_scheme, s_coords, r_coords):
     """ Applies tapered mask to record section, muting early arrivals
 
@@ -30,19 +99,10 @@ def mute_early_arrivals(traces, slope, const, time_scheme, s_coords, r_coords):
         CONST has units of time, and
         || s - r || is distance between source and receiver.
     """
-
-    nr = len(traces)
     nt, dt, _ = time_scheme
 
-
-    for ir in range(nr):
-        # calculate source-reciever distance
-        (sx, sy) = (s_coords[0][ir], s_coords[1][ir])
-        (rx, ry) = (r_coords[0][ir], r_coords[1][ir])
-        offset = np.sqrt((rx-sx)**2 + (ry-sy)**2)
-
-        # apply tapered mask
-        traces[ir].data *= mask(slope, const, offset, (nt, dt, 0.))
+    # apply tapered mask
+    traces *= mask(slope, const, offsets(s_coords, r_coords), (nt, dt, 0.))
 
     return traces
 
@@ -58,18 +118,10 @@ def mute_late_arrivals(traces, slope, const, time_scheme, s_coords, r_coords):
         CONST has units of time, and
         || s - r || is distance between source and receiver.
     """
-
-    nr = len(traces)
     nt, dt, _ = time_scheme
 
-    for ir in range(nr):
-        # calculate source-reciever distance
-        (sx, sy) = (s_coords[0][ir], s_coords[1][ir])
-        (rx, ry) = (r_coords[0][ir], r_coords[1][ir])
-        offset = np.sqrt((rx-sx)**2 + (ry-sy)**2)
-
-        # apply tapered mask
-        traces[ir].data *= (1.-mask(slope, const, offset, (nt, dt, 0.)))
+    # apply tapered mask
+    traces *= (1.-mask(slope, const, offsets(s_coords, r_coords), (nt, dt, 0.)))
 
     return traces
 
@@ -82,17 +134,7 @@ def mute_short_offsets(traces, dist, s_coords, r_coords):
         where || s - r || is the offset between source and receiver and 
         DIST is a user-supplied cutoff
     """
-    nr = len(traces)
-
-    for ir in range(nr):
-        # calculate source-reciever distance
-        (sx, sy) = (s_coords[0][ir], s_coords[1][ir])
-        (rx, ry) = (r_coords[0][ir], r_coords[1][ir])
-        offset = np.sqrt((rx-sx)**2 + (ry-sy)**2)
-
-        if offset < dist:
-            traces[ir].data[:] = 0.
-        
+    traces[offsets(s_coords, r_coords) < dist] = 0.
     return traces
 
 
@@ -104,18 +146,16 @@ def mute_long_offsets(traces, dist, s_coords, r_coords):
         where || s - r || is the offset between source and receiver and 
         DIST is a user-supplied cutoff
     """
-    nr = len(traces)
+    traces[offsets(s_coords, r_coords) > dist] = 0.
+    return traces
 
-    for ir in range(nr):
-        # calculate source-reciever distance
-        (sx, sy) = (s_coords[0][ir], s_coords[1][ir])
-        (rx, ry) = (r_coords[0][ir], r_coords[1][ir])
-        offset = np.sqrt((rx-sx)**2 + (ry-sy)**2)
 
-        if offset > dist:
-            traces[ir].data[:] = 0.
-        
-    return traces
+def offsets(s_coords, r_coords):
+    """ Returns source-receiver distances, one per trace
+    """
+    sx, sy = np.asarray(s_coords[0]), np.asarray(s_coords[1])
+    rx, ry = np.asarray(r_coords[0]), np.asarray(r_coords[1])
+    return np.sqrt((rx-sx)**2 + (ry-sy)**2)
 
 
 
@@ -124,38 +164,95 @@ def mute_long_offsets(traces, dist, s_coords, r_coords):
 def mask(slope, const, offset, time_scheme, length=400):
     """ Constructs tapered mask that can be applied to trace to
       mute early or late arrivals.
-    """
 
+      If OFFSET is an array, returns one mask per offset as rows of an
+      (nr, nt) array
+    """
     nt, dt, _ = time_scheme
 
-    mask = np.ones(nt)
-
     # construct taper
     win = np.sin(np.linspace(0, np.pi, 2*length))
     win = win[0:length]
 
     # caculate offsets
-    itmin = int(np.ceil((slope*abs(offset)+const)/dt)) - length/2
-    itmax = itmin + length
-
-    if 1 < itmin < itmax < nt:
-        mask[0:itmin] = 0.
-        mask[itmin:itmax] = win*mask[itmin:itmax]
-    elif itmin < 1 <= itmax:
-        mask[0:itmax] = win[length-itmax:length]*mask[0:itmax]
-    elif itmin < nt < itmax:
-        mask[0:itmin] = 0.
-        mask[itmin:nt] = win[0:nt-itmin]*mask[itmin:nt]
-    elif itmin > nt:
-        mask[:] = 0.
+    itmin = np.ceil((slope*abs(np.asarray(offset))+const)/dt).astype(int) \
+          - length//2
 
-    return mask
+    # zero before taper, taper, one after taper
+    it = np.arange(nt) - np.expand_dims(itmin, -1)
+    mask = np.where(it < length, win[np.clip(it, 0, length-1)], 1.)
+    mask[it < 0] = 0.
 
+    return mask
 
 
 def correlate(u, v):
-    w = np.convolve(u, np.flipud(v))
-    return
+    """ Full cross correlation of U and V along the last axis, computed
+      with FFTs
+
+      For single traces, this equals np.convolve(u, np.flipud(v))
+    """
+    u = np.asarray(u)
+    v = np.asarray(v)
+    n = u.shape[-1] + v.shape[-1] - 1
+    nfft = _fftpack.next_fast_len(n)
+
+    w = np.fft.irfft(np.fft.rfft(u, nfft) * np.fft.rfft(v[..., ::-1], nfft),
+        nfft)
+    return w[..., :n]
+
+
+def correlation_lag(syn, obs, dt, subsample=False):
+    """ Returns time by which OBS lags SYN, taken from the peak of the
+      absolute cross correlation
+
+      If SUBSAMPLE is True, the peak is refined by fitting a parabola
+      through it and its two neighbours
+    """
+    nt = np.shape(syn)[-1]
+    cc = abs(correlate(obs, syn))
+    return _peak_lag(cc, nt, dt, subsample)
+
+
+def correlation_lags(traces, i, j, dt, subsample=False):
+    """ Returns correlation_lag(traces[I], traces[J], dt) for index arrays
+      I and J, such as those of station pairs
+
+      Each trace is transformed only once, and pairs are processed in
+      chunks to bound memory use
+    """
+    i = np.asarray(i, dtype=int)
+    j = np.asarray(j, dtype=int)
+    nt = traces.shape[-1]
+    n = 2*nt - 1
+    nfft = _fftpack.next_fast_len(n)
+
+    forward = np.fft.rfft(traces, nfft)
+    reverse = np.fft.rfft(traces[:, ::-1], nfft)
+
+    lags = np.empty(len(i))
+    chunk = max(1, 2**22 // nfft)
+    for k in range(0, len(i), chunk):
+        cc = np.fft.irfft(forward[j[k:k+chunk]] * reverse[i[k:k+chunk]], nfft)
+        lags[k:k+chunk] = _peak_lag(abs(cc[:, :n]), nt, dt, subsample)
+    return lags
+
+
+def _peak_lag(cc, nt, dt, subsample):
+    # lag of the peak of absolute cross correlations of traces of length NT
+    it = np.argmax(cc, axis=-1)
+    lag = (it - nt + 1).astype(float)
+
+    if subsample:
+        n = cc.shape[-1]
+        c0 = _take(cc, np.clip(it-1, 0, n-1))
+        c1 = _take(cc, it)
+        c2 = _take(cc, np.clip(it+1, 0, n-1))
+        den = c0 - 2.*c1 + c2
+        ok = (0 < it) & (it < n-1) & (den != 0.)
+        lag += np.where(ok, 0.5*(c0-c2)/np.where(ok, den, 1.), 0.)
+
+    return lag*dt
 
 
 def tukeywin(nt, imin, imax, alpha=0.05):
@@ -171,3 +268,7 @@ def tukeywin(nt, imin, imax, alpha=0.05):
     win[imin:imax] = w
     return win
 
+
+def _take(a, i):
+    # selects one element of A per trace along the last axis
+    return np.take_along_axis(a, np.expand_dims(i, -1), -1)[..., 0]
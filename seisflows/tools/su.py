@@ -0,0 +1,225 @@
+
+# Native reader and writer for Seismic Unix files. A whole gather is held as
+# one (nrec, nt) float32 array together with a structured array of trace
+# headers, avoiding the per-trace objects of an obspy Stream.
+
+import numpy as np
+
+from seisflows.tools.unix import detach
+
+
+# SEG-Y trace header fields, in order, with their sizes in bytes. Fields are
+# signed integers except where another type is given.
+_FIELDS = [
+    ('trace_sequence_number_within_line', 4),
+    ('trace_sequence_number_within_segy_file', 4),
+    ('original_field_record_number', 4),
+    ('trace_number_within_the_original_field_record', 4),
+    ('energy_source_point_number', 4),
+    ('ensemble_number', 4),
+    ('trace_number_within_the_ensemble', 4),
+    ('trace_identification_code', 2),
+    ('number_of_vertically_summed_traces_yielding_this_trace', 2),
+    ('number_of_horizontally_stacked_traces_yielding_this_trace', 2),
+    ('data_use', 2),
+    ('distance_from_center_of_the_source_point_to_the_center_of_the_receiver_group', 4),
+    ('receiver_group_elevation', 4),
+    ('surface_elevation_at_source', 4),
+    ('source_depth_below_surface', 4),
+    ('datum_elevation_at_receiver_group', 4),
+    ('datum_elevation_at_source', 4),
+    ('water_depth_at_source', 4),
+    ('water_depth_at_group', 4),
+    ('scalar_to_be_applied_to_all_elevations_and_depths', 2),
+    ('scalar_to_be_applied_to_all_coordinates', 2),
+    ('source_coordinate_x', 4),
+    ('source_coordinate_y', 4),
+    ('group_coordinate_x', 4),
+    ('group_coordinate_y', 4),
+    ('coordinate_units', 2),
+    ('weathering_velocity', 2),
+    ('subweathering_velocity', 2),
+    ('uphole_time_at_source_in_ms', 2),
+    ('uphole_time_at_group_in_ms', 2),
+    ('source_static_correction_in_ms', 2),
+    ('group_static_correction_in_ms', 2),
+    ('total_static_applied_in_ms', 2),
+    ('lag_time_A', 2),
+    ('lag_time_B', 2),
+    ('delay_recording_time', 2),
+    ('mute_time_start_time_in_ms', 2),
+    ('mute_time_end_time_in_ms', 2),
+    ('number_of_samples_in_this_trace', 'u2'),
+    ('sample_interval_in_ms_for_this_trace', 'u2'),
+    ('gain_type_of_field_instruments', 2),
+    ('instrument_gain_constant', 2),
+    ('instrument_early_or_initial_gain', 2),
+    ('correlated', 2),
+    ('sweep_frequency_at_start', 2),
+    ('sweep_frequency_at_end', 2),
+    ('sweep_length_in_ms', 2),
+    ('sweep_type', 2),
+    ('sweep_trace_taper_length_at_start_in_ms', 2),
+    ('sweep_trace_taper_length_at_end_in_ms', 2),
+    ('taper_type', 2),
+    ('alias_filter_frequency', 2),
+    ('alias_filter_slope', 2),
+    ('notch_filter_frequency', 2),
+    ('notch_filter_slope', 2),
+    ('low_cut_frequency', 2),
+    ('high_cut_frequency', 2),
+    ('low_cut_slope', 2),
+    ('high_cut_slope', 2),
+    ('year_data_recorded', 2),
+    ('day_of_year', 2),
+    ('hour_of_day', 2),
+    ('minute_of_hour', 2),
+    ('second_of_minute', 2),
+    ('time_basis_code', 2),
+    ('trace_weighting_factor', 2),
+    ('geophone_group_number_of_roll_switch_position_one', 2),
+    ('geophone_group_number_of_trace_number_one', 2),
+    ('geophone_group_number_of_last_trace', 2),
+    ('gap_size', 2),
+    ('over_travel_associated_with_taper', 2),
+    ('x_coordinate_of_ensemble_position_of_this_trace', 4),
+    ('y_coordinate_of_ensemble_position_of_this_trace', 4),
+    ('for_3d_poststack_data_this_field_is_for_in_line_number', 4),
+    ('for_3d_poststack_data_this_field_is_for_cross_line_number', 4),
+    ('shotpoint_number', 4),
+    ('scalar_to_be_applied_to_the_shotpoint_number', 2),
+    ('trace_value_measurement_unit', 2),
+    ('transduction_constant_mantissa', 4),
+    ('transduction_constant_exponent', 2),
+    ('transduction_units', 2),
+    ('device_trace_identifier', 2),
+    ('scalar_to_be_applied_to_times', 2),
+    ('source_type_orientation', 2),
+    ('source_energy_direction_mantissa', 4),
+    ('source_energy_direction_exponent', 2),
+    ('source_measurement_mantissa', 4),
+    ('source_measurement_exponent', 2),
+    ('source_measurement_unit', 2),
+    ('unassigned', 'V8'),
+    ]
+
+HEADER_SIZE = 240
+
+
+def header_dtype(byteorder='<'):
+    """ Returns structured dtype of a 240-byte trace header
+    """
+    names, formats, offsets = [], [], []
+    offset = 0
+    for name, fmt in _FIELDS:
+        if fmt in [2, 4]:
+            fmt = 'i%d' % fmt
+        if fmt[0] != 'V':
+            fmt = byteorder + fmt
+        names += [name]
+        formats += [fmt]
+        offsets += [offset]
+        offset += np.dtype(fmt).itemsize
+
+    assert offset == HEADER_SIZE
+    return np.dtype({'names': names, 'formats': formats, 'offsets': offsets,
+        'itemsize': HEADER_SIZE})
+
+
+class Gather(object):
+    """ Seismic Unix gather
+
+      DATA is an (nrec, nt) array of traces and HEADERS a structured array of
+      the corresponding trace headers
+    """
+    def __init__(self, data, headers):
+        self.data = data
+        self.headers = headers
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    @property
+    def nrec(self):
+        return self.data.shape[0]
+
+    @property
+    def nt(self):
+        return self.data.shape[1]
+
+    @property
+    def dt(self):
+        # sample interval is stored in microseconds
+        return 1.e-6*float(self.headers['sample_interval_in_ms_for_this_trace'][0])
+
+    def copy(self, data=None):
+        """ Returns gather with copied headers and, unless DATA is given,
+          copied traces
+        """
+        if data is None:
+            data = self.data.copy()
+        return Gather(data, self.headers.copy())
+
+    def source_coords(self):
+        return (self.headers['source_coordinate_x'].astype(float),
+                self.headers['source_coordinate_y'].astype(float),
+                np.zeros(self.nrec))
+
+    def receiver_coords(self):
+        return (self.headers['group_coordinate_x'].astype(float),
+                self.headers['group_coordinate_y'].astype(float),
+                np.zeros(self.nrec))
+
+
+def read(filename, mmap=False, byteorder='<'):
+    """ Reads Seismic Unix file into a Gather
+
+      If MMAP is True, traces and headers are copy-on-write views of the file
+      on disk. Otherwise traces are read into one contiguous array.
+    """
+    dtype = header_dtype(byteorder)
+
+    # number of samples is taken from the first header
+    first = np.fromfile(filename, dtype=dtype, count=1)
+    if len(first) == 0:
+        raise IOError('Empty Seismic Unix file: %s' % filename)
+    nt = int(first['number_of_samples_in_this_trace'][0])
+
+    rtype = _record_dtype(dtype, nt, byteorder)
+    if mmap:
+        records = np.memmap(filename, dtype='uint8', mode='c')
+    else:
+        records = np.fromfile(filename, dtype='uint8')
+
+    if len(records) % rtype.itemsize:
+        raise IOError('Traces of unequal length: %s' % filename)
+    records = records.view(rtype)
+
+    if np.any(records['header']['number_of_samples_in_this_trace'] != nt):
+        raise IOError('Traces of unequal length: %s' % filename)
+
+    if mmap:
+        return Gather(records['data'], records['header'])
+    else:
+        data = np.ascontiguousarray(records['data'], dtype='float32')
+        return Gather(data, records['header'].copy())
+
+
+def write(gather, filename, byteorder='<'):
+    """ Writes Gather to Seismic Unix file
+    """
+    nrec, nt = gather.data.shape
+    dtype = header_dtype(byteorder)
+
+    records = np.empty(nrec, dtype=_record_dtype(dtype, nt, byteorder))
+    records['header'] = gather.headers.astype(dtype)
+    records['header']['number_of_samples_in_this_trace'] = nt
+    records['data'] = gather.data
+
+    detach(filename)
+    records.tofile(filename)
+
+
+def _record_dtype(dtype, nt, byteorder):
+    return np.dtype([('header', dtype), ('data', byteorder+'f4', (nt,))])
+
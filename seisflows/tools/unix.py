@@ -1,6 +1,7 @@
 
 import os
 import errno
+import fcntl
 import random
 import shutil
 import socket
@@ -8,7 +9,8 @@ import subprocess
 import sys
 import time
 
-from os.path import abspath, basename, isdir, isfile, join
+from os.path import abspath, basename, exists, isdir, isfile, islink, join
+from os.path import realpath
 from seisflows.tools.tools import iterable
 
 
@@ -52,6 +54,17 @@ def cp(src='', dst=''):
         shutil.copytree(src, dst)
 
 
+def detach(filename):
+    """ Removes FILENAME if it is a symbolic link or shares its data with other
+      hard links, so that a subsequent write creates a private file instead of
+      modifying the shared one
+    """
+    if islink(filename):
+        os.remove(filename)
+    elif isfile(filename) and os.stat(filename).st_nlink > 1:
+        os.remove(filename)
+
+
 def hostname():
     return socket.gethostname().split('.')[0]
 
@@ -75,6 +88,25 @@ def ls(path):
     return dirs
 
 
+def mark_complete(path, filenames):
+    """ Records that FILENAMES in directory PATH have been completely written
+
+      The names and sizes of the files are written to a manifest, which only
+      appears under its final name once it has been written in full
+    """
+    lines = []
+    for filename in iterable(filenames):
+        size = os.path.getsize(join(path, basename(filename)))
+        lines += ['%s %d\n' % (basename(filename), size)]
+
+    tmpfile = join(path, '.'+_MANIFEST+'.tmp')
+    with open(tmpfile, 'w') as file:
+        file.writelines(lines)
+        file.flush()
+        os.fsync(file.fileno())
+    os.rename(tmpfile, join(path, _MANIFEST))
+
+
 def mkdir(dirs):
     #time.sleep(2.0 * random.random())
     for dir in iterable(dirs):
@@ -135,12 +167,73 @@ def select(items, prompt=''):
             return items[reply - 1]
 
 
+def transfer(src='', dst='', method='copy'):
+    """ Transfers files or directories in the same way as cp, using one of
+      several methods
+
+        copy - independent copies
+        reflink - copy-on-write clones where supported by the filesystem,
+            otherwise independent copies
+        hardlink - hard links, or copies where linking is not possible
+        symlink - symbolic links to absolute source paths
+
+      Linked files should only be modified after calling detach on them
+    """
+    if method == 'copy':
+        cp(src, dst)
+        return
+
+    if method not in ['reflink', 'hardlink', 'symlink']:
+        raise ValueError('Bad transfer method: %s' % method)
+
+    if isinstance(src, (list, tuple)):
+        if len(src) > 1:
+            assert isdir(dst)
+
+        for sub in src:
+            transfer(sub, dst, method)
+        return
+
+    if isdir(dst):
+        dst = join(dst, basename(src))
+
+    if isfile(src):
+        _transfer_file(src, dst, method)
+
+    elif isdir(src):
+        mkdir(dst)
+        for sub in ls(src):
+            transfer(join(src, sub), dst, method)
+
+
 def touch(filename, times=None):
     with open(filename, 'a'):
         os.utime(filename, times)
 
 
 
+def wait_complete(paths, timeout=None):
+    """ Waits until every directory in PATHS has been marked complete and all
+      files listed in its manifest are present with their recorded sizes
+
+      Returns as soon as this is the case, without a fixed delay. Raises an
+      exception if TIMEOUT seconds pass first
+    """
+    pending = list(iterable(paths))
+    start = time.time()
+    interval = 0.01
+    while True:
+        pending = [path for path in pending if not _is_complete(path)]
+        if not pending:
+            return
+
+        if timeout is not None and time.time()-start > timeout:
+            raise Exception('Timed out waiting for %s' % pending[0])
+
+        time.sleep(interval)
+        interval = min(2.*interval, 1.)
+
+
 def which(name):
     def isexe(file):
         return os.path.isfile(file) and os.access(file, os.X_OK)
@@ -158,3 +251,61 @@ def which(name):
     else:
         return None
 
+
+
+### utility functions
+
+# name of manifest written by mark_complete
+_MANIFEST = '.complete'
+
+# ioctl request for cloning files on Linux (btrfs, xfs, ...)
+_FICLONE = 0x40049409
+
+
+def _transfer_file(src, dst, method):
+    # link to the underlying file rather than to another link
+    src = realpath(src)
+
+    # removing DST would destroy SRC if both resolve to the same file, so
+    # fail as shutil.copy does when cp is asked to copy a file onto itself
+    if src == realpath(dst):
+        raise shutil.Error('%s and %s are the same file' % (src, dst))
+
+    if exists(dst) or islink(dst):
+        os.remove(dst)
+
+    if method == 'symlink':
+        os.symlink(src, dst)
+        return
+
+    if method == 'hardlink':
+        try:
+            os.link(src, dst)
+        except OSError:
+            # e.g. source and destination on different filesystems
+            shutil.copy(src, dst)
+        return
+
+    if method == 'reflink':
+        try:
+            with open(src, 'rb') as fsrc:
+                with open(dst, 'wb') as fdst:
+                    fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+            shutil.copymode(src, dst)
+        except (IOError, OSError):
+            # filesystem does not support cloning
+            shutil.copy(src, dst)
+
+
+def _is_complete(path):
+    try:
+        with open(join(path, _MANIFEST), 'r') as file:
+            lines = file.readlines()
+        for line in lines:
+            filename, size = line.split()
+            if os.path.getsize(join(path, filename)) != int(size):
+                return False
+    except (IOError, OSError):
+        # manifest or listed files not yet visible
+        return False
+    return True
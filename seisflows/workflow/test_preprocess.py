@@ -6,6 +6,7 @@ import numpy as np
 from glob import glob
 from os.path import abspath, basename, dirname, exists
 from seisflows.config import ParameterError
+from seisflows.tools import unix
 from seisflows.workflow.base import base
 
 PAR = sys.modules['seisflows_parameters']
@@ -50,6 +51,13 @@ class test_preprocess(base):
         if PATH.SYNTHETICS:
             assert exists(PATH.SYNTHETICS)
 
+        # solver directories, one per source, preprocessed offline
+        if 'SOLVER' not in PATH:
+            setattr(PATH, 'SOLVER', '')
+
+        if PATH.SOLVER:
+            assert exists(PATH.SOLVER)
+
         if 'WORKDIR' not in PATH:
             setattr(PATH, 'WORKDIR', abspath('.'))
 
@@ -97,6 +105,12 @@ class test_preprocess(base):
             print 'testing adjoint...'
             self.test_adjoint(dat, syn)
 
+        if PAR.MISFIT and \
+           PATH.SOLVER:
+
+            print 'testing offline preprocessing...'
+            self.test_prepare_eval_grad()
+
         print 'SUCCESS\n'
 
 
@@ -195,12 +209,7 @@ class test_preprocess(base):
 
 
     def test_misfit(self, dat, syn):
-        nt, dt, _ = preprocess.get_time_scheme(syn)
-        nn, _ = preprocess.get_network_size(syn)
-
-        rsd = []
-        for ii in range(nn):
-            rsd.append(preprocess.misfit(syn[ii].data, dat[ii].data, nt, dt))
+        rsd = preprocess.get_residuals(syn, dat)
 
 
         filename = PATH.WORKDIR+'/'+'output_misfit'
@@ -210,18 +219,43 @@ class test_preprocess(base):
 
 
     def test_adjoint(self, dat, syn):
-        nt, dt, _ = preprocess.get_time_scheme(syn)
-        nn, _ = preprocess.get_network_size(syn)
-
         adj = syn
-        for ii in range(nn):
-            adj[ii].data = preprocess.adjoint(syn[ii].data, dat[ii].data, nt, dt)
+        adj.data = preprocess.get_adjoint_traces(syn, dat)
 
         self.save(adj, 'output_adjoint')
 
         print ''
 
 
+    def test_prepare_eval_grad(self):
+        try:
+            paths = sorted(dirname(dirname(path)) for path in
+                glob(PATH.SOLVER+'/'+'*/traces/syn'))
+            if not paths:
+                raise Exception('No synthetics found in %s' % PATH.SOLVER)
+
+            filenames = sorted(basename(filename) for filename in
+                glob(paths[0]+'/'+'traces/syn/*'))
+
+            for path in paths:
+                unix.rm(path+'/'+'residuals')
+                unix.mkdir(path+'/'+'traces/adj')
+
+            preprocess.prepare_eval_grad_sources(paths, filenames)
+
+        except Exception,e:
+            print 'offline preprocessing FAILED\n'
+            print e.message
+            print e.__class__.__name__
+            traceback.print_exc(e)
+            sys.exit(-1)
+
+        else:
+            print ' %d sources, misfit %e' % (len(paths),
+                preprocess.sum_residuals([path+'/'+'residuals' for path in paths]))
+            print ''
+
+
     def save(self, data, filename):
         if PAR.FORMAT in ['SU', 'su']:
             extension = '.su'
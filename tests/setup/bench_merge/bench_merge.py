@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+""" Benchmarks conversion between dictionary and vector representations of
+  models (solver.merge, solver.split) for increasing numbers of mesh slices
+"""
+
+import sys
+import time
+
+import numpy as np
+
+from seisflows.config import Dict, Null
+from seisflows.tools.tools import Struct
+
+
+# load dummy state
+sys.modules['seisflows_parameters'] = Dict({
+    'MATERIALS': 'Elastic',
+    'DENSITY': 'Constant',
+    'MMAP': False})
+sys.modules['seisflows_paths'] = Dict({})
+for name in ['system', 'preprocess']:
+    sys.modules['seisflows_'+name] = Null()
+
+from seisflows.solver.base import base
+
+
+NGLL = 2000
+NPROC = [1, 4, 16, 64, 256, 1024]
+
+
+def merge_legacy(solver, model):
+    # reference implementation based on repeated np.append
+    m = np.array([])
+    for key in solver.parameters:
+        for iproc in range(solver.mesh_properties.nproc):
+            m = np.append(m, model[key][iproc])
+    return m
+
+
+def timeit(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+if __name__ == '__main__':
+    print '%8s  %10s  %10s  %10s  %10s' % \
+        ('nproc', 'ngll', 'merge', 'split', 'legacy')
+
+    for nproc in NPROC:
+        ngll = [NGLL]*nproc
+        solver = base()
+        solver._mesh_properties = Struct([
+            ['nproc', nproc],
+            ['ngll', ngll],
+            ['offsets', np.cumsum([0]+ngll)]])
+
+        model = {}
+        for key in solver.parameters:
+            model[key] = [np.random.rand(n).astype('float32') for n in ngll]
+
+        t1, m = timeit(solver.merge, model)
+        t2, _ = timeit(solver.split, m)
+        t3, m0 = timeit(merge_legacy, solver, model)
+        assert np.array_equal(m, m0)
+
+        print '%8d  %10d  %10.4f  %10.4f  %10.4f' % \
+            (nproc, sum(ngll), t1, t2, t3)
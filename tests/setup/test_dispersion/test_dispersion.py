@@ -47,6 +47,23 @@ class TestDispersionCode(unittest.TestCase):
         self.assertEqual(fmax_idx, 41)
 
 
+    def test_phase_shift(self):
+        # vectorized transform must match direct sums over receivers
+        nr, nf = 12, 30
+        U = np.random.randn(nr, nf) + 1.0j*np.random.randn(nr, nf)
+        f = np.linspace(1.0, 100.0, nf)
+        x = np.linspace(0.0, 110.0, nr)
+        p = 1.0/np.arange(100.0, 1000.0, 50.0)
+
+        for nthreads in [1, 3]:
+            Upf = dispersion.phase_shift(U, f, x, p, 10.0, nthreads, chunk=500)
+            for fi in range(nf):
+                for pi in range(len(p)):
+                    k = 2.0*np.pi*f[fi]*p[pi]
+                    self.assertAlmostEqual(Upf[pi,fi],
+                        np.dot(10.0*np.exp(1.0j*k*x), U[:,fi]))
+
+
     @staticmethod
     def read_ascii(path, NR, nt):
         dat_type = 'semd'
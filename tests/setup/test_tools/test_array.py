@@ -0,0 +1,134 @@
+import unittest
+
+import os
+import shutil
+from tempfile import mkdtemp
+
+import numpy as np
+import scipy.interpolate
+import scipy.signal
+
+from seisflows.tools import array
+
+
+class TestToolsArray(unittest.TestCase):
+    def setUp(self):
+        self.mesh = 100.*np.random.rand(400, 2)
+
+    def tearDown(self):
+        pass
+
+    def test_gridsmooth(self):
+        Z = np.random.randn(20, 30)
+
+        # compare with direct 2D convolution; standard deviation is half
+        # the span
+        k = np.arange(-4, 5)
+        F = np.exp(-0.5*(k[:,None]**2 + k[None,:]**2)/2.**2)
+        ref = scipy.signal.convolve2d(Z, F, 'same') /\
+              scipy.signal.convolve2d(np.ones(Z.shape), F, 'same')
+        self.assertTrue(np.allclose(array.gridsmooth(Z, 4.), ref))
+
+        # anisotropic spans smooth along each axis independently
+        Z = np.random.randn(6, 7, 8)
+        out = array.gridsmooth(Z, (0., 0., 3.))
+        for i in range(6):
+            for j in range(7):
+                self.assertTrue(np.allclose(out[i,j],
+                    array.gridsmooth(Z[i,j][None,:], (0., 3.))[0]))
+
+    def test_smoothing_operator(self):
+        sigma = 10.
+        G = array.smoothing_operator(self.mesh, sigma)
+
+        # compare with dense Gaussian weights, truncated at three sigma
+        d = np.sqrt(np.sum((self.mesh[:,None] - self.mesh[None])**2, axis=2))
+        W = np.exp(-0.5*d**2/sigma**2)
+        W[d > 3.*sigma] = 0.
+        W /= W.sum(axis=1)[:,None]
+        self.assertTrue(np.allclose(G.toarray(), W, atol=1.e-6))
+
+        # constants must be preserved
+        self.assertTrue(np.allclose(G.dot(np.ones(len(self.mesh))), 1.))
+
+    def test_gaussian_masks(self):
+        points = np.array([[20., 30.], [70., 50.]])
+        masks = array.gaussian_masks(self.mesh, points, 5.).toarray()
+
+        for mask, (x, z) in zip(masks, points):
+            d2 = (self.mesh[:,0]-x)**2 + (self.mesh[:,1]-z)**2
+            ref = np.exp(-0.5*d2/5.**2)
+            ref[d2 > 30.**2] = 0.
+            self.assertTrue(np.allclose(mask, ref))
+
+    def test_geometry(self):
+        geometry = array.MeshGeometry([self.mesh[:,0], self.mesh[:,1]],
+            [0, 150, 400])
+
+        self.assertEqual(geometry.nproc, 2)
+        self.assertTrue(np.array_equal(geometry.slice(1), self.mesh[150:]))
+        self.assertTrue(np.array_equal(geometry.bounds[:,0],
+            self.mesh.min(axis=0)))
+        self.assertIs(geometry.tree, geometry.tree)
+
+        # coordinates must be usable by scipy interpolation routines
+        v = np.random.rand(len(self.mesh))
+        scipy.interpolate.griddata(geometry.mesh, v, geometry.slice(1))
+        array.grid2mesh(*array.mesh2grid(v, geometry.mesh) + (geometry.mesh,))
+
+        for i, n in enumerate(geometry.neighbours(self.mesh[:3], 10.)):
+            d = np.sqrt(np.sum((self.mesh - self.mesh[i])**2, axis=1))
+            self.assertEqual(sorted(n), list(np.where(d <= 10.)[0]))
+
+    def test_mask_average(self):
+        # must match masks applied over the whole mesh, one at a time
+        v = np.random.randn(len(self.mesh))
+        x, z = self.mesh[:,0], self.mesh[:,1]
+
+        separated = np.array([[20., 20.], [80., 80.]])
+        overlapping = np.array([[40., 50.], [45., 50.], [50., 52.]])
+        for points in [separated, overlapping]:
+            ref = v.copy()
+            for px, pz in points:
+                mask = np.exp(-0.5*((x-px)**2 + (z-pz)**2)/5.**2)
+                weight = np.sum(mask*ref)/np.sum(mask)
+                ref = (1.-mask)*ref + mask*weight
+
+            masks = array.gaussian_masks(self.mesh, points, 5.)
+            self.assertTrue(np.allclose(array.mask_average(v, masks), ref,
+                atol=1.e-6))
+
+    def test_interpolation(self):
+        # cached operators must match direct interpolation
+        v = np.sin(self.mesh[:,0]/20.) + np.cos(self.mesh[:,1]/30.)
+        V, grid = array.mesh2grid(v, self.mesh)
+
+        ref = scipy.interpolate.griddata(self.mesh, v, grid, 'linear')
+        inside = ~np.isnan(ref)
+        self.assertTrue(np.allclose(V.flatten()[inside], ref[inside]))
+
+        ref = scipy.interpolate.griddata(grid, V.flatten(), self.mesh, 'linear')
+        self.assertTrue(np.allclose(array.grid2mesh(V, grid, self.mesh), ref))
+
+        self.assertIs(array.get_interpolator(self.mesh),
+            array.get_interpolator(self.mesh.copy()))
+
+    def test_interpolator_persistence(self):
+        # interpolators saved by one process must be usable by another
+        path = mkdtemp()
+        try:
+            v = np.random.rand(len(self.mesh))
+            V = array.get_interpolator(self.mesh, path).mesh2grid(v)
+            self.assertEqual(len(os.listdir(path)), 1)
+
+            array._interpolators.clear()
+            interpolator = array.get_interpolator(self.mesh, path)
+            self.assertTrue(np.array_equal(interpolator.mesh2grid(v), V))
+            self.assertTrue(np.array_equal(interpolator.grid2mesh(V),
+                array.MeshInterpolator(self.mesh).grid2mesh(V)))
+        finally:
+            shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
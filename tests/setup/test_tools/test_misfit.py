@@ -0,0 +1,88 @@
+import unittest
+
+import numpy as np
+
+from seisflows.plugins import adjoint, misfit
+
+
+class TestPluginsMisfit(unittest.TestCase):
+    def setUp(self):
+        nr, nt, dt = 5, 500, 1.e-3
+        t = np.arange(nt)*dt
+
+        def wavelet(t0):
+            return np.sin(2*np.pi*20*(t-t0))*np.exp(-((t-t0)/0.05)**2)
+
+        self.syn = np.array([wavelet(0.20+0.010*ir) for ir in range(nr)])
+        self.obs = np.array([wavelet(0.21+0.012*ir) for ir in range(nr)])
+        self.time_scheme = (nt, dt)
+
+    def tearDown(self):
+        pass
+
+    def test_batched(self):
+        # results for arrays of traces must match those for single traces
+        nt, dt = self.time_scheme
+        for name in ['Waveform', 'Envelope', 'InstantaneousPhase',
+                     'Traveltime', 'TraveltimeInexact', 'Amplitude',
+                     'Envelope3', 'InstantaneousPhase2']:
+            rsd = getattr(misfit, name)(self.syn, self.obs, nt, dt)
+            adj = getattr(adjoint, name)(self.syn, self.obs, nt, dt)
+            self.assertEqual(rsd.shape, (len(self.syn),))
+            self.assertEqual(adj.shape, self.syn.shape)
+
+            for ir, (syn, obs) in enumerate(zip(self.syn, self.obs)):
+                self.assertTrue(np.allclose(rsd[ir],
+                    getattr(misfit, name)(syn, obs, nt, dt)))
+                self.assertTrue(np.allclose(adj[ir],
+                    getattr(adjoint, name)(syn, obs, nt, dt)))
+
+    def test_scratch(self):
+        # adjoint traces must not depend on intermediate results being shared
+        nt, dt = self.time_scheme
+        for name in ['Envelope', 'InstantaneousPhase', 'Traveltime',
+                     'Amplitude', 'Envelope3', 'InstantaneousPhase2']:
+            scratch = {}
+            rsd = getattr(misfit, name)(self.syn, self.obs, nt, dt,
+                scratch=scratch)
+            adj = getattr(adjoint, name)(self.syn, self.obs, nt, dt,
+                scratch=scratch)
+            self.assertTrue(scratch)
+            self.assertTrue(np.allclose(rsd,
+                getattr(misfit, name)(self.syn, self.obs, nt, dt)))
+            self.assertTrue(np.allclose(adj,
+                getattr(adjoint, name)(self.syn, self.obs, nt, dt)))
+
+    def test_dispersion(self):
+        # adjoint traces must be the gradient of half the squared residuals
+        nt, dt = self.time_scheme
+        kwargs = {'x': 10.*np.arange(len(self.syn)),
+                  'c': np.arange(200., 2000., 50.),
+                  'fmin': 5., 'fmax': 60.}
+
+        # noise avoids zeros of the phase-shift transform, where the image
+        # is not differentiable
+        np.random.seed(0)
+        syn = self.syn + 0.1*np.random.randn(*self.syn.shape)
+        obs = self.obs + 0.1*np.random.randn(*self.obs.shape)
+
+        def misfit_function(syn):
+            rsd = misfit.Dispersion(syn, obs, nt, dt, **kwargs)
+            return 0.5*np.sum(rsd**2)
+
+        adj = adjoint.Dispersion(syn, obs, nt, dt, **kwargs)
+        self.assertEqual(adj.shape, syn.shape)
+
+        dsyn = 1.e-6*np.random.randn(*syn.shape)
+        df = misfit_function(syn + dsyn) - misfit_function(syn - dsyn)
+        self.assertAlmostEqual(df/np.sum(2.*adj*dsyn), 1., places=3)
+
+    def test_traveltime(self):
+        nt, dt = self.time_scheme
+        rsd = misfit.Traveltime(self.syn, self.obs, nt, dt)
+        lags = 0.01 + 0.002*np.arange(len(self.syn))
+        self.assertTrue(np.allclose(rsd, lags, atol=dt))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import unittest
+
+import os
+import shutil
+import sys
+from tempfile import mkdtemp
+
+import numpy as np
+
+from seisflows.config import Dict, Null
+
+
+# load dummy state
+PAR = Dict({
+    'FORMAT': 'su',
+    'MISFIT': 'Envelope',
+    'NORMALIZE': [],
+    'MUTE': [],
+    'FILTER': None,
+    'NT': 200,
+    'DT': 1.e-3,
+    'NTASK': 1,
+    'PREPROCESS_PARALLEL': True,
+    'NPROCMAX': 4,
+    'NPROC': 1,
+    'NTASKMAX': 2})
+sys.modules['seisflows_parameters'] = PAR
+sys.modules['seisflows_paths'] = Dict({})
+for name in ['system', 'workflow']:
+    sys.modules['seisflows_'+name] = Null()
+
+CHANNELS = ['U%s_file_single.su' % c for c in 'xyz']
+sys.modules['seisflows_solver'] = Dict({'data_filenames': CHANNELS})
+
+from seisflows.preprocess.base import base
+from seisflows.tools import residuals, su
+
+
+class TestPreprocessBase(unittest.TestCase):
+    def setUp(self):
+        self.preprocess = base()
+        self.preprocess.check()
+        self.preprocess.setup()
+
+        nrec, nt = 5, PAR.NT
+        headers = np.zeros(nrec, dtype=su.header_dtype())
+        headers['trace_sequence_number_within_line'] = np.arange(1, nrec+1)
+        headers['sample_interval_in_ms_for_this_trace'] = 1000
+        headers['group_coordinate_x'] = 100*np.arange(nrec)
+
+        self.paths = []
+        for _ in range(2):
+            path = mkdtemp()
+            for name in ['obs', 'syn', 'adj']:
+                os.makedirs(path+'/'+'traces/'+name)
+            for channel in CHANNELS:
+                for name in ['obs', 'syn']:
+                    data = np.random.randn(nrec, nt).astype('float32')
+                    su.write(su.Gather(data, headers.copy()),
+                        path+'/'+'traces/'+name+'/'+channel)
+            self.paths += [path]
+
+        # second directory holds a copy of the first
+        shutil.rmtree(self.paths[1])
+        shutil.copytree(self.paths[0], self.paths[1])
+
+    def tearDown(self):
+        for path in self.paths:
+            shutil.rmtree(path)
+
+    def test_nworkers(self):
+        # solver task cores plus a share of those left over, capped by jobs
+        self.assertEqual(self.preprocess.get_nworkers(10), 2)
+        self.assertEqual(self.preprocess.get_nworkers(1), 1)
+        self.assertEqual(self.preprocess.get_nworkers(10, concurrent=False), 4)
+
+        # parameters are read-only once defined
+        PAR.__dict__['PREPROCESS_PARALLEL'] = False
+        try:
+            self.assertEqual(self.preprocess.get_nworkers(10), 1)
+        finally:
+            PAR.__dict__['PREPROCESS_PARALLEL'] = True
+
+    def test_prepare_eval_grad(self):
+        # pooled and serial processing must give identical results
+        serial, pooled = self.paths
+        self.preprocess.map('prepare_channel',
+            [(serial, channel) for channel in CHANNELS], 1)
+        self.preprocess.prepare_eval_grad(pooled)
+        self.assertTrue(self.preprocess.get_nworkers(len(CHANNELS)) > 1)
+
+        for channel in CHANNELS:
+            self.assertTrue(np.array_equal(
+                residuals.load(serial+'/'+'residuals', channel),
+                residuals.load(pooled+'/'+'residuals', channel)))
+            self.assertTrue(np.array_equal(
+                su.read(serial+'/'+'traces/adj/'+channel).data,
+                su.read(pooled+'/'+'traces/adj/'+channel).data))
+
+
+if __name__ == '__main__':
+    unittest.main()
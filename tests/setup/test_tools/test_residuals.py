@@ -0,0 +1,51 @@
+import unittest
+
+import os
+import shutil
+from tempfile import mkdtemp
+
+import numpy as np
+
+from seisflows.tools import residuals
+
+
+class TestToolsResiduals(unittest.TestCase):
+    def setUp(self):
+        self.path = mkdtemp()
+        self.filename = os.path.join(self.path, 'residuals')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_append(self):
+        ux = np.random.randn(5)
+        uz = np.random.randn(3)
+        residuals.append(self.filename, ux, 'Ux_file_single.su')
+        residuals.append(self.filename, uz, 'Uz_file_single.su')
+
+        self.assertEqual(residuals.channels(self.filename),
+            ['Ux_file_single.su', 'Uz_file_single.su'])
+        self.assertTrue(np.array_equal(residuals.load(self.filename),
+            np.concatenate([ux, uz])))
+        self.assertTrue(np.array_equal(
+            residuals.load(self.filename, 'Uz_file_single.su'), uz))
+        self.assertAlmostEqual(residuals.sum_squares(self.filename),
+            np.sum(ux**2) + np.sum(uz**2))
+
+    def test_long_channel(self):
+        with self.assertRaises(ValueError):
+            residuals.append(self.filename, np.ones(4), 'x'*33)
+        residuals.append(self.filename, np.ones(4), 'x'*32)
+        self.assertEqual(residuals.channels(self.filename), ['x'*32])
+
+    def test_truncated(self):
+        residuals.append(self.filename, np.ones(4))
+        with open(self.filename, 'ab') as file:
+            file.write(b'\0'*10)
+        with self.assertRaises(IOError):
+            residuals.sum_squares(self.filename)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
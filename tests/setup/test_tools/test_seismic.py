@@ -0,0 +1,133 @@
+
+import unittest
+
+import os
+import shutil
+from tempfile import mkdtemp
+
+import numpy as np
+
+from seisflows.tools.seismic import ModelDict, Parfile, SliceArray, getpar, \
+    setpar
+
+
+class TestToolsSeismic(unittest.TestCase):
+    def setUp(self):
+        self.ngll = [3, 5, 2]
+        self.slices = [np.arange(n, dtype='float32') + 10*i
+                       for i, n in enumerate(self.ngll)]
+
+    def tearDown(self):
+        pass
+
+    def test_slicearray_preallocated(self):
+        a = SliceArray(self.ngll)
+        for iproc, val in enumerate(self.slices):
+            a[iproc] = val
+        self.assertEqual(len(a), 3)
+        self.assertEqual(a.data.dtype, np.float32)
+        self.assertTrue(np.array_equal(a.data, np.concatenate(self.slices)))
+        self.assertEqual(a.minmax, [0., 21.])
+
+        # slices are views into contiguous buffer
+        a[1][:] = -1.
+        self.assertTrue(np.all(a.data[3:8] == -1.))
+
+    def test_slicearray_append(self):
+        a = SliceArray()
+        for val in self.slices:
+            a += [val]
+        self.assertEqual(list(np.diff(a.offsets)), self.ngll)
+        for iproc, val in enumerate(self.slices):
+            self.assertTrue(np.array_equal(a[iproc], val))
+        self.assertEqual(a.minmax, [0., 21.])
+
+    def test_slicearray_wrap(self):
+        v = np.arange(10.)
+        a = SliceArray(self.ngll, data=v)
+        a[2][:] = 0.
+        self.assertTrue(np.all(v[8:] == 0.))
+        self.assertEqual(a.minmax, [0., 7.])
+
+    def test_modeldict_arithmetic(self):
+        m = ModelDict()
+        g = ModelDict()
+        for key in ['vp', 'vs']:
+            m[key] = SliceArray(self.ngll, data=np.ones(10))
+            g[key] = SliceArray(self.ngll, data=np.arange(10.))
+
+        h = g*m*2.
+        self.assertTrue(np.array_equal(h['vp'].data, 2.*np.arange(10.)))
+        self.assertEqual(list(h['vs'].offsets), list(g['vs'].offsets))
+
+        g *= 3.
+        g -= m
+        self.assertTrue(np.array_equal(g['vs'].data, 3.*np.arange(10.)-1.))
+        self.assertEqual(g.minmax('vs'), [-1., 26.])
+
+        del m['vs']
+        with self.assertRaises(KeyError):
+            g + m
+
+
+class TestToolsParfile(unittest.TestCase):
+    def setUp(self):
+        self.path = mkdtemp()
+        self.filename = os.path.join(self.path, 'Par_file')
+        with open(self.filename, 'w') as file:
+            file.writelines([
+                '# simulation\n',
+                'NSTEP_BETWEEN_OUTPUT_INFO = 100\n',
+                'NSTEP                     = 1000      # number of steps\n',
+                'DT                        = 1.1d-3\n',
+                'SIMULATION_TYPE           = 1\n',
+                'SAVE_FORWARD              = .false.\n'])
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_getpar(self):
+        # keys must match exactly, not as prefixes
+        self.assertEqual(getpar('NSTEP', self.filename, cast=int), 1000)
+        self.assertAlmostEqual(getpar('DT', self.filename, cast=float), 1.1e-3)
+
+    def test_setpar(self):
+        setpar('NSTEP', 2000, self.filename)
+        self.assertEqual(getpar('NSTEP', self.filename, cast=int), 2000)
+        self.assertEqual(
+            getpar('NSTEP_BETWEEN_OUTPUT_INFO', self.filename, cast=int), 100)
+
+        # comments keep their position
+        with open(self.filename, 'r') as file:
+            lines = file.readlines()
+        self.assertEqual(lines[2],
+            'NSTEP                     = 2000      # number of steps\n')
+
+    def test_batch(self):
+        with Parfile(self.filename) as parfile:
+            parfile['SIMULATION_TYPE'] = 3
+            parfile['SAVE_FORWARD'] = '.true.'
+
+            # nothing is written before leaving the block
+            self.assertEqual(getpar('SIMULATION_TYPE', self.filename), '1')
+
+        parfile = Parfile(self.filename)
+        self.assertEqual(parfile['SIMULATION_TYPE'], '3')
+        self.assertEqual(parfile['SAVE_FORWARD'], '.true.')
+        self.assertFalse(os.path.exists(self.filename+'.tmp'))
+
+    def test_missing(self):
+        # setting a key absent from the file must leave it absent
+        parfile = Parfile(self.filename)
+        parfile['MISSING'] = 1
+        self.assertFalse('MISSING' in parfile)
+        self.assertFalse(parfile.modified)
+        with self.assertRaises(KeyError):
+            parfile['MISSING']
+        with self.assertRaises(Exception) as cm:
+            parfile.get('MISSING')
+        self.assertNotIsInstance(cm.exception, IndexError)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,7 @@
 import unittest
 
 import numpy as np
+import obspy
 
 from seisflows.tools import signal
 
@@ -31,6 +32,64 @@ class TestSeistoolsSignal(unittest.TestCase):
         # check monotonicity
         assert(np.all(np.diff(w) >= 0))
 
+        # one row per offset, each matching the single-offset mask
+        offsets = np.array([0., 10., 20.])
+        w = signal.mask(1.e-3, const, offsets, (nt, dt, t1), length=10)
+        self.assertEqual(w.shape, (3, nt))
+        for ir, offset in enumerate(offsets):
+            self.assertTrue(np.array_equal(w[ir],
+                signal.mask(1.e-3, const, offset, (nt, dt, t1), length=10)))
+
+    def test_filter(self):
+        # batched processing must match obspy's per-trace processing
+        nr, nt, dt = 10, 1000, 1.e-3
+        data = np.random.randn(nr, nt).astype('float32')
+
+        stream = obspy.Stream([obspy.Trace(data[ir].copy(),
+            header={'delta': dt}) for ir in range(nr)])
+        for tr in stream:
+            tr.detrend('demean')
+            tr.detrend('linear')
+            tr.taper(0.05, type='hann')
+            tr.filter('bandpass', freqmin=5., freqmax=50.)
+
+        out = signal.detrend(data.astype('float64'))
+        out = signal.taper(out, 0.05)
+        out = signal.bandpass(out, 5., 50., dt)
+
+        ref = np.array([tr.data for tr in stream])
+        self.assertTrue(np.allclose(out, ref, atol=1.e-6*abs(ref).max()))
+
+    def test_correlate(self):
+        u = np.random.randn(3, 200)
+        v = np.random.randn(3, 150)
+        w = signal.correlate(u, v)
+        for i in range(3):
+            self.assertTrue(np.allclose(w[i], np.convolve(u[i], v[i][::-1])))
+
+    def test_correlation_lag(self):
+        nt, dt = 400, 1.e-3
+        t = np.arange(nt)*dt
+        syn = np.exp(-((t-0.1)/0.01)**2)
+        obs = np.exp(-((t-0.1253)/0.01)**2)
+
+        lag = signal.correlation_lag(syn, obs, dt)
+        self.assertAlmostEqual(lag, 0.025)
+
+        lag = signal.correlation_lag(syn, obs, dt, subsample=True)
+        self.assertAlmostEqual(lag, 0.0253, delta=0.1*dt)
+
+    def test_correlation_lags(self):
+        nt, dt = 400, 1.e-3
+        t = np.arange(nt)*dt
+        traces = np.array([np.exp(-((t-t0)/0.01)**2)
+            for t0 in [0.10, 0.12, 0.15, 0.19]])
+        i, j = np.triu_indices(len(traces), 1)
+
+        lags = signal.correlation_lags(traces, i, j, dt)
+        self.assertTrue(np.allclose(lags,
+            signal.correlation_lag(traces[i], traces[j], dt)))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,143 @@
+
+import unittest
+
+import os
+import shutil
+from tempfile import mkdtemp
+
+import numpy as np
+
+from multiprocessing.pool import ThreadPool
+
+from seisflows.plugins.solver_io import adios, fortran_binary
+
+
+class TestSolverIOFortranBinary(unittest.TestCase):
+    def setUp(self):
+        self.path = mkdtemp()
+        self.v = np.arange(100, dtype='float32')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_readwrite(self):
+        fortran_binary.write_slice(self.v, self.path, 'vp', 0)
+        w = fortran_binary.read_slice(self.path, 'vp', 0)[0]
+        self.assertTrue(np.array_equal(self.v, w))
+
+    def test_mmap(self):
+        fortran_binary.write_slice(self.v, self.path, 'vp', 0)
+        w = fortran_binary.read_slice(self.path, 'vp', 0, mmap=True)[0]
+        self.assertTrue(np.array_equal(self.v, w))
+
+        # modifications must not be written back to disk
+        w *= 2.
+        u = fortran_binary.read_slice(self.path, 'vp', 0)[0]
+        self.assertTrue(np.array_equal(self.v, u))
+
+    def test_mmap_bad_marker(self):
+        filename = '%s/proc%06d_%s.bin' % (self.path, 0, 'vp')
+        fortran_binary._write(self.v, filename)
+        with open(filename, 'r+b') as f:
+            f.seek(-4, os.SEEK_END)
+            np.array([0], dtype='int32').tofile(f)
+        with self.assertRaises(IOError):
+            fortran_binary.read_slice(self.path, 'vp', 0, mmap=True)
+
+    def test_write_inplace(self):
+        fortran_binary.write_slice(self.v, self.path, 'vp', 0)
+        filename = '%s/proc%06d_%s.bin' % (self.path, 0, 'vp')
+        self.assertTrue(fortran_binary._write_inplace(-self.v, filename))
+        w = fortran_binary.read_slice(self.path, 'vp', 0)[0]
+        self.assertTrue(np.array_equal(-self.v, w))
+
+        # size mismatch falls back to regular write
+        self.assertFalse(fortran_binary._write_inplace(self.v[:10], filename))
+        fortran_binary.write_slice(self.v[:10], self.path, 'vp', 0, inplace=True)
+        w = fortran_binary.read_slice(self.path, 'vp', 0)[0]
+        self.assertTrue(np.array_equal(self.v[:10], w))
+
+    def test_write_inplace_hardlink(self):
+        fortran_binary.write_slice(self.v, self.path, 'vp', 0)
+        filename = '%s/proc%06d_%s.bin' % (self.path, 0, 'vp')
+        os.link(filename, self.path+'/'+'link.bin')
+        self.assertFalse(fortran_binary._write_inplace(-self.v, filename))
+
+
+class TestSolverIOAdios(unittest.TestCase):
+    def setUp(self):
+        self.path = mkdtemp()
+        self.v = np.arange(100, dtype='float32')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_readwrite(self):
+        for iproc in range(3):
+            for key in ['vp', 'vs']:
+                adios.write_slice(iproc*self.v, self.path, key, iproc)
+        self.assertEqual(os.listdir(self.path).count(adios.DATAFILE), 1)
+
+        for iproc in range(3):
+            for mmap in [False, True]:
+                w = adios.read_slice(self.path, 'vs', iproc, mmap=mmap)[0]
+                self.assertTrue(np.array_equal(iproc*self.v, w))
+
+        keys, vals = adios.mread(self.path, ['vs', 'vp'], 2)
+        self.assertEqual(keys, ['vp', 'vs'])
+        self.assertTrue(np.array_equal(vals[0], 2*self.v))
+
+    def test_overwrite(self):
+        filename = os.path.join(self.path, adios.DATAFILE)
+        adios.write_slice(self.v, self.path, 'vp', 0)
+        adios.write_slice(-self.v, self.path, 'vp', 0)
+
+        # slices are appended, and the later version is read back
+        self.assertEqual(os.path.getsize(filename), 2*4*len(self.v))
+        w = adios.read_slice(self.path, 'vp', 0)[0]
+        self.assertTrue(np.array_equal(-self.v, w))
+
+        adios.write_slice(self.v[:10], self.path, 'vp', 0)
+        w = adios.read_slice(self.path, 'vp', 0)[0]
+        self.assertTrue(np.array_equal(self.v[:10], w))
+
+    def test_linked(self):
+        # writing to a linked container must leave the original unchanged
+        src = os.path.join(self.path, 'src')
+        os.mkdir(src)
+        adios.write_slice(self.v, src, 'vp', 0)
+
+        for link in [os.link, os.symlink]:
+            dst = os.path.join(self.path, link.__name__)
+            os.mkdir(dst)
+            for name in [adios.DATAFILE, adios.INDEXFILE]:
+                link(os.path.join(src, name), os.path.join(dst, name))
+
+            adios.write_slice(-self.v, dst, 'vp', 0)
+            self.assertTrue(np.array_equal(
+                adios.read_slice(dst, 'vp', 0)[0], -self.v))
+            self.assertTrue(np.array_equal(
+                adios.read_slice(src, 'vp', 0)[0], self.v))
+            self.assertEqual(os.path.getsize(
+                os.path.join(src, adios.DATAFILE)), 4*len(self.v))
+
+    def test_fallback(self):
+        fortran_binary.write_slice(self.v, self.path, 'x', 0)
+        self.assertTrue(adios.exists_slice(self.path, 'x', 0))
+        self.assertFalse(adios.exists_slice(self.path, 'x', 1))
+        w = adios.read_slice(self.path, 'x', 0)[0]
+        self.assertTrue(np.array_equal(self.v, w))
+
+    def test_concurrent_write(self):
+        def write(iproc):
+            adios.write_slice(iproc*self.v, self.path, 'vp', iproc)
+        pool = ThreadPool(8)
+        pool.map(write, range(32))
+        pool.close()
+        for iproc in range(32):
+            w = adios.read_slice(self.path, 'vp', iproc)[0]
+            self.assertTrue(np.array_equal(iproc*self.v, w))
+
+
+if __name__ == '__main__':
+    unittest.main()
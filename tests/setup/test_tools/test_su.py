@@ -0,0 +1,67 @@
+import unittest
+
+import os
+import shutil
+from tempfile import mkdtemp
+
+import numpy as np
+import obspy
+
+from seisflows.tools import su
+
+
+class TestToolsSU(unittest.TestCase):
+    def setUp(self):
+        self.path = mkdtemp()
+        self.filename = os.path.join(self.path, 'Uy_file_single.su')
+
+        nrec, nt = 5, 100
+        headers = np.zeros(nrec, dtype=su.header_dtype())
+        headers['trace_sequence_number_within_line'] = np.arange(1, nrec+1)
+        headers['sample_interval_in_ms_for_this_trace'] = 1000
+        headers['group_coordinate_x'] = 100*np.arange(nrec)
+        headers['source_coordinate_x'] = 250
+        data = np.random.randn(nrec, nt).astype('float32')
+        self.gather = su.Gather(data, headers)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_readwrite(self):
+        su.write(self.gather, self.filename)
+
+        for mmap in [False, True]:
+            d = su.read(self.filename, mmap=mmap)
+            self.assertTrue(np.array_equal(d.data, self.gather.data))
+            self.assertEqual(d.nt, 100)
+            self.assertAlmostEqual(d.dt, 1.e-3)
+
+    def test_obspy(self):
+        # files must be interchangeable with those read by obspy
+        su.write(self.gather, self.filename)
+        stream = obspy.read(self.filename, format='SU', byteorder='<')
+
+        self.assertEqual(len(stream), self.gather.nrec)
+        for ir, tr in enumerate(stream):
+            self.assertTrue(np.array_equal(tr.data, self.gather.data[ir]))
+            self.assertEqual(tr.stats.su.trace_header.group_coordinate_x,
+                             self.gather.receiver_coords()[0][ir])
+
+        for tr in stream:
+            tr.stats.delta = 2.e-3
+        stream.write(self.filename, format='SU')
+        d = su.read(self.filename)
+        self.assertTrue(np.array_equal(d.data, self.gather.data))
+        self.assertAlmostEqual(d.dt, 2.e-3)
+
+    def test_mmap_copy_on_write(self):
+        su.write(self.gather, self.filename)
+        d = su.read(self.filename, mmap=True)
+        d.data[:] = 0.
+
+        d = su.read(self.filename)
+        self.assertTrue(np.array_equal(d.data, self.gather.data))
+
+
+if __name__ == '__main__':
+    unittest.main()
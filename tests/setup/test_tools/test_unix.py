@@ -0,0 +1,93 @@
+import unittest
+
+import os
+import shutil
+from tempfile import mkdtemp
+
+from seisflows.tools import unix
+
+
+class TestUnixTransfer(unittest.TestCase):
+    def setUp(self):
+        self.path = mkdtemp()
+        self.src = os.path.join(self.path, 'src')
+        os.mkdir(self.src)
+        for name in ['a', 'b']:
+            with open(os.path.join(self.src, name), 'w') as file:
+                file.write(name)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _read(self, filename):
+        with open(filename, 'r') as file:
+            return file.read()
+
+    def test_methods(self):
+        for method in ['copy', 'reflink', 'hardlink', 'symlink']:
+            dst = os.path.join(self.path, method)
+            unix.transfer(self.src, dst, method)
+            self.assertEqual(sorted(os.listdir(dst)), ['a', 'b'])
+            self.assertEqual(self._read(os.path.join(dst, 'a')), 'a')
+
+        self.assertTrue(os.path.islink(os.path.join(self.path, 'symlink/a')))
+
+    def test_bad_method(self):
+        with self.assertRaises(ValueError):
+            unix.transfer(self.src, self.path+'/dst', 'move')
+
+    def test_detach(self):
+        for method in ['hardlink', 'symlink']:
+            dst = os.path.join(self.path, method)
+            unix.transfer(self.src, dst, method)
+
+            # writing to a detached file must leave the source unchanged
+            filename = os.path.join(dst, 'a')
+            unix.detach(filename)
+            with open(filename, 'w') as file:
+                file.write('c')
+
+            self.assertEqual(self._read(filename), 'c')
+            self.assertEqual(self._read(os.path.join(self.src, 'a')), 'a')
+
+    def test_same_file(self):
+        # transferring a file onto itself must leave it intact
+        filename = os.path.join(self.src, 'a')
+        link = os.path.join(self.path, 'link')
+        os.symlink(filename, link)
+
+        for method in ['copy', 'reflink', 'hardlink', 'symlink']:
+            for dst in [filename, link]:
+                with self.assertRaises(shutil.Error):
+                    unix.transfer(filename, dst, method)
+                self.assertEqual(self._read(filename), 'a')
+
+
+class TestUnixComplete(unittest.TestCase):
+    def setUp(self):
+        self.path = mkdtemp()
+        with open(os.path.join(self.path, 'vp_kernel.bin'), 'w') as file:
+            file.write('data')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_complete(self):
+        unix.mark_complete(self.path, ['vp_kernel.bin'])
+        unix.wait_complete([self.path], timeout=1.)
+
+    def test_timeout(self):
+        with self.assertRaises(Exception):
+            unix.wait_complete([self.path], timeout=0.05)
+
+    def test_incomplete(self):
+        unix.mark_complete(self.path, ['vp_kernel.bin'])
+
+        # file truncated after manifest was written
+        open(os.path.join(self.path, 'vp_kernel.bin'), 'w').close()
+        with self.assertRaises(Exception):
+            unix.wait_complete([self.path], timeout=0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()